@@ -2,14 +2,76 @@ import jwt
 from jwt.exceptions import ExpiredSignatureError, DecodeError
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi import Request, HTTPException
+from collections import OrderedDict
 import configparser
+import hashlib
 import logging
+import time
+
+from bin.Metrics import registry
+
+logger = logging.getLogger(__name__)
 
 config = configparser.ConfigParser()
 config.read("configuration.ini")
 JWT_SECRET = config["API"]["jwt_secret"]
 JWT_ALGORITHM = config["API"]["jwt_algorithm"]
 BROKER_JWT_SECRET = config["EMQX"]["emqx_jwt_secret"]
+TOKEN_CACHE_SIZE = config.getint("API", "token_cache_size", fallback=4096)
+TOKEN_CACHE_TTL = config.getfloat("API", "token_cache_ttl", fallback=300)
+
+
+class VerifiedTokenCache:
+    """Bounded LRU cache of tokens whose signature has already been verified, keyed by a digest of the token.
+
+    An entry is reused until the earlier of the token's `exp` claim and `ttl` seconds after verification,
+    so expired tokens are always rejected by a full decode.
+    """
+    def __init__(self, max_entries: int = 4096, ttl: float = 300):
+        self.max_entries = int(max_entries)
+        self.ttl = float(ttl)
+        self.entries: OrderedDict[bytes, tuple[float, dict]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(namespace: str, token: str) -> bytes:
+        return hashlib.sha256((namespace + ":" + token).encode()).digest()
+
+    def get(self, key: bytes) -> dict | None:
+        entry = self.entries.get(key)
+        if entry is None or entry[0] <= time.time():
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key: bytes, payload: dict):
+        expires = time.time() + self.ttl
+        if isinstance(payload.get("exp"), (int, float)):
+            expires = min(expires, payload["exp"])
+        self.entries[key] = (expires, payload)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+# Shared by JWTBearer and BrokerJWTBearer.
+token_cache = VerifiedTokenCache(TOKEN_CACHE_SIZE, TOKEN_CACHE_TTL)
+
+token_verify_seconds = registry.histogram("token_verify_seconds", "Time to verify a bearer token, including token cache hits.", ["token"])
+token_rejections = registry.counter("token_rejections_total", "Bearer tokens that failed verification.", ["token"])
+api_verify_time = token_verify_seconds.labels("api")
+broker_verify_time = token_verify_seconds.labels("broker")
 
 
 def encode_jwt(payload: dict[str, any]) -> str:
@@ -18,13 +80,17 @@ def encode_jwt(payload: dict[str, any]) -> str:
     return jwt.encode(payload=payload, key=JWT_SECRET, algorithm=JWT_ALGORITHM)
 
 def decode_jwt(token: str) -> dict:
+    key = token_cache.key("api", token)
+    cached = token_cache.get(key)
+    if cached is not None:
+        return cached
+
     try:
-        logging.log(logging.INFO, "JWT_SECRET: " + JWT_SECRET)
-        logging.log(logging.INFO, "Decoding token: " + token)
         decoded_token = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM], audience="authenticated")
+        token_cache.put(key, decoded_token)
         return decoded_token
     except Exception as e:
-        print(e)
+        logger.warning("Rejected API token: %s", e)
         return {}
     
 class JWTBearer(HTTPBearer):
@@ -45,12 +111,16 @@ class JWTBearer(HTTPBearer):
     def verify_jwt(self, jwtoken: str) -> bool:
         isTokenValid: bool = False
 
+        start = time.perf_counter()
         try:
             payload = decode_jwt(jwtoken)
         except:
             payload = None
+        api_verify_time.observe(time.perf_counter() - start)
         if payload:
             isTokenValid = True
+        else:
+            token_rejections.labels("api").inc()
         return isTokenValid
         
 def encode_broker_jwt(payload: dict[str, any]) -> str:
@@ -60,11 +130,17 @@ def encode_broker_jwt(payload: dict[str, any]) -> str:
 
 
 def decode_broker_jwt(token: str) -> dict:
+    key = token_cache.key("broker", token)
+    cached = token_cache.get(key)
+    if cached is not None:
+        return cached
+
     try:
         decoded_token = jwt.decode(token, BROKER_JWT_SECRET, algorithms=[JWT_ALGORITHM])
+        token_cache.put(key, decoded_token)
         return decoded_token
     except Exception as e:
-        print(e)
+        logger.warning("Rejected broker token: %s", e)
         return {}
 
 class BrokerJWTBearer(HTTPBearer):
@@ -85,10 +161,14 @@ class BrokerJWTBearer(HTTPBearer):
     def verify_jwt(self, jwtoken: str) -> bool:
         is_token_valid: bool = False
 
+        start = time.perf_counter()
         try:
             payload = decode_broker_jwt(jwtoken)
         except:
             payload = None
+        broker_verify_time.observe(time.perf_counter() - start)
         if payload:
             is_token_valid = True
+        else:
+            token_rejections.labels("broker").inc()
         return is_token_valid
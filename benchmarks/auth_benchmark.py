@@ -0,0 +1,33 @@
+"""
+Measures per-request bearer token verification cost with and without the verified token cache.
+
+auth.py reads configuration.ini on import, so run this from the directory the API runs in:
+    python -m benchmarks.auth_benchmark --requests 20000
+"""
+import argparse, time
+
+import auth
+
+def run(verify, token: str, requests: int) -> float:
+    start = time.perf_counter()
+    for _ in range(requests):
+        verify(token)
+    return (time.perf_counter() - start) * 1e6 / requests
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=20000)
+    args = parser.parse_args()
+
+    token = auth.encode_broker_jwt({"broker": "emqx", "exp": int(time.time()) + 3600})
+    bearer = auth.BrokerJWTBearer()
+
+    def uncached(token):
+        auth.token_cache.entries.clear()
+        return bearer.verify_jwt(token)
+
+    print(f"{'full HMAC verify':<20} {run(uncached, token, args.requests):>8.2f} us/request")
+    print(f"{'cached verify':<20} {run(bearer.verify_jwt, token, args.requests):>8.2f} us/request")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+"""
+Reports compression ratio and time per message for each compression profile.
+
+Usage: python -m benchmarks.compression_profiles --iterations 200
+"""
+import argparse, time
+
+from bin.CompressionExecutor import brotli_compress_b64, brotli_decompress_b64
+from bin.CompressionProfiles import PROFILES
+from benchmarks.payloads import make_reading_message, make_rule_update_message
+from models import EgressMessage, IngressMessage
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--iterations", type=int, default=200)
+    args = parser.parse_args()
+
+    samples = {
+        "ReadingMessage x4": IngressMessage(type=0, data=make_reading_message(modules=4)),
+        "ReadingMessage x64": IngressMessage(type=0, data=make_reading_message(modules=64)),
+        "RuleUpdateMessage x8": EgressMessage(type=0, data=make_rule_update_message(modules=8)),
+    }
+
+    print(f"{'message':<22}{'profile':<18}{'bytes':>8}{'ratio':>8}{'compress us':>14}{'decompress us':>16}")
+    for sample_name, sample in samples.items():
+        data = sample.model_dump_json().encode('utf-8')
+        for profile in PROFILES.values():
+            start = time.perf_counter()
+            for _ in range(args.iterations):
+                payload = brotli_compress_b64(data, profile.quality, profile.lgwin, profile.dictionary_id)
+            compress_us = (time.perf_counter() - start) * 1e6 / args.iterations
+
+            start = time.perf_counter()
+            for _ in range(args.iterations):
+                brotli_decompress_b64(payload, profile.dictionary_id)
+            decompress_us = (time.perf_counter() - start) * 1e6 / args.iterations
+
+            print(f"{sample_name:<22}{profile.name:<18}{len(payload):>8}{len(data) / len(payload):>8.2f}{compress_us:>14.1f}{decompress_us:>16.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""
+Minimal fake of the EMQX HTTP publish API, used to measure the API's egress throughput without a real broker.
+
+Run standalone with `python -m benchmarks.fake_emqx --port 18083 --latency 0.01` or start it in-process with `FakeEMQX`.
+"""
+import argparse, asyncio, json, threading
+
+class FakeEMQX:
+    """Keep-alive HTTP/1.1 server answering /api/v5/publish and /api/v5/publish/bulk after a fixed latency."""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 18083, latency: float = 0.01, status_code: int = 200):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.status_code = status_code
+        self.published = 0
+        self.requests = 0
+        self.loop = None
+        self.server = None
+        self.thread = None
+        self.writers = set()
+
+    @property
+    def url(self) -> str:
+        return "http://" + self.host + ":" + str(self.port)
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.writers.add(writer)
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                path = request_line.split()[1].decode()
+
+                content_length = 0
+                while True:
+                    header = await reader.readline()
+                    if header in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = header.decode().partition(":")
+                    if name.strip().lower() == "content-length":
+                        content_length = int(value.strip())
+                body = json.loads(await reader.readexactly(content_length)) if content_length else None
+
+                await asyncio.sleep(self.latency)
+                self.requests += 1
+
+                if path.endswith("/publish/bulk"):
+                    self.published += len(body)
+                    response = json.dumps([{"id": str(i)} for i in range(len(body))]).encode()
+                else:
+                    self.published += 1
+                    response = json.dumps({"id": "0"}).encode()
+
+                writer.write(b"HTTP/1.1 " + str(self.status_code).encode() + b" OK\r\n"
+                             b"Content-Type: application/json\r\n"
+                             b"Content-Length: " + str(len(response)).encode() + b"\r\n\r\n" + response)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.writers.discard(writer)
+            writer.close()
+
+    async def serve(self):
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    def start(self):
+        """Start the server on a background thread and return once it is listening."""
+        started = threading.Event()
+
+        def run():
+            self.loop = asyncio.new_event_loop()
+            self.loop.run_until_complete(self.serve())
+            started.set()
+            self.loop.run_forever()
+
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+        started.wait()
+        return self
+
+    async def close(self):
+        self.server.close()
+        for writer in list(self.writers):
+            writer.close()
+        await self.server.wait_closed()
+
+    def stop(self):
+        if self.loop is not None:
+            asyncio.run_coroutine_threadsafe(self.close(), self.loop).result(timeout=2)
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join(timeout=2)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake EMQX HTTP publish API.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=18083)
+    parser.add_argument("--latency", type=float, default=0.01, help="Seconds to wait before answering each request.")
+    args = parser.parse_args()
+
+    fake = FakeEMQX(args.host, args.port, args.latency)
+
+    async def main():
+        await fake.serve()
+        print("Fake EMQX listening on " + fake.url)
+        await asyncio.Event().wait()
+
+    asyncio.run(main())
@@ -0,0 +1,147 @@
+"""
+In-process fake of the parts of the supabase client the API uses, so benchmarks run without a database.
+
+Tables are lists of rows held in memory. Rows of tables that the API reads with embedded resources, such as
+`unit_rule_allocations` with its `rules`, are stored already embedded, and the select column list is not applied.
+Every call of `execute` and every CSV post sleeps for `latency` seconds, like a round trip to PostgREST.
+"""
+import threading, time
+from typing import Dict, List, Optional
+
+class FakeResponse:
+    def __init__(self, data, status_code: int = 201):
+        self.data = data
+        self.status_code = status_code
+
+    def raise_for_status(self):
+        pass
+
+class FakeQuery:
+    """Chainable query in the style of the postgrest query builder."""
+
+    def __init__(self, client: "FakeSupabase", table: str):
+        self.client = client
+        self.table = table
+        self.action = "select"
+        self.values = None
+        self.conflict: List[str] = []
+        self.filters = []
+        self.one = False
+
+    def select(self, columns: str = "*"):
+        self.action = "select"
+        return self
+
+    def update(self, values: dict):
+        self.action, self.values = "update", values
+        return self
+
+    def upsert(self, rows, on_conflict: str = ""):
+        self.action, self.values = "upsert", rows if isinstance(rows, list) else [rows]
+        self.conflict = [column.strip() for column in on_conflict.split(",") if column.strip()]
+        return self
+
+    def insert(self, rows):
+        self.action, self.values = "insert", rows if isinstance(rows, list) else [rows]
+        return self
+
+    def delete(self):
+        self.action = "delete"
+        return self
+
+    def eq(self, column: str, value):
+        self.filters.append(lambda row: row.get(column) == value)
+        return self
+
+    def in_(self, column: str, values):
+        values = set(values)
+        self.filters.append(lambda row: row.get(column) in values)
+        return self
+
+    def single(self):
+        self.one = True
+        return self
+
+    def matches(self, row: dict) -> bool:
+        return all(condition(row) for condition in self.filters)
+
+    def execute(self) -> FakeResponse:
+        time.sleep(self.client.latency)
+        with self.client.lock:
+            self.client.calls[self.table + "." + self.action] = self.client.calls.get(self.table + "." + self.action, 0) + 1
+            rows = self.client.tables.setdefault(self.table, [])
+
+            if self.action == "select":
+                data = [dict(row) for row in rows if self.matches(row)]
+                return FakeResponse((data[0] if data else None) if self.one else data, 200)
+            if self.action == "update":
+                data = [row for row in rows if self.matches(row)]
+                for row in data:
+                    row.update(self.values)
+                return FakeResponse(data)
+            if self.action == "delete":
+                rows[:] = [row for row in rows if not self.matches(row)]
+                return FakeResponse([])
+
+            for value in self.values:
+                existing = None
+                if self.conflict:
+                    existing = next((row for row in rows if all(row.get(column) == value.get(column) for column in self.conflict)), None)
+                if existing is not None:
+                    existing.update(value)
+                else:
+                    rows.append(dict(value))
+            return FakeResponse(self.values)
+
+class FakeSession:
+    """Stands in for `client.postgrest.session`, which the reading store posts CSV bodies through."""
+
+    def __init__(self, client: "FakeSupabase"):
+        self.client = client
+
+    def post(self, path: str, content: bytes = b"", headers: Optional[dict] = None) -> FakeResponse:
+        time.sleep(self.client.latency)
+        rows = max(0, len(content.splitlines()) - 1) # Less the header.
+        with self.client.lock:
+            self.client.calls[path.strip("/") + ".csv"] = self.client.calls.get(path.strip("/") + ".csv", 0) + 1
+            self.client.rows_written[path.strip("/")] = self.client.rows_written.get(path.strip("/"), 0) + rows
+        return FakeResponse(None)
+
+class FakeRpc:
+    """Database function call, counted along with the rows passed in `rows`."""
+
+    def __init__(self, client: "FakeSupabase", name: str, params: dict):
+        self.client = client
+        self.name = name
+        self.params = params
+
+    def execute(self) -> FakeResponse:
+        time.sleep(self.client.latency)
+        with self.client.lock:
+            self.client.calls["rpc." + self.name] = self.client.calls.get("rpc." + self.name, 0) + 1
+            self.client.rows_written[self.name] = self.client.rows_written.get(self.name, 0) + len(self.params.get("rows") or [])
+        return FakeResponse(None, 200)
+
+class FakePostgrest:
+    def __init__(self, client: "FakeSupabase"):
+        self.session = FakeSession(client)
+
+class FakeSupabase:
+    """Drop-in for `supabase.Client` in `main.supabase_client`, the sync state store and the reading store.
+
+    Readings posted as CSV, and rows passed to database functions, are counted rather than kept, so long runs do not
+    grow memory.
+    """
+    def __init__(self, tables: Optional[Dict[str, List[dict]]] = None, latency: float = 0.0):
+        self.tables: Dict[str, List[dict]] = tables or {}
+        self.latency = float(latency)
+        self.lock = threading.Lock()
+        self.calls: Dict[str, int] = {}
+        self.rows_written: Dict[str, int] = {}
+        self.postgrest = FakePostgrest(self)
+
+    def table(self, name: str) -> FakeQuery:
+        return FakeQuery(self, name)
+
+    def rpc(self, name: str, params: dict) -> FakeRpc:
+        return FakeRpc(self, name, params)
@@ -0,0 +1,116 @@
+"""Synthetic fleets of control units, built from the examples in json_examples, shared by the load benchmarks."""
+import json, os, random, uuid
+from typing import Dict, List, Tuple
+
+from benchmarks.payloads import compress_ingress
+from bin.TariffTable import TariffCache
+from models import DeviceRule, ModuleRuleUpdate, ReadingDataItem, ReadingMessage, RuleUpdateMessage, StateChangeItem, TOUSchedule, UnitRuleUpdate
+
+EXAMPLES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "json_examples")
+
+def load_example_objects(name: str) -> list:
+    """JSON objects of an example file. Some examples hold several objects one after another, not an array."""
+    with open(os.path.join(EXAMPLES, name)) as file:
+        text = file.read()
+
+    decoder = json.JSONDecoder()
+    objects = []
+    index = 0
+    while True:
+        # Skip whitespace and the commas some examples put between objects.
+        while index < len(text) and text[index] in " \t\r\n,":
+            index += 1
+        if index >= len(text):
+            return objects
+        value, index = decoder.raw_decode(text, index)
+        objects.append(value)
+
+def load_example_reading() -> dict:
+    """The first reading of json_examples/ReadingMessage.json, which fleets vary around."""
+    message = load_example_objects("ReadingMessage.json")[0]["data"]
+    # The example predates the rename of the reading list to `readings`.
+    return (message.get("readings") or message["data"])[0]
+
+def load_example_rules() -> List[DeviceRule]:
+    return [DeviceRule.model_validate(item) for item in load_example_objects("ExampleRules.json") if "expression" in item]
+
+def load_example_tou() -> TOUSchedule:
+    return TOUSchedule.model_validate(load_example_objects("TOUPricing.json")[0])
+
+class Fleet:
+    """`units` control units with `modules` modules each, whose readings vary around the example reading.
+
+    Every unit and module gets a stable id from `seed`, so runs with the same arguments send the same packets.
+    """
+    def __init__(self, units: int = 100, modules: int = 16, state_changes: int = 2, period: int = 300, seed: int = 0):
+        self.period = int(period)
+        self.state_changes = int(state_changes)
+        self.rng = random.Random(seed)
+        self.template = load_example_reading()
+        self.rules = load_example_rules()
+        self.tou = load_example_tou()
+
+        self.modules: Dict[str, List[str]] = {}
+        for _ in range(units):
+            unit_id = str(uuid.UUID(int=self.rng.getrandbits(128)))
+            self.modules[unit_id] = [str(uuid.UUID(int=self.rng.getrandbits(128))) for _ in range(modules)]
+
+    @property
+    def unit_ids(self) -> List[str]:
+        return list(self.modules)
+
+    def reading(self, module_id: str, period_start: int) -> ReadingDataItem:
+        rng, template = self.rng, self.template
+        return ReadingDataItem(
+            module_id=module_id,
+            sample_count=max(1, template["sample_count"] + rng.randint(-5, 5)),
+            mean_voltage=round(template["mean_voltage"] + rng.uniform(-5, 5), 3),
+            mean_frequency=round(template["mean_frequency"] + rng.uniform(-0.2, 0.2), 4),
+            apparent_power=[round(value * rng.uniform(0.5, 1.5), 4) for value in template["apparent_power"]],
+            power_factor=[round(max(-1.0, min(1.0, value + rng.uniform(-0.1, 0.1))), 6) for value in template["power_factor"]],
+            kwh_usage=round(template["kwh_usage"] * rng.uniform(0.5, 1.5), 3),
+            state_changes=[
+                StateChangeItem(state=bool(i % 2), timestamp=period_start + rng.randint(0, self.period))
+                for i in range(self.state_changes)
+            ],
+        )
+
+    def reading_message(self, unit_id: str, period_start: int) -> ReadingMessage:
+        return ReadingMessage(
+            period_start=period_start,
+            period_end=period_start + self.period,
+            readings=[self.reading(module_id, period_start) for module_id in self.modules[unit_id]],
+        )
+
+    def ingress_packets(self, periods: int = 1, first_period: int = 1696790400) -> List[Tuple[str, str]]:
+        """One compressed reading packet per unit and period, as (unit id, payload), compressed the way units do."""
+        return [
+            (unit_id, compress_ingress(self.reading_message(unit_id, first_period + index * self.period)))
+            for index in range(periods)
+            for unit_id in self.modules
+        ]
+
+    def rule_update(self, unit_id: str) -> RuleUpdateMessage:
+        """Full replace of the example rules, the first two on the unit and the rest on every module."""
+        return RuleUpdateMessage(
+            unit_rules=UnitRuleUpdate(action=1, rules=self.rules[:2]),
+            module_rules=[ModuleRuleUpdate(module_id=module_id, action=1, rules=self.rules[2:]) for module_id in self.modules[unit_id]],
+        )
+
+    def tables(self, broker_address: str = "127.0.0.1", broker_port: int = 1883) -> Dict[str, List[dict]]:
+        """Rows for benchmarks.fake_supabase, in the embedded shape the API selects them in."""
+        unit_rules, module_rules = self.rules[:2], self.rules[2:]
+        return {
+            "control_units": [{"id": unit_id, "user_id": None, "broker_id": "broker", "brokers": {"address": broker_address, "port": broker_port}} for unit_id in self.modules],
+            "topic_allocations": [
+                {"unit_id": unit_id, "ingress": ingress, "all": False, "topics": {"topic": topic}}
+                for unit_id in self.modules for ingress, topic in ((True, "/ingress/" + unit_id), (False, "/egress/" + unit_id))
+            ],
+            "unit_rule_allocations": [{"unit_id": unit_id, "rules": rule.model_dump()} for unit_id in self.modules for rule in unit_rules],
+            "modules": [
+                {"id": module_id, "unit_id": unit_id, "module_rule_allocations": [{"rules": rule.model_dump()} for rule in module_rules]}
+                for unit_id, module_ids in self.modules.items() for module_id in module_ids
+            ],
+            "unit_sync_state": [],
+            "unit_tariffs": [{"unit_id": unit_id, "hash": TariffCache.key(self.tou), "schedule": self.tou.model_dump()} for unit_id in self.modules],
+        }
@@ -0,0 +1,237 @@
+"""
+Load test of the API against a synthetic fleet, with in-process fakes of supabase and EMQX.
+
+Every unit sends `--periods` reading packets to /mqtt/v1/ingress, and is then sent its TOU schedule, its rules, a
+rules sync and a bulk TOU update through the egress endpoints. Each scenario reports throughput, p50/p99 latency,
+process CPU time and the time spent per pipeline stage (from the /metrics histograms). The results are written as
+JSON; with --baseline, a previous results file is compared against.
+
+auth.py and main.py read configuration.ini on import, so run this from the directory the API runs in:
+    python -m benchmarks.fleet_benchmark --units 200 --modules 16 --periods 3 --output fleet_results.json
+"""
+import argparse, asyncio, datetime, json, os, platform, subprocess, tempfile, time
+from typing import Awaitable, Callable, List
+
+import httpx
+
+import main
+from benchmarks.fake_emqx import FakeEMQX
+from benchmarks.fake_supabase import FakeSupabase
+from benchmarks.fleet import Fleet
+from bin.BrokerPublisher import BrokerPublisher
+from bin.EgressOutbox import EgressOutbox
+from bin.Metrics import Histogram, registry
+from bin.ReadingStore import SupabaseReadingStore
+from bin.SyncState import SyncStateStore
+from bin.TariffTable import TariffStore
+from models import EgressMessage
+
+SCENARIOS = ("ingress", "tou", "rules", "sync", "bulk")
+
+def percentile(values: List[float], fraction: float) -> float:
+    """Nearest-rank percentile of sorted values."""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, int(round(fraction * len(values) + 0.5)) - 1))]
+
+def stage_totals() -> dict:
+    """Seconds and observations so far of every histogram child of the metrics registry, by metric and labels."""
+    totals = {}
+    for metric in registry.metrics.values():
+        if isinstance(metric, Histogram) and metric.name.endswith("_seconds"):
+            for values, child in metric.children.items():
+                totals[":".join((metric.name,) + values)] = (child.sum, child.count)
+    return totals
+
+def stage_delta(before: dict, after: dict) -> dict:
+    stages = {}
+    for key, (seconds, count) in after.items():
+        previous_seconds, previous_count = before.get(key, (0.0, 0))
+        if count > previous_count:
+            stages[key] = {"seconds": round(seconds - previous_seconds, 6), "count": count - previous_count}
+    return stages
+
+async def wait_for_outbox(timeout: float = 60.0):
+    """Wait until the egress outbox has delivered everything, if it is enabled."""
+    if main.egress_outbox is None:
+        return
+    deadline = time.monotonic() + timeout
+    while (await main.egress_outbox.stats())["pending"] and time.monotonic() < deadline:
+        await asyncio.sleep(0.01)
+
+async def run_scenario(name: str, requests: List[Callable[[], Awaitable[httpx.Response]]], concurrency: int, drain: Callable[[], Awaitable[None]]) -> dict:
+    """Send the requests with at most `concurrency` in flight, then wait for `drain`. Returns the scenario's results."""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = 0
+
+    async def send(request):
+        nonlocal errors
+        async with semaphore:
+            start = time.perf_counter()
+            response = await request()
+            latencies.append(time.perf_counter() - start)
+            if response.status_code >= 400 or response.json().get("result", "ok") != "ok":
+                errors += 1
+
+    stages = stage_totals()
+    cpu = time.process_time()
+    start = time.perf_counter()
+    await asyncio.gather(*(send(request) for request in requests))
+    elapsed = time.perf_counter() - start
+    await drain()
+    drained = time.perf_counter() - start
+
+    latencies.sort()
+    result = {
+        "requests": len(requests),
+        "errors": errors,
+        "seconds": round(elapsed, 4),
+        "drained_seconds": round(drained, 4),
+        "requests_per_second": round(len(requests) / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 0.5) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        "max_ms": round(latencies[-1] * 1000, 3) if latencies else 0.0,
+        "cpu_seconds": round(time.process_time() - cpu, 4),
+        "stages": stage_delta(stages, stage_totals()),
+    }
+    print(f"{name:<8} {result['requests_per_second']:>9.1f} req/s  p50 {result['p50_ms']:>8.2f} ms  p99 {result['p99_ms']:>8.2f} ms  "
+          f"cpu {result['cpu_seconds']:>6.2f}s  drained {result['drained_seconds']:>6.2f}s  {errors} errors")
+    return result
+
+def install_fakes(supabase: FakeSupabase, emqx: FakeEMQX, outbox_path: str):
+    """Point the API's clients at the fakes. Call after main.load_config and before main.startup."""
+    main.supabase_client = supabase
+    main.sync_state = SyncStateStore(supabase)
+    main.reading_store = SupabaseReadingStore(supabase, cost=main.tariff_tables is not None)
+    main.tariff_store = TariffStore(supabase)
+
+    publisher = main.broker_publisher
+    main.broker_publisher = BrokerPublisher(
+        emqx.url + "/api/v5/publish", {"Content-Type": "application/json"},
+        pool_size=publisher.pool_size, retries=publisher.retries, bulk_chunk_size=publisher.bulk_chunk_size,
+        bulk_concurrency=publisher.bulk_concurrency,
+    )
+
+    if main.egress_outbox is not None:
+        outbox = main.egress_outbox
+        main.egress_outbox = EgressOutbox(
+            outbox_path, main.broker_publisher.publish_bulk, outbox.breaker, chunk_size=outbox.chunk_size,
+            concurrency=outbox.concurrency, backoff=outbox.backoff, max_backoff=outbox.max_backoff,
+            max_attempts=outbox.max_attempts, lease=outbox.lease,
+        )
+        outbox.executor.submit(outbox.connection.close).result()
+        outbox.executor.shutdown()
+
+async def run(args) -> dict:
+    fleet = Fleet(args.units, args.modules, args.state_changes, seed=args.seed)
+    packets = fleet.ingress_packets(args.periods)
+    print(f"{args.units} units, {args.modules} modules, {args.state_changes} state changes, {len(packets)} packets "
+          f"of {sum(len(payload) for _, payload in packets) // len(packets)} base64 bytes")
+
+    supabase = FakeSupabase(fleet.tables(), latency=args.db_latency)
+    emqx = FakeEMQX(port=0, latency=args.broker_latency).start()
+    directory = tempfile.TemporaryDirectory()
+
+    main.load_config()
+    install_fakes(supabase, emqx, os.path.join(directory.name, "outbox.sqlite3"))
+    await main.startup()
+
+    api_headers = {"Authorization": "Bearer " + main.encode_jwt({"aud": "authenticated"})}
+    broker_headers = {"Authorization": "Bearer " + main.encode_broker_jwt({"broker": "benchmark"})}
+    tou = fleet.tou.model_dump(mode="json")
+    bulk_tou = EgressMessage(type=3, data=fleet.tou).model_dump(mode="json")
+
+    results = {}
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://api", timeout=None) as client:
+        scenarios = {
+            "ingress": ([
+                lambda unit_id=unit_id, payload=payload: client.post("/mqtt/v1/ingress", json={"clientId": unit_id, "topic": "/ingress/" + unit_id, "data": payload}, headers=broker_headers)
+                for unit_id, payload in packets
+            ], main.reading_buffer.flush),
+            "tou": ([
+                lambda unit_id=unit_id: client.post("/mqtt/v1/tou", params={"unit_id": unit_id}, json=tou, headers=api_headers)
+                for unit_id in fleet.unit_ids
+            ], wait_for_outbox),
+            "rules": ([
+                lambda unit_id=unit_id: client.post("/mqtt/v1/rules", params={"unit_id": unit_id}, json=fleet.rule_update(unit_id).model_dump(mode="json"), headers=api_headers)
+                for unit_id in fleet.unit_ids
+            ], wait_for_outbox),
+            "sync": ([
+                lambda unit_id=unit_id: client.get("/mqtt/v1/sync", params={"unit_id": unit_id}, headers=api_headers)
+                for unit_id in fleet.unit_ids
+            ], wait_for_outbox),
+            "bulk": ([
+                lambda unit_ids=fleet.unit_ids[start:start + args.bulk_size]: client.post("/mqtt/v1/bulk", json={"unit_ids": unit_ids, "message": bulk_tou}, headers=api_headers)
+                for start in range(0, args.units, args.bulk_size)
+            ], wait_for_outbox),
+        }
+        for name in args.scenarios:
+            requests, drain = scenarios[name]
+            results[name] = await run_scenario(name, requests, args.concurrency, drain)
+
+    await main.shutdown()
+    emqx.stop()
+    directory.cleanup()
+
+    if "ingress" in results:
+        results["ingress"]["rows_written"] = supabase.rows_written.get("readings", 0)
+    print(f"broker received {emqx.published} messages in {emqx.requests} requests, database calls {supabase.calls}")
+    return results
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, cwd=os.path.dirname(__file__)).stdout.strip()
+    except OSError:
+        return ""
+
+def compare(results: dict, baseline: dict):
+    """Print the change of throughput and p99 latency of every scenario against a baseline results file."""
+    print(f"\nAgainst {baseline.get('commit') or 'baseline'} from {baseline.get('timestamp', '?')}:")
+    for name, result in results["scenarios"].items():
+        previous = baseline.get("scenarios", {}).get(name)
+        if not previous or not previous["requests_per_second"] or not previous["p99_ms"]:
+            continue
+        throughput = (result["requests_per_second"] / previous["requests_per_second"] - 1) * 100
+        p99 = (result["p99_ms"] / previous["p99_ms"] - 1) * 100
+        print(f"{name:<8} throughput {throughput:>+7.1f}%  p99 {p99:>+7.1f}%")
+
+def run_benchmark():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--units", type=int, default=200)
+    parser.add_argument("--modules", type=int, default=16, help="Modules per unit.")
+    parser.add_argument("--state-changes", type=int, default=2, help="State changes per module and period.")
+    parser.add_argument("--periods", type=int, default=3, help="Reading packets sent by each unit.")
+    parser.add_argument("--concurrency", type=int, default=64, help="Requests in flight.")
+    parser.add_argument("--bulk-size", type=int, default=100, help="Units per bulk request.")
+    parser.add_argument("--db-latency", type=float, default=0.002, help="Seconds per fake database call.")
+    parser.add_argument("--broker-latency", type=float, default=0.005, help="Seconds per fake broker request.")
+    parser.add_argument("--scenarios", type=lambda value: [name.strip() for name in value.split(",")], default=list(SCENARIOS),
+                        help="Comma separated subset of: " + ", ".join(SCENARIOS))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="fleet_results.json", help="Results file to write.")
+    parser.add_argument("--baseline", help="Earlier results file to compare against.")
+    args = parser.parse_args()
+
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error("Unknown scenarios: " + ", ".join(sorted(unknown)))
+
+    results = {
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "parameters": {key: value for key, value in vars(args).items() if key not in ("output", "baseline")},
+        "scenarios": asyncio.run(run(args)),
+    }
+    with open(args.output, "w") as file:
+        json.dump(results, file, indent=2)
+    print("Wrote " + args.output)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            compare(results, json.load(file))
+
+if __name__ == "__main__":
+    run_benchmark()
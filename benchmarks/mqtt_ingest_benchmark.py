@@ -0,0 +1,106 @@
+"""
+Compares ingress throughput of the MQTT ingest daemon against the HTTP webhook path.
+
+The daemon run publishes packets to a real broker and measures an in-process IngestWorker draining them; the webhook
+run posts the same packets to the API app in-process. Readings are counted instead of written to storage.
+
+Run from the directory the API runs in, with a broker listening:
+    python -m benchmarks.mqtt_ingest_benchmark --messages 5000 --modules 16 --host localhost --port 1883
+"""
+import argparse, asyncio, configparser, time
+
+import httpx
+import paho.mqtt.client as mqtt
+
+import main
+from benchmarks.payloads import make_reading_message, compress_ingress
+from bin.ReadingStore import ReadingStore
+from mqtt.IngestDaemon import IngestWorker
+
+# Unit every packet is sent from, published on its own ingress topic.
+UNIT_ID = "5d6f3a40-8c1e-4f0b-9a57-2b8e6c1d9f03"
+
+class CountingStore(ReadingStore):
+    def __init__(self):
+        self.rows = 0
+
+    def write(self, batch):
+        self.rows += len(batch)
+
+def make_payloads(messages: int, modules: int) -> list:
+    return [compress_ingress(make_reading_message(modules=modules, seed=seed)) for seed in range(messages)]
+
+async def run_daemon(config: configparser.ConfigParser, payloads: list, topic: str) -> float:
+    worker = IngestWorker(0, config)
+    await worker.start()
+    store = main.reading_store = CountingStore()
+
+    publisher = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, protocol=worker.protocol)
+    publisher.connect(worker.host, worker.port)
+    publisher.loop_start()
+    await asyncio.sleep(0.5) # Let the worker's subscription settle.
+
+    start = time.perf_counter()
+    for payload in payloads:
+        publisher.publish(topic, payload, qos=worker.qos)
+    while worker.processed + worker.failed < len(payloads):
+        await asyncio.sleep(0.01)
+    await main.reading_buffer.flush()
+    elapsed = time.perf_counter() - start
+
+    publisher.disconnect()
+    publisher.loop_stop()
+    await worker.stop()
+    print(f"{'mqtt daemon':<12} {len(payloads) / elapsed:>10.1f} msg/s, {store.rows} rows, {worker.failed} failed")
+    return elapsed
+
+async def run_webhook(payloads: list, topic: str, concurrency: int) -> float:
+    main.load_config()
+    await main.startup()
+    store = main.reading_store = CountingStore()
+    headers = {"Authorization": "Bearer " + main.encode_broker_jwt({"broker": "benchmark"})}
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://api") as client:
+        async def post(payload):
+            async with semaphore:
+                response = await client.post("/mqtt/v1/ingress", json={"clientId": UNIT_ID, "topic": topic, "data": payload}, headers=headers)
+                response.raise_for_status()
+
+        start = time.perf_counter()
+        await asyncio.gather(*(post(payload) for payload in payloads))
+        await main.reading_buffer.flush()
+        elapsed = time.perf_counter() - start
+
+    await main.shutdown()
+    print(f"{'webhook':<12} {len(payloads) / elapsed:>10.1f} msg/s, {store.rows} rows")
+    return elapsed
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument("--modules", type=int, default=16, help="Readings per packet.")
+    parser.add_argument("--concurrency", type=int, default=64, help="Concurrent webhook requests.")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=1883)
+    parser.add_argument("--protocol", choices=("5", "3.1.1"), default="5")
+    parser.add_argument("--no-shared", action="store_true", help="Subscribe without $share, for brokers that lack shared subscriptions.")
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read("configuration.ini")
+    if not config.has_section("MQTT_INGEST"):
+        config.add_section("MQTT_INGEST")
+    config.set("MQTT_INGEST", "host", args.host)
+    config.set("MQTT_INGEST", "port", str(args.port))
+    config.set("MQTT_INGEST", "protocol", args.protocol)
+    config.set("MQTT_INGEST", "shared", str(not args.no_shared))
+    topic = config.get("MQTT_INGEST", "topics", fallback="/ingress/+").split(",")[0].strip().replace("+", UNIT_ID)
+
+    payloads = make_payloads(args.messages, args.modules)
+    print(f"{args.messages} packets, {args.modules} readings each")
+    asyncio.run(run_webhook(payloads, topic, args.concurrency))
+    asyncio.run(run_daemon(config, payloads, topic))
+
+if __name__ == "__main__":
+    run()
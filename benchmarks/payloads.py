@@ -0,0 +1,49 @@
+"""Synthetic SDR payloads shared by the benchmarks."""
+import base64, random, uuid
+import brotli
+
+from models import IngressMessage, ReadingDataItem, ReadingMessage, StateChangeItem, DeviceRule, ModuleRuleUpdate, RuleUpdateMessage, UnitRuleUpdate
+
+# Rules from json_examples/ExampleRules.json.
+EXAMPLE_RULES = [
+    DeviceRule(priority=1, expression="TSP <= 5000 && Day == 1 && hr > 12", command="setVar(bool, myBool, 1);"),
+    DeviceRule(priority=2, expression="TSP > 5000 && Day == 1 && hr < 12", command="setVar(bool, myBool, 0);"),
+    DeviceRule(priority=10, expression="myBool", command="setState(1); setVar(bool, myBool, 1);"),
+    DeviceRule(priority=10, expression="!myBool", command="setState(0); setVar(bool, myBool, 0);"),
+]
+
+def make_reading_message(modules: int = 16, state_changes: int = 2, period_start: int = 1696790400, period: int = 300, seed: int = 0) -> ReadingMessage:
+    """Build a ReadingMessage with `modules` readings, in the shape of json_examples/ReadingMessage.json."""
+    rng = random.Random(seed)
+    readings = []
+    for _ in range(modules):
+        readings.append(ReadingDataItem(
+            module_id=str(uuid.UUID(int=rng.getrandbits(128))),
+            sample_count=rng.randint(5, 30),
+            mean_voltage=round(rng.uniform(225, 240), 3),
+            mean_frequency=round(rng.uniform(49.8, 50.2), 4),
+            apparent_power=[round(rng.uniform(0, 600), 4) for _ in range(4)],
+            power_factor=[round(rng.uniform(-1, 1), 4) for _ in range(4)],
+            kwh_usage=round(rng.uniform(0, 2), 3),
+            state_changes=[
+                StateChangeItem(state=bool(i % 2), timestamp=period_start + rng.randint(0, period))
+                for i in range(state_changes)
+            ],
+        ))
+    return ReadingMessage(period_start=period_start, period_end=period_start + period, readings=readings)
+
+def compress_ingress(message: ReadingMessage) -> str:
+    """Compress a reading message the way units do: IngressMessage JSON, brotli, base64."""
+    data = IngressMessage(type=0, data=message).model_dump_json().encode('utf-8')
+    return base64.b64encode(brotli.compress(data)).decode('utf-8')
+
+def make_rule_update_message(modules: int = 8, seed: int = 0) -> RuleUpdateMessage:
+    """Build a full replace RuleUpdateMessage with the example rules on every module."""
+    rng = random.Random(seed)
+    return RuleUpdateMessage(
+        unit_rules=UnitRuleUpdate(action=1, rules=EXAMPLE_RULES[:2]),
+        module_rules=[
+            ModuleRuleUpdate(module_id=str(uuid.UUID(int=rng.getrandbits(128))), action=1, rules=EXAMPLE_RULES[2:])
+            for _ in range(modules)
+        ],
+    )
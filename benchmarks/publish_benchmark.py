@@ -0,0 +1,63 @@
+"""
+Compares egress throughput of the old blocking `requests.post` publish against the pooled `BrokerPublisher`.
+
+Usage: python -m benchmarks.publish_benchmark --messages 500 --concurrency 50 --latency 0.01
+"""
+import argparse, asyncio, time
+
+import requests
+
+from bin.BrokerPublisher import BrokerPublisher
+from benchmarks.fake_emqx import FakeEMQX
+from models import BrokerPublishMessage
+
+HEADERS = {"Content-Type": "application/json"}
+
+def make_message(i: int) -> BrokerPublishMessage:
+    return BrokerPublishMessage(payload_encoding="plain", topic="/egress/unit-" + str(i), payload="GxIA+I2UqVmDPQ==", qos=0, retain=False)
+
+async def run_blocking(url: str, messages: int, concurrency: int) -> float:
+    """Mirrors the previous publish_message: a synchronous POST inside a coroutine."""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def publish(i):
+        async with semaphore:
+            requests.post(url, json=make_message(i).model_dump(), headers=HEADERS)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(publish(i) for i in range(messages)))
+    return time.perf_counter() - start
+
+async def run_pooled(url: str, messages: int, concurrency: int) -> float:
+    publisher = BrokerPublisher(url, HEADERS, pool_size=concurrency)
+    await publisher.start()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def publish(i):
+        async with semaphore:
+            await publisher.publish(make_message(i))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(publish(i) for i in range(messages)))
+    elapsed = time.perf_counter() - start
+    await publisher.stop()
+    return elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--messages", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.01, help="Simulated broker latency in seconds.")
+    args = parser.parse_args()
+
+    fake = FakeEMQX(port=0, latency=args.latency).start()
+    url = fake.url + "/api/v5/publish"
+
+    for name, runner in (("blocking requests.post", run_blocking), ("pooled BrokerPublisher", run_pooled)):
+        elapsed = asyncio.run(runner(url, args.messages, args.concurrency))
+        print(f"{name:<24} {args.messages / elapsed:>10.1f} msg/s  ({elapsed:.2f}s for {args.messages} messages)")
+
+    fake.stop()
+
+if __name__ == "__main__":
+    main()
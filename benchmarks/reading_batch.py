@@ -0,0 +1,78 @@
+"""
+Compares building database rows with per-reading dicts (the previous insert_readings) against ReadingBatch.
+
+Usage: python -m benchmarks.reading_batch --packets 500 --modules 64
+"""
+import argparse, datetime, json, time
+
+from bin.ReadingBatch import ReadingBatch
+from benchmarks.payloads import make_reading_message
+
+def dict_rows(data):
+    """The row building of insert_readings before ReadingBatch, followed by the JSON encoding PostgREST does."""
+    readings_to_insert = []
+    state_changes_to_insert = []
+
+    period_start = datetime.datetime.fromtimestamp(data.period_start).strftime("%Y-%m-%d %H:%M:%S+00")
+    period_end = datetime.datetime.fromtimestamp(data.period_end).strftime("%Y-%m-%d %H:%M:%S+00")
+
+    for reading in data.readings:
+        readings_to_insert.append({
+            "iqr_apparent_power": reading.apparent_power[2],
+            "iqr_power_factor": reading.power_factor[2],
+            "kurtosis_apparent_power": reading.apparent_power[3],
+            "kurtosis_power_factor": reading.power_factor[3],
+            "kwh_usage": reading.kwh_usage,
+            "max_apparent_power": reading.apparent_power[1],
+            "max_power_factor": reading.power_factor[1],
+            "mean_apparent_power": reading.apparent_power[0],
+            "mean_frequency": reading.mean_frequency,
+            "mean_power_factor": reading.power_factor[0],
+            "mean_voltage": reading.mean_voltage,
+            "module_id": reading.module_id,
+            "period_end_time": period_end,
+            "period_start_time": period_start,
+            "sample_count": reading.sample_count
+        })
+
+        for state_change in reading.state_changes:
+            state_changes_to_insert.append({
+                "module" : reading.module_id,
+                "state" : state_change.state,
+                "timestamp" : datetime.datetime.fromtimestamp(state_change.timestamp).strftime("%Y-%m-%d %H:%M:%S+00")
+            })
+
+    return json.dumps(readings_to_insert), json.dumps(state_changes_to_insert)
+
+def batch_rows(messages):
+    batch = ReadingBatch()
+    for message in messages:
+        batch.add_message(message)
+    return batch.readings_csv(), batch.state_changes_csv()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--packets", type=int, default=500)
+    parser.add_argument("--modules", type=int, default=64)
+    parser.add_argument("--state-changes", type=int, default=2)
+    args = parser.parse_args()
+
+    messages = [
+        make_reading_message(modules=args.modules, state_changes=args.state_changes, period_start=1696790400 + 300 * i, seed=i)
+        for i in range(args.packets)
+    ]
+    readings = args.packets * args.modules
+
+    start = time.perf_counter()
+    for message in messages:
+        dict_rows(message)
+    elapsed = time.perf_counter() - start
+    print(f"{'dict rows + json':<20} {elapsed * 1e6 / readings:>8.2f} us/reading")
+
+    start = time.perf_counter()
+    batch_rows(messages)
+    elapsed = time.perf_counter() - start
+    print(f"{'ReadingBatch + csv':<20} {elapsed * 1e6 / readings:>8.2f} us/reading")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""
+Compares the binary reading frame (MQTTDataPacket e = 1) with brotli compressed JSON (e = 0): wire size and
+decoding cost from the base64 payload to a ReadingBatch. Every packet is round-tripped through the codec first.
+
+Usage: python -m benchmarks.reading_codec --packets 500 --modules 16
+"""
+import argparse, base64, time
+
+import brotli
+
+from bin.ReadingBatch import ReadingBatch
+from bin.ReadingCodec import ReadingCodecError, encode_reading_message, decode_reading_batch, decode_reading_batch_b64
+from benchmarks.payloads import make_reading_message, compress_ingress
+from models import IngressMessage, ReadingMessage, StateChangeItem
+
+def expected_batch(message: ReadingMessage) -> ReadingBatch:
+    batch = ReadingBatch()
+    batch.add_message(message)
+    return batch
+
+def check_round_trip(message: ReadingMessage):
+    message_type, batch = decode_reading_batch(encode_reading_message(message))
+    assert message_type == 0
+    assert vars(batch) == vars(expected_batch(message)), "Binary frame does not round-trip."
+
+def check_codec():
+    """Round trips of the edge cases, and rejection of damaged frames."""
+    check_round_trip(ReadingMessage(period_start=1696790400, period_end=1696790700, readings=[]))
+    message = make_reading_message(modules=4, state_changes=3)
+    check_round_trip(message)
+
+    # Ids that are not canonical UUIDs switch the frame to string ids, so they come back exactly as sent.
+    readings = [reading.model_copy(update={"module_id": module_id}) for reading, module_id in zip(message.readings, ("module-1", "D0F96266-6D4B-46CB-9C7B-C31142F6AB30", "ünïcode", ""))]
+    check_round_trip(message.model_copy(update={"readings": readings}))
+
+    # State changes before the period start, and no state changes at all.
+    readings = [reading.model_copy(update={"state_changes": None}) for reading in message.readings]
+    readings[0] = readings[0].model_copy(update={"state_changes": message.readings[0].state_changes + [StateChangeItem(state=True, timestamp=1)]})
+    check_round_trip(message.model_copy(update={"readings": readings}))
+
+    frame = encode_reading_message(message)
+    for damaged in (frame[:-1], frame + b"\0", frame[:20], b"\2" + frame[1:], b""):
+        try:
+            decode_reading_batch(damaged)
+        except ReadingCodecError:
+            continue
+        raise AssertionError("Damaged frame was accepted.")
+
+def decode_json(payload: str) -> ReadingBatch:
+    return expected_batch(IngressMessage.model_validate_json(brotli.decompress(base64.b64decode(payload))).data)
+
+def run(decode, payloads: list) -> float:
+    start = time.perf_counter()
+    for payload in payloads:
+        decode(payload)
+    return (time.perf_counter() - start) * 1e6 / len(payloads)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--packets", type=int, default=500)
+    parser.add_argument("--modules", type=int, default=16, help="Readings per packet.")
+    args = parser.parse_args()
+
+    check_codec()
+    messages = [make_reading_message(modules=args.modules, seed=seed) for seed in range(args.packets)]
+    for message in messages:
+        check_round_trip(message)
+    print(f"Round trips ok, {args.packets} packets of {args.modules} readings")
+
+    encodings = {
+        "json": [IngressMessage(type=0, data=message).model_dump_json().encode('utf-8') for message in messages],
+        "json+brotli": [base64.b64decode(compress_ingress(message)) for message in messages],
+        "binary": [encode_reading_message(message) for message in messages],
+        "binary+brotli": [brotli.compress(encode_reading_message(message)) for message in messages],
+    }
+    for name, encoded in encodings.items():
+        size = sum(map(len, encoded)) / len(encoded)
+        print(f"{name:<16} {size:>9.1f} bytes/packet {size * 4 / 3:>9.1f} as base64")
+
+    json_payloads = [compress_ingress(message) for message in messages]
+    binary_payloads = [base64.b64encode(encode_reading_message(message)).decode('ascii') for message in messages]
+    print(f"{'decode json':<16} {run(decode_json, json_payloads):>9.1f} us/packet")
+    print(f"{'decode binary':<16} {run(decode_reading_batch_b64, binary_payloads):>9.1f} us/packet")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+Prices readings with a compiled TariffTable against walking the TOUSchedule for every reading. That both agree is
+checked by tests/test_tariff_table.py, against `walk_rate` here.
+
+Usage: python -m benchmarks.tariff_table --readings 1000000
+"""
+import argparse, datetime, math, time
+
+import numpy as np
+
+from benchmarks.fleet import load_example_tou
+from bin.TariffTable import TariffCache, day_of_week, in_season
+from models import TOUSchedule
+
+def walk_rate(schedule: TOUSchedule, timestamp: int, utc_offset: int = 0) -> float:
+    """Rate at a timestamp found by walking the schedule's nested lists, as a reference."""
+    moment = datetime.datetime.fromtimestamp(timestamp + utc_offset, datetime.timezone.utc)
+    date = moment.date()
+
+    day = day_of_week(date)
+    for holiday in schedule.public_holidays:
+        if (holiday.year, holiday.month, holiday.day) == (date.year, date.month, date.day) and holiday.treat_as:
+            day = holiday.treat_as
+
+    for season in schedule.seasons:
+        if in_season(date.month, date.day, (season.start_date.month, season.start_date.day), (season.end_date.month, season.end_date.day)):
+            break
+    else:
+        return math.nan
+
+    rate = next((base.price for base in schedule.base_prices if base.season == season.name), math.nan)
+    for period in schedule.tou_prices:
+        if period.season != season.name or day not in period.days:
+            continue
+        for hours in period.times:
+            if (hours.start <= moment.hour < hours.end) if hours.end > hours.start else (moment.hour >= hours.start or moment.hour < hours.end):
+                rate = period.price
+    return rate
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--readings", type=int, default=1000000)
+    parser.add_argument("--utc-offset", type=int, default=7200, help="Seconds local time is ahead of UTC.")
+    args = parser.parse_args()
+
+    schedule = load_example_tou()
+
+    rng = np.random.default_rng(0)
+    timestamps = rng.integers(1640995200, 1704067200, args.readings)
+    kwh = rng.uniform(0, 2, args.readings)
+
+    cache = TariffCache(utc_offset=args.utc_offset)
+    start = time.perf_counter()
+    table = cache.get(schedule)
+    table.rates(timestamps[:1])
+    compile_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    costs = cache.get(schedule).price(timestamps, kwh)
+    table_time = time.perf_counter() - start
+
+    sample = min(args.readings, 20000)
+    start = time.perf_counter()
+    walked = [walk_rate(schedule, int(timestamp), args.utc_offset) * value for timestamp, value in zip(timestamps[:sample], kwh[:sample])]
+    walk_time = (time.perf_counter() - start) * args.readings / sample
+    assert np.allclose(costs[:sample], walked, equal_nan=True)
+
+    print(f"{'compile':<12} {compile_time * 1000:>10.2f} ms (first year)")
+    print(f"{'table':<12} {table_time * 1e9 / args.readings:>10.1f} ns/reading")
+    print(f"{'walk':<12} {walk_time * 1e9 / args.readings:>10.1f} ns/reading (from {sample} readings)")
+    print(f"cache {cache.stats()}")
+
+if __name__ == "__main__":
+    main()
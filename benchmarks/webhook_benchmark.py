@@ -0,0 +1,91 @@
+"""
+Measures end-to-end ingress webhook throughput against the number of compression workers.
+
+Requests are posted to /mqtt/v1/ingress in-process through httpx.ASGITransport, so each one pays for broker JWT
+auth, decompression, validation, pricing, dedup and buffering, and the run lasts until the ingress buffer has been
+written to an in-process fake of supabase. Every request is a distinct packet of a synthetic fleet, so none is
+dropped as a retransmission.
+
+auth.py and main.py read configuration.ini on import, so run this from the directory the API runs in:
+    python -m benchmarks.webhook_benchmark --requests 2000 --modules 64 --mode process
+"""
+import argparse, asyncio, math, os, tempfile, time
+
+import httpx
+
+import main
+from benchmarks.fake_emqx import FakeEMQX
+from benchmarks.fake_supabase import FakeSupabase
+from benchmarks.fleet import Fleet
+from benchmarks.fleet_benchmark import install_fakes, percentile
+from bin.CompressionExecutor import CompressionExecutor
+
+async def run_webhooks(fleet: Fleet, packets: list, executor_options: dict, concurrency: int) -> dict:
+    """Post every packet with at most `concurrency` in flight, using a compression executor made from `executor_options`."""
+    emqx = FakeEMQX(port=0).start()
+    directory = tempfile.TemporaryDirectory()
+
+    main.load_config()
+    install_fakes(FakeSupabase(fleet.tables()), emqx, os.path.join(directory.name, "outbox.sqlite3"))
+    main.compression_executor.shutdown()
+    main.compression_executor = CompressionExecutor(**executor_options)
+    await main.startup()
+
+    headers = {"Authorization": "Bearer " + main.encode_broker_jwt({"broker": "benchmark"})}
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = 0
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://api", timeout=None) as client:
+        async def post(unit_id: str, payload: str):
+            nonlocal errors
+            async with semaphore:
+                start = time.perf_counter()
+                response = await client.post("/mqtt/v1/ingress", json={"clientId": unit_id, "topic": "/ingress/" + unit_id, "data": payload}, headers=headers)
+                latencies.append(time.perf_counter() - start)
+                if response.status_code >= 400 or response.json().get("result") != "ok":
+                    errors += 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(post(unit_id, payload) for unit_id, payload in packets))
+        await main.reading_buffer.flush()
+        elapsed = time.perf_counter() - start
+
+    await main.shutdown()
+    emqx.stop()
+    directory.cleanup()
+
+    latencies.sort()
+    return {
+        "requests_per_second": len(packets) / elapsed,
+        "p50_ms": percentile(latencies, 0.5) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "errors": errors,
+    }
+
+def report(name: str, result: dict):
+    print(f"{name:<12} {result['requests_per_second']:>10.1f} req/s  p50 {result['p50_ms']:>8.2f} ms  p99 {result['p99_ms']:>8.2f} ms  {result['errors']} errors")
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--modules", type=int, default=64, help="Readings per packet.")
+    parser.add_argument("--units", type=int, default=100)
+    parser.add_argument("--mode", choices=("process", "thread"), default="process")
+    args = parser.parse_args()
+
+    fleet = Fleet(args.units, args.modules)
+    packets = fleet.ingress_packets(math.ceil(args.requests / args.units))[:args.requests]
+    print(f"Payload: {sum(len(payload) for _, payload in packets) // len(packets)} base64 bytes, {args.modules} readings")
+
+    report("inline", asyncio.run(run_webhooks(fleet, packets, {"mode": "inline"}, args.concurrency)))
+
+    workers = 1
+    while workers <= (os.cpu_count() or 1):
+        result = asyncio.run(run_webhooks(fleet, packets, {"mode": args.mode, "max_workers": workers, "inline_threshold": 0}, args.concurrency))
+        report(args.mode + " x" + str(workers), result)
+        workers *= 2
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,122 @@
+import asyncio, logging, random, time
+from typing import Dict, List, Optional
+
+import httpx
+
+from bin.Metrics import registry
+from models import BrokerPublishMessage
+
+logger = logging.getLogger(__name__)
+
+broker_request_seconds = registry.histogram("broker_request_seconds", "Time of each HTTP request to the broker's publish API, retries counted separately.", ["endpoint"])
+broker_request_errors = registry.counter("broker_request_errors_total", "Broker requests that failed or returned a retryable status.", ["endpoint"])
+
+class BrokerPublisher:
+    """Async, keep-alive, connection pooled client for the EMQX HTTP publish API."""
+
+    # Status codes worth retrying. 4xx codes other than 429 are the caller's fault and are returned as-is.
+    RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+    # EMQX reason code returned for a bulk item that had no subscribers.
+    NO_MATCHING_SUBSCRIBERS = 16
+
+    def __init__(self, url: str, headers: Dict[str, str], pool_size: int = 20, timeout: float = 5.0,
+                 connect_timeout: float = 2.0, retries: int = 3, backoff: float = 0.1, max_backoff: float = 2.0,
+                 bulk_chunk_size: int = 500, bulk_concurrency: int = 4):
+        self.url = url
+        self.bulk_url = url + "/bulk"
+        self.bulk_chunk_size = int(bulk_chunk_size)
+        self.bulk_concurrency = int(bulk_concurrency)
+        self.headers = headers
+        self.pool_size = int(pool_size)
+        self.timeout = httpx.Timeout(float(timeout), connect=float(connect_timeout))
+        self.retries = int(retries)
+        self.backoff = float(backoff)
+        self.max_backoff = float(max_backoff)
+        self.client: Optional[httpx.AsyncClient] = None
+
+    async def start(self):
+        """Open the connection pool. Must be called from within the running event loop."""
+        if self.client is None:
+            self.client = httpx.AsyncClient(
+                headers=self.headers,
+                timeout=self.timeout,
+                limits=httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size),
+            )
+
+    async def stop(self):
+        """Close the connection pool."""
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    def _delay(self, attempt: int) -> float:
+        """Exponential backoff with full jitter."""
+        return random.uniform(0, min(self.max_backoff, self.backoff * (2 ** attempt)))
+
+    async def post(self, url: str, body) -> httpx.Response:
+        """POST a JSON body to the broker, retrying transport errors and retryable status codes with backoff."""
+        await self.start()
+
+        endpoint = "bulk" if url == self.bulk_url else "publish"
+        request_time = broker_request_seconds.labels(endpoint)
+
+        attempt = 0
+        while True:
+            start = time.perf_counter()
+            try:
+                response = await self.client.post(url, json=body)
+                request_time.observe(time.perf_counter() - start)
+                if response.status_code not in self.RETRY_STATUS_CODES:
+                    return response
+                broker_request_errors.labels(endpoint).inc()
+                if attempt >= self.retries:
+                    return response
+                logger.warning("Broker returned %d, retrying (attempt %d).", response.status_code, attempt + 1)
+            except httpx.TransportError as e:
+                request_time.observe(time.perf_counter() - start)
+                broker_request_errors.labels(endpoint).inc()
+                if attempt >= self.retries:
+                    raise
+                logger.warning("Broker request failed: %s, retrying (attempt %d).", e, attempt + 1)
+
+            await asyncio.sleep(self._delay(attempt))
+            attempt += 1
+
+    async def publish(self, message: BrokerPublishMessage) -> httpx.Response:
+        """Publish a single message to the broker."""
+        return await self.post(self.url, message.model_dump())
+
+    async def _publish_chunk(self, chunk: List[BrokerPublishMessage], semaphore: asyncio.Semaphore) -> List[dict]:
+        """Publish one chunk through the bulk API and map the broker's reply to one result per message."""
+        async with semaphore:
+            try:
+                response = await self.post(self.bulk_url, [message.model_dump() for message in chunk])
+            except httpx.HTTPError as e:
+                logger.error("Bulk publish failed: %s", e)
+                return [{"result" : "fail", "message" : "Failed to reach the broker.", "retryable" : True}] * len(chunk)
+
+        if response.status_code not in (200, 202):
+            retryable = response.status_code in self.RETRY_STATUS_CODES
+            return [{"result" : "fail", "message" : "Broker returned " + str(response.status_code) + ".", "retryable" : retryable}] * len(chunk)
+
+        results = []
+        for item in response.json():
+            if "id" in item:
+                results.append({"result" : "ok", "message" : "The message was delivered to at least one subscriber."})
+            elif item.get("reason_code") == self.NO_MATCHING_SUBSCRIBERS:
+                results.append({"result" : "ok", "message" : "No matched subscribers."})
+            else:
+                results.append({"result" : "fail", "message" : str(item.get("message", "Failed to deliver the message."))})
+        return results
+
+    async def publish_bulk(self, messages: List[BrokerPublishMessage]) -> List[dict]:
+        """Publish many messages through the EMQX bulk API in chunks, with a bounded number of chunks in flight.
+
+        Returns one result per message, in the order the messages were given. Results of chunks that failed because
+        the broker was unreachable or overloaded are marked `retryable`.
+        """
+        semaphore = asyncio.Semaphore(self.bulk_concurrency)
+        chunks = [messages[i:i + self.bulk_chunk_size] for i in range(0, len(messages), self.bulk_chunk_size)]
+        chunk_results = await asyncio.gather(*(self._publish_chunk(chunk, semaphore) for chunk in chunks))
+        return [result for results in chunk_results for result in results]
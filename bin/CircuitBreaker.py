@@ -0,0 +1,57 @@
+import time
+
+class CircuitBreaker:
+    """Stops calls to a failing dependency for a while instead of piling retries onto it.
+
+    After `threshold` consecutive failures the breaker opens for `cooldown` seconds. Once that has passed it is
+    half-open: one trial call is let through, which closes the breaker on success or reopens it for twice as long,
+    up to `max_cooldown`, on failure.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, threshold: int = 5, cooldown: float = 5.0, max_cooldown: float = 60.0):
+        self.threshold = int(threshold)
+        self.base_cooldown = float(cooldown)
+        self.max_cooldown = float(max_cooldown)
+        self.cooldown = self.base_cooldown
+        self.failures = 0
+        self.opened_at = 0.0
+        self.opened = False
+        self.trips = 0
+
+    @property
+    def state(self) -> str:
+        if not self.opened:
+            return self.CLOSED
+        return self.HALF_OPEN if self.retry_in() == 0 else self.OPEN
+
+    def retry_in(self) -> float:
+        """Seconds until calls may be tried again, 0 if they may be tried now."""
+        if not self.opened:
+            return 0.0
+        return max(0.0, self.opened_at + self.cooldown - time.monotonic())
+
+    def success(self):
+        self.failures = 0
+        self.opened = False
+        self.cooldown = self.base_cooldown
+
+    def failure(self):
+        self.failures += 1
+        if self.opened:
+            # The trial call failed, stay open for longer.
+            self.cooldown = min(self.max_cooldown, self.cooldown * 2)
+            self.opened_at = time.monotonic()
+        elif self.failures >= self.threshold:
+            self.opened = True
+            self.opened_at = time.monotonic()
+            self.trips += 1
+
+    def stats(self) -> dict:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.failures,
+            "trips": self.trips,
+        }
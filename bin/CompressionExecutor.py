@@ -0,0 +1,107 @@
+import asyncio, base64, codecs, concurrent.futures, os, time
+from typing import Iterator
+
+import brotli
+
+from bin.CompressionProfiles import CompressionProfile, get_dictionary
+
+# Module level functions so they can be pickled into worker processes.
+
+def brotli_compress_b64(data: bytes, quality: int = 11, lgwin: int = 22, dictionary_id: int = 0) -> str:
+    """Compress bytes with brotli, optionally after applying a shared dictionary, and return them as a base64 string."""
+    if dictionary_id:
+        data = get_dictionary(dictionary_id).encode(data)
+    return base64.b64encode(brotli.compress(data, quality=quality, lgwin=lgwin)).decode('utf-8')
+
+def brotli_decompress_b64(message: str, dictionary_id: int = 0) -> str:
+    """Decode a base64 string, decompress it with brotli, reverse the shared dictionary if any, and return the utf-8 text."""
+    data = brotli.decompress(base64.b64decode(message))
+    if dictionary_id:
+        data = get_dictionary(dictionary_id).decode(data)
+    return data.decode('utf-8')
+
+def brotli_decompress_b64_timed(message: str, dictionary_id: int = 0) -> tuple[str, int, int, float, float]:
+    """brotli_decompress_b64 that also measures its work, for the pipeline metrics.
+
+    Returns the text, the compressed and decompressed sizes in bytes, and the seconds spent decoding the base64 and decompressing.
+    """
+    start = time.perf_counter()
+    compressed = base64.b64decode(message)
+    decoded = time.perf_counter()
+    data = brotli.decompress(compressed)
+    if dictionary_id:
+        data = get_dictionary(dictionary_id).decode(data)
+    text = data.decode('utf-8')
+    return text, len(compressed), len(data), decoded - start, time.perf_counter() - decoded
+
+def brotli_decompress_b64_chunks(message: str, dictionary_id: int = 0, chunk_size: int = 65536) -> Iterator[str]:
+    """Streaming form of brotli_decompress_b64, yielding the utf-8 text in pieces of at most about `chunk_size` bytes.
+
+    Only one chunk of the base64 input and of the decompressed output is held at a time.
+    """
+    dictionary = get_dictionary(dictionary_id) if dictionary_id else None
+    decompressor = brotli.Decompressor()
+    text = codecs.getincrementaldecoder('utf-8')()
+    step = chunk_size - chunk_size % 4 # Whole base64 quanta, so every slice decodes on its own.
+
+    def drain(data: bytes) -> Iterator[str]:
+        while True:
+            output = decompressor.process(data, output_buffer_limit=chunk_size)
+            data = b""
+            if output:
+                yield text.decode(dictionary.decode(output) if dictionary else output)
+            # Output held back by the limit is released by further calls, even when no input is left.
+            if not output or (decompressor.can_accept_more_data() and len(output) < chunk_size):
+                return
+
+    for start in range(0, len(message), step):
+        yield from drain(base64.b64decode(message[start:start + step]))
+    yield from drain(b"")
+
+    if not decompressor.is_finished():
+        raise brotli.error("Truncated brotli stream.")
+    text.decode(b"", final=True)
+
+class CompressionExecutor:
+    """Runs brotli compression and decompression off the event loop.
+
+    Modes:
+        - "process" - A process pool. Sidesteps the GIL for the base64 and utf-8 work around brotli.
+        - "thread" - A thread pool. Relies on brotli releasing the GIL while it (de)compresses.
+        - "inline" - Runs everything on the event loop, as before.
+
+    Payloads smaller than `inline_threshold` bytes are always handled inline, since handing them to a worker costs more than the work.
+    """
+    def __init__(self, mode: str = "process", max_workers: int = 0, inline_threshold: int = 4096):
+        self.mode = mode
+        self.max_workers = int(max_workers) or os.cpu_count() or 1
+        self.inline_threshold = int(inline_threshold)
+
+        if mode == "process":
+            self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.max_workers)
+        elif mode == "thread":
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="brotli")
+        elif mode == "inline":
+            self.executor = None
+        else:
+            raise ValueError("Unknown compression executor mode: " + mode)
+
+    async def run(self, size: int, function, *args):
+        """Run `function(*args)` inline or on the pool, depending on the payload size."""
+        if self.executor is None or size < self.inline_threshold:
+            return function(*args)
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    async def compress(self, data: bytes, profile: CompressionProfile) -> str:
+        return await self.run(len(data), brotli_compress_b64, data, profile.quality, profile.lgwin, profile.dictionary_id)
+
+    async def decompress(self, message: str, dictionary_id: int = 0) -> str:
+        return await self.run(len(message), brotli_decompress_b64, message, dictionary_id)
+
+    async def decompress_timed(self, message: str, dictionary_id: int = 0) -> tuple[str, int, int, float, float]:
+        """decompress that also returns the sizes and stage timings of brotli_decompress_b64_timed."""
+        return await self.run(len(message), brotli_decompress_b64_timed, message, dictionary_id)
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
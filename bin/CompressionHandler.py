@@ -2,6 +2,10 @@ import concurrent.futures
 import logging, base64, brotli, json
 from typing import List, Any
 
+from bin.LogConfig import payload_log
+
+logger = logging.getLogger(__name__)
+
 class CompressionHandler:
     def __init__(self, compression_callback, decompression_callback, max_threads: int = 5):
         self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=int(max_threads)) # Thread Pool for MQTT Compression/Decompression
@@ -32,9 +36,9 @@ class CompressionHandler:
 
         try:
             retval['msg'] = base64.b64encode(brotli.compress(message.encode('utf-8'))).decode('utf-8')
-            logging.info("Message Compressed:\nTopic: " + topic + "\nMessage: " + message)
+            payload_log.log("Message compressed for %s: %s", topic, payload=message)
         except Exception as e:
-            logging.error("Compression error: " + str(e))
+            logger.error("Compression error: %s", e)
             return [str(), str()]
         
         return [client_id, topic, json.dumps(retval)]
@@ -44,13 +48,13 @@ class CompressionHandler:
     def brotli_decompress(self, client_id: str, topic: str, message: str) -> List[str, Any]:
         msg_object = json.loads(message)
         if(msg_object['enc'] != "br"):
-            logging.error("Invalid encoding format.")
+            logger.error("Invalid encoding format.")
             return [topic, json.loads(str())]
         
         try:
             data = brotli.decompress(base64.b64decode(msg_object["msg"])).decode('utf-8')
-            logging.info("Message Decompressed:\nMessage: " + data + "\nRatio: " + str(len(message) * 100 / len(data)) + "%.")
+            payload_log.log("Message decompressed from %s, %d%% of its size: %s", topic, len(message) * 100 // max(len(data), 1), payload=data)
             return [topic, json.loads(data)]
         except Exception as e:
-            print("Decompression Error:", str(e))
+            logger.error("Decompression error: %s", e)
             return [client_id, topic, json.loads(str())]
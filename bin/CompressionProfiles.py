@@ -0,0 +1,79 @@
+import json, os
+from typing import Dict, List
+
+DICTIONARY_DIR = os.path.join(os.path.dirname(__file__), "dictionaries")
+
+# Control characters never appear unescaped in JSON text, so they are free to stand in for dictionary tokens.
+# Tab, line feed and carriage return are left out because they are valid whitespace between JSON tokens.
+TOKEN_CODES = [bytes([code]) for code in range(1, 32) if code not in (9, 10, 13)]
+
+class SchemaDictionary:
+    """Shared dictionary of strings that recur in SDR message JSON, such as the schema's keys.
+
+    The Python brotli binding cannot load custom LZ77 dictionaries, so the dictionary is applied as a
+    substitution pass before brotli: each token is swapped for a single control character. Both sides must
+    agree on the dictionary, so its id travels in the `MQTTDataPacket.d` field of the envelope.
+    """
+    def __init__(self, id: int, tokens: List[str]):
+        if len(tokens) > len(TOKEN_CODES):
+            raise ValueError(f"Dictionary {id} has {len(tokens)} tokens, at most {len(TOKEN_CODES)} are supported.")
+        self.id = id
+        self.tokens = [token.encode('utf-8') for token in tokens]
+        # Replace longer tokens first so that tokens which contain other tokens still match.
+        self.encode_order = sorted(zip(self.tokens, TOKEN_CODES), key=lambda pair: len(pair[0]), reverse=True)
+
+    def encode(self, data: bytes) -> bytes:
+        for token, code in self.encode_order:
+            data = data.replace(token, code)
+        return data
+
+    def decode(self, data: bytes) -> bytes:
+        for token, code in zip(self.tokens, TOKEN_CODES):
+            data = data.replace(code, token)
+        return data
+
+def load_dictionaries(path: str = DICTIONARY_DIR) -> Dict[int, SchemaDictionary]:
+    dictionaries = {}
+    for file_name in sorted(os.listdir(path)) if os.path.isdir(path) else []:
+        if file_name.endswith(".json"):
+            with open(os.path.join(path, file_name)) as file:
+                definition = json.load(file)
+            dictionaries[definition["id"]] = SchemaDictionary(definition["id"], definition["tokens"])
+    return dictionaries
+
+DICTIONARIES = load_dictionaries()
+
+def get_dictionary(id: int) -> SchemaDictionary:
+    if id not in DICTIONARIES:
+        raise ValueError(f"Unknown compression dictionary: {id}")
+    return DICTIONARIES[id]
+
+class CompressionProfile:
+    """Brotli settings used to compress a message.
+
+    `dictionary_id` of 0 disables the shared dictionary and keeps the plain base64 wire format.
+    """
+    def __init__(self, name: str, quality: int = 11, lgwin: int = 22, dictionary_id: int = 0):
+        self.name = name
+        self.quality = int(quality)
+        self.lgwin = int(lgwin)
+        self.dictionary_id = int(dictionary_id)
+
+PROFILES: Dict[str, CompressionProfile] = {
+    profile.name: profile for profile in (
+        CompressionProfile("default", quality=11, lgwin=22),
+        CompressionProfile("fast", quality=5, lgwin=18),
+        CompressionProfile("dictionary", quality=11, lgwin=22, dictionary_id=1),
+        CompressionProfile("fast_dictionary", quality=5, lgwin=18, dictionary_id=1),
+    )
+}
+
+# EgressMessage.type -> configuration name used to pick its profile.
+EGRESS_TYPE_NAMES = {
+    0: "rules",
+    1: "schedule",
+    2: "parameters",
+    3: "tou",
+    4: "tags",
+    5: "batch",
+}
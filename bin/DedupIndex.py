@@ -0,0 +1,115 @@
+import hashlib, time
+from collections import deque
+from typing import Hashable, List
+
+from bin.ReadingBatch import ReadingBatch
+
+GENERATIONS = 4
+
+class DedupIndex:
+    """Time-bounded memory of the packets and readings recently queued, to drop units' retransmissions.
+
+    Packets are known by a digest of their unit and payload, so a resent packet is dropped before it is decompressed.
+    Readings are known by (unit, module_id, period_start, period_end) and state changes by (unit, module_id, state,
+    timestamp), which also catches rows resent in a different packet. Keys are remembered for `ttl` seconds, up to
+    `ttl` plus a generation more, in GENERATIONS sets that expire whole. At most `max_entries` keys are kept, older
+    generations being dropped early to stay under it. Row keys are 64-bit hashes, so a collision could drop a row,
+    with odds far below those of a lost packet.
+    """
+    def __init__(self, ttl: float = 900.0, max_entries: int = 500000):
+        self.ttl = float(ttl)
+        self.max_entries = int(max_entries)
+        self.generations: deque = deque([(time.monotonic(), set())])
+
+        self.packets_dropped = 0
+        self.readings_dropped = 0
+        self.state_changes_dropped = 0
+        self.evicted = 0
+
+    def __len__(self) -> int:
+        return sum(len(keys) for _, keys in self.generations)
+
+    @staticmethod
+    def packet_key(client_id: str, data: str) -> bytes:
+        digest = hashlib.blake2b(client_id.encode('utf-8'), digest_size=16)
+        digest.update(b"\0")
+        digest.update(data.encode('utf-8'))
+        return digest.digest()
+
+    def _current(self) -> set:
+        """The generation new keys go into, after expiring and evicting old generations."""
+        now = time.monotonic()
+        while self.generations and self.generations[0][0] + self.ttl + self.ttl / GENERATIONS <= now:
+            self.generations.popleft()
+
+        created, keys = self.generations[-1] if self.generations else (now, None)
+        if keys is None or now - created >= self.ttl / GENERATIONS or len(keys) >= self.max_entries // GENERATIONS:
+            keys = set()
+            self.generations.append((now, keys))
+            while len(self.generations) > 1 and len(self) > self.max_entries:
+                self.evicted += len(self.generations.popleft()[1])
+        return keys
+
+    def seen(self, key: Hashable) -> bool:
+        return any(key in keys for _, keys in self.generations)
+
+    def claim(self, key: Hashable) -> bool:
+        """Remember a packet key. False if it is already known, and the packet a duplicate."""
+        current = self._current()
+        if self.seen(key):
+            self.packets_dropped += 1
+            return False
+        current.add(key)
+        return True
+
+    def release(self, key: Hashable):
+        """Forget a claimed packet that failed, so its retransmission is processed."""
+        for _, keys in self.generations:
+            keys.discard(key)
+
+    def reading_keys(self, client_id: str, batch: ReadingBatch) -> List[int]:
+        return [hash((client_id, module_id, period_start, period_end)) for module_id, period_start, period_end in zip(batch.module_id, batch.period_start, batch.period_end)]
+
+    def state_keys(self, client_id: str, batch: ReadingBatch) -> List[int]:
+        # The trailing None keeps state change keys apart from reading keys.
+        return [hash((client_id, module_id, state, timestamp, None)) for module_id, state, timestamp in zip(batch.state_module, batch.state, batch.state_timestamp)]
+
+    def _fresh(self, keys: List[int]) -> List[int]:
+        """Indices of the keys not seen before, which are remembered from now on."""
+        current = self._current()
+        fresh = []
+        for index, key in enumerate(keys):
+            if not self.seen(key):
+                current.add(key)
+                fresh.append(index)
+        return fresh
+
+    def admit(self, client_id: str, batch: ReadingBatch) -> ReadingBatch:
+        """Remember the readings and state changes of a unit and return the ones not seen before.
+
+        Returns the batch itself when nothing in it was seen, which is the common case.
+        """
+        fresh = self._fresh(self.reading_keys(client_id, batch))
+        states = self._fresh(self.state_keys(client_id, batch))
+        if len(fresh) == len(batch) and len(states) == batch.state_change_count:
+            return batch
+
+        self.readings_dropped += len(batch) - len(fresh)
+        self.state_changes_dropped += batch.state_change_count - len(states)
+        return batch.take(fresh, states)
+
+    def forget(self, client_id: str, batch: ReadingBatch):
+        """Forget admitted readings and state changes that could not be queued, so their retransmission is processed."""
+        for key in self.reading_keys(client_id, batch) + self.state_keys(client_id, batch):
+            self.release(key)
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self),
+            "max_entries": self.max_entries,
+            "generations": len(self.generations),
+            "packets_dropped": self.packets_dropped,
+            "readings_dropped": self.readings_dropped,
+            "state_changes_dropped": self.state_changes_dropped,
+            "evicted": self.evicted,
+        }
@@ -0,0 +1,213 @@
+import asyncio, concurrent.futures, logging, random, sqlite3, time
+from typing import Awaitable, Callable, List, Optional
+
+from bin.CircuitBreaker import CircuitBreaker
+from models import BrokerPublishMessage
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    topic TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    qos INTEGER NOT NULL,
+    retain INTEGER NOT NULL,
+    created REAL NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL NOT NULL,
+    lease_until REAL NOT NULL DEFAULT 0,
+    dead INTEGER NOT NULL DEFAULT 0,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS outbox_topic ON outbox (topic, id) WHERE dead = 0;
+CREATE INDEX IF NOT EXISTS outbox_due ON outbox (next_attempt) WHERE dead = 0;
+"""
+
+# Claims the oldest due message of each topic that is not leased by another dispatcher. Later messages of a topic
+# wait for the earlier ones, so a unit receives its messages in order.
+CLAIM = """
+UPDATE outbox SET lease_until = :lease_until
+WHERE id IN (
+    SELECT id FROM outbox AS message
+    WHERE dead = 0 AND next_attempt <= :now AND lease_until <= :now
+    AND NOT EXISTS (SELECT 1 FROM outbox AS earlier WHERE earlier.topic = message.topic AND earlier.dead = 0 AND earlier.id < message.id)
+    ORDER BY id LIMIT :limit
+)
+RETURNING id, topic, payload, qos, retain, attempts
+"""
+
+class EgressOutbox:
+    """Durable queue of broker messages in a local SQLite database, drained by a background dispatcher.
+
+    `put` commits messages to disk and returns, so callers do not wait on the broker. The dispatcher claims due
+    messages with a lease, which lets several API processes share one outbox file, and publishes them in chunks
+    with at most `concurrency` chunks in flight. Delivered messages are deleted.
+
+    When the broker is unreachable or overloaded the messages are retried with exponential backoff and the
+    circuit breaker stops the dispatcher from hammering it; these failures never expire a message. Messages the
+    broker rejects are retried `max_attempts` times and then kept as dead letters.
+    """
+    def __init__(self, path: str, publish_bulk: Callable[[List[BrokerPublishMessage]], Awaitable[List[dict]]],
+                 breaker: CircuitBreaker, chunk_size: int = 500, concurrency: int = 4, backoff: float = 1.0,
+                 max_backoff: float = 60.0, max_attempts: int = 20, lease: float = 60.0, synchronous: str = "normal"):
+        self.path = path
+        self.publish_bulk = publish_bulk
+        self.breaker = breaker
+        self.chunk_size = int(chunk_size)
+        self.concurrency = int(concurrency)
+        self.backoff = float(backoff)
+        self.max_backoff = float(max_backoff)
+        self.max_attempts = int(max_attempts)
+        self.lease = float(lease)
+
+        # One thread owns the connection, which keeps the blocking SQLite calls off the event loop and in order.
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="outbox")
+        self.connection = self.executor.submit(self._connect, synchronous).result()
+
+        self.wakeup: Optional[asyncio.Event] = None
+        self.task: Optional[asyncio.Task] = None
+        self.running = False
+
+        self.queued = 0
+        self.delivered = 0
+        self.retries = 0
+        self.dead_letters = 0
+
+    def _connect(self, synchronous: str) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=" + {"full": "FULL", "normal": "NORMAL"}[synchronous.lower()])
+        connection.execute("PRAGMA busy_timeout=5000")
+        connection.executescript(SCHEMA)
+        return connection
+
+    async def _call(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    def _insert(self, messages: List[BrokerPublishMessage]):
+        now = time.time()
+        with self.connection:
+            self.connection.executemany(
+                "INSERT INTO outbox (topic, payload, qos, retain, created, next_attempt) VALUES (?, ?, ?, ?, ?, ?)",
+                [(message.topic, message.payload, message.qos, int(message.retain), now, now) for message in messages]
+            )
+
+    def _claim(self, limit: int) -> list:
+        now = time.time()
+        with self.connection:
+            return self.connection.execute(CLAIM, {"now": now, "lease_until": now + self.lease, "limit": limit}).fetchall()
+
+    def _complete(self, delivered: List[int], retry: List[tuple], dead: List[tuple]):
+        with self.connection:
+            self.connection.executemany("DELETE FROM outbox WHERE id = ?", [(id,) for id in delivered])
+            self.connection.executemany("UPDATE outbox SET attempts = ?, next_attempt = ?, lease_until = 0, error = ? WHERE id = ?", retry)
+            self.connection.executemany("UPDATE outbox SET dead = 1, lease_until = 0, error = ? WHERE id = ?", dead)
+
+    def _next_due(self) -> Optional[float]:
+        return self.connection.execute("SELECT MIN(MAX(next_attempt, lease_until)) FROM outbox WHERE dead = 0").fetchone()[0]
+
+    def _counts(self) -> tuple:
+        return self.connection.execute("SELECT COUNT(*) - SUM(dead), SUM(dead) FROM outbox").fetchone()
+
+    async def put(self, messages: List[BrokerPublishMessage]):
+        """Store messages for delivery. Returns once they are committed."""
+        await self._call(self._insert, messages)
+        self.queued += len(messages)
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    def _delay(self, attempt: int) -> float:
+        """Exponential backoff with full jitter."""
+        return random.uniform(0, min(self.max_backoff, self.backoff * (2 ** attempt)))
+
+    async def _send(self, rows: list, semaphore: asyncio.Semaphore) -> tuple:
+        async with semaphore:
+            results = await self.publish_bulk([
+                BrokerPublishMessage(payload_encoding="plain", topic=topic, payload=payload, qos=qos, retain=bool(retain))
+                for _, topic, payload, qos, retain, _ in rows
+            ])
+        return rows, results
+
+    async def dispatch(self) -> int:
+        """Claim due messages and publish them once. Returns the number of messages claimed."""
+        # A half-open breaker lets a single message through to probe the broker.
+        limit = 1 if self.breaker.state == CircuitBreaker.HALF_OPEN else self.chunk_size * self.concurrency
+        rows = await self._call(self._claim, limit)
+        if not rows:
+            return 0
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+        sent = await asyncio.gather(*(self._send(rows[i:i + self.chunk_size], semaphore) for i in range(0, len(rows), self.chunk_size)))
+
+        now = time.time()
+        delivered, retry, dead = [], [], []
+        for chunk, results in sent:
+            if all(result.get("retryable") for result in results):
+                self.breaker.failure()
+            else:
+                self.breaker.success()
+            for (id, topic, _, _, _, attempts), result in zip(chunk, results):
+                if result["result"] == "ok":
+                    delivered.append(id)
+                elif result.get("retryable"):
+                    # The broker is down or overloaded, which is no fault of the message: retry without counting it.
+                    retry.append((attempts, now + max(self._delay(attempts), self.breaker.retry_in()), result["message"], id))
+                elif attempts + 1 >= self.max_attempts:
+                    logger.error("Giving up on message %d to %s after %d attempts: %s", id, topic, attempts + 1, result["message"])
+                    dead.append((result["message"], id))
+                else:
+                    retry.append((attempts + 1, now + self._delay(attempts + 1), result["message"], id))
+
+        await self._call(self._complete, delivered, retry, dead)
+        self.delivered += len(delivered)
+        self.retries += len(retry)
+        self.dead_letters += len(dead)
+        return len(rows)
+
+    async def _run(self):
+        while self.running:
+            try:
+                delay = self.breaker.retry_in()
+                if delay == 0 and await self.dispatch():
+                    continue
+                if delay == 0:
+                    next_due = await self._call(self._next_due)
+                    delay = self.max_backoff if next_due is None else max(0.0, next_due - time.time())
+            except Exception as e:
+                logger.error("Egress outbox dispatch failed: %s", e)
+                delay = self.backoff
+
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def start(self):
+        if self.running:
+            return
+        self.wakeup = asyncio.Event()
+        self.running = True
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop dispatching. Undelivered messages stay on disk for the next start."""
+        self.running = False
+        if self.task is not None:
+            self.wakeup.set()
+            await self.task
+            self.task = None
+        await self._call(self.connection.close)
+        self.executor.shutdown(wait=True)
+
+    async def stats(self) -> dict:
+        pending, dead = await self._call(self._counts)
+        return {
+            "pending": pending or 0,
+            "dead_letters": dead or 0,
+            "queued": self.queued,
+            "delivered": self.delivered,
+            "retries": self.retries,
+            "circuit_breaker": self.breaker.stats(),
+        }
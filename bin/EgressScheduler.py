@@ -0,0 +1,176 @@
+import asyncio, logging, time
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from models import EgressBatchMessage, EgressMessage
+
+logger = logging.getLogger(__name__)
+
+APPEND = 0
+REPLACE = 1
+
+# EgressMessage.type of a batch envelope.
+BATCH_TYPE = 5
+
+# Result of a message dropped for a later one, which the unit never receives.
+SUPERSEDED = {"result" : "superseded", "message" : "Replaced by a later message before it was sent."}
+
+def supersedes(later: EgressMessage, earlier: EgressMessage) -> bool:
+    """Whether the unit state after `later` no longer depends on `earlier`, so `earlier` need not be sent."""
+    if later.type != earlier.type:
+        return False
+    data, earlier_data = later.data, earlier.data
+
+    if later.type == 0:
+        # A full rules replace covers the unit and the modules it lists. Exec actions run something and are never dropped.
+        if data.unit_rules.action != REPLACE or any(module.action != REPLACE for module in data.module_rules):
+            return False
+        if earlier_data.unit_rules.action > REPLACE or any(module.action > REPLACE for module in earlier_data.module_rules):
+            return False
+        return {module.module_id for module in earlier_data.module_rules} <= {module.module_id for module in data.module_rules}
+    if later.type == 2:
+        # Parameters are complete, but a format or reset must still reach the unit.
+        return (data.format_device or not earlier_data.format_device) and (data.reset_device or not earlier_data.reset_device)
+    if later.type == 3:
+        return True
+    if later.type in (1, 4):
+        return data.action == REPLACE
+    return False
+
+class PendingEgress:
+    """Messages held for one topic, and the futures of the callers waiting on each."""
+
+    def __init__(self, deadline: float):
+        self.deadline = deadline
+        self.messages: List[EgressMessage] = []
+        self.futures: List[asyncio.Future] = []
+
+class EgressScheduler:
+    """Holds egress messages per topic for `window` seconds and publishes them together.
+
+    Within the window a message that supersedes an earlier one of the same type (see `supersedes`) replaces it,
+    and the remaining messages of a topic go out as one batch envelope (EgressMessage type 5) when `batch` is set,
+    or one by one otherwise. All topics that are due at once are handed to `publish` in a single call, so the
+    broker's bulk API can carry them. Callers of `submit` get the result of the publish that carried their message,
+    or SUPERSEDED at once when a later message replaced theirs, so they do not record state the unit never got.
+    """
+    def __init__(self, publish: Callable[[List[Tuple[str, EgressMessage]]], Awaitable[List[dict]]], window: float = 0.2,
+                 max_messages: int = 16, batch: bool = True):
+        self.publish = publish
+        self.window = float(window)
+        self.max_messages = int(max_messages)
+        self.batch = batch
+
+        self.pending: Dict[str, PendingEgress] = {}
+        self.wakeup: Optional[asyncio.Event] = None
+        self.task: Optional[asyncio.Task] = None
+        self.publishes: set = set()
+        self.running = False
+
+        self.messages_submitted = 0
+        self.messages_superseded = 0
+        self.messages_batched = 0
+        self.messages_published = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.window > 0
+
+    async def submit(self, topic: str, message: EgressMessage) -> dict:
+        """Queue a message for a topic and wait for the result of its publish."""
+        self.messages_submitted += 1
+        future = asyncio.get_running_loop().create_future()
+
+        pending = self.pending.get(topic)
+        if pending is None:
+            pending = self.pending[topic] = PendingEgress(time.monotonic() + self.window)
+            if self.wakeup is not None:
+                self.wakeup.set()
+
+        for index in range(len(pending.messages) - 1, -1, -1):
+            if supersedes(message, pending.messages[index]):
+                del pending.messages[index]
+                pending.futures.pop(index).set_result(SUPERSEDED)
+                self.messages_superseded += 1
+        pending.messages.append(message)
+        pending.futures.append(future)
+
+        if not self.running or len(pending.messages) >= self.max_messages:
+            self.dispatch([topic])
+
+        return await future
+
+    def envelopes(self, topic: str, pending: PendingEgress) -> List[Tuple[str, EgressMessage, List[asyncio.Future]]]:
+        if len(pending.messages) == 1 or not self.batch:
+            return [(topic, message, [future]) for message, future in zip(pending.messages, pending.futures)]
+        self.messages_batched += len(pending.messages)
+        envelope = EgressMessage(type=BATCH_TYPE, data=EgressBatchMessage(messages=pending.messages))
+        return [(topic, envelope, pending.futures)]
+
+    def dispatch(self, topics: List[str]):
+        """Publish the messages held for the given topics in one call of `publish`."""
+        envelopes = []
+        for topic in topics:
+            envelopes.extend(self.envelopes(topic, self.pending.pop(topic)))
+        if envelopes:
+            task = asyncio.create_task(self._publish(envelopes))
+            self.publishes.add(task)
+            task.add_done_callback(self.publishes.discard)
+
+    async def _publish(self, envelopes: List[Tuple[str, EgressMessage, List[asyncio.Future]]]):
+        self.messages_published += len(envelopes)
+        try:
+            results = await self.publish([(topic, message) for topic, message, _ in envelopes])
+        except Exception as e:
+            logger.error("Egress publish failed: %s", e)
+            results = [e] * len(envelopes)
+
+        for (_, _, futures), result in zip(envelopes, results):
+            for future in futures:
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+    async def _run(self):
+        while self.running:
+            if not self.pending:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+
+            # Topics are kept in order of arrival, so the first one is due first.
+            delay = next(iter(self.pending.values())).deadline - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            now = time.monotonic()
+            self.dispatch([topic for topic, pending in self.pending.items() if pending.deadline <= now])
+
+    async def start(self):
+        if not self.enabled or self.running:
+            return
+        self.wakeup = asyncio.Event()
+        self.running = True
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Publish everything still held and wait for publishes in flight."""
+        self.running = False
+        if self.task is not None:
+            self.wakeup.set()
+            await self.task
+            self.task = None
+        self.dispatch(list(self.pending))
+        if self.publishes:
+            await asyncio.gather(*self.publishes, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            "pending_topics": len(self.pending),
+            "messages_submitted": self.messages_submitted,
+            "messages_superseded": self.messages_superseded,
+            "messages_batched": self.messages_batched,
+            "messages_published": self.messages_published,
+            "messages_saved": self.messages_submitted - self.messages_published - sum(len(pending.messages) for pending in self.pending.values()),
+        }
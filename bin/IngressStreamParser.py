@@ -0,0 +1,148 @@
+import json
+from typing import List, Optional
+
+from models import ReadingDataItem
+
+WHITESPACE = " \t\n\r"
+
+class IngressStreamParser:
+    """Incremental parser of IngressMessage JSON for reading packets too large to hold as one object tree.
+
+    Text is fed in chunks as it is decompressed. The envelope fields (`type`, `data.period_start`,
+    `data.period_end`) are kept as attributes and every element of `data.readings` is returned as a
+    ReadingDataItem as soon as it is complete, so only the unparsed tail of the text is buffered: at most
+    one reading plus one chunk. Any other members are parsed and skipped.
+    """
+    def __init__(self):
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.position = 0
+        self.closing = False
+
+        # Containers entered so far, "root", "data" and "readings", and what is expected next inside the innermost.
+        self.stack: List[str] = []
+        self.state = "start"
+        self.key: Optional[str] = None
+
+        self.type: Optional[int] = None
+        self.period_start: Optional[int] = None
+        self.period_end: Optional[int] = None
+        self.reading_count = 0
+
+    @property
+    def finished(self) -> bool:
+        return self.state == "end"
+
+    def feed(self, text: str) -> List[ReadingDataItem]:
+        """Parse another chunk of text and return the readings it completed."""
+        self.buffer = self.buffer[self.position:] + text
+        self.position = 0
+        return self.parse()
+
+    def close(self) -> List[ReadingDataItem]:
+        """Parse whatever is left at the end of the document. Raises ValueError if it is incomplete."""
+        self.closing = True
+        readings = self.parse()
+        if not self.finished:
+            raise ValueError("Incomplete ingress message.")
+        return readings
+
+    def skip_whitespace(self) -> bool:
+        """Move to the next token. Returns False if the buffer ran out first."""
+        buffer, position = self.buffer, self.position
+        while position < len(buffer) and buffer[position] in WHITESPACE:
+            position += 1
+        self.position = position
+        return position < len(buffer)
+
+    def decode_value(self):
+        """Decode the value at the current position. Raises IndexError if it may continue in the next chunk."""
+        try:
+            value, end = self.decoder.raw_decode(self.buffer, self.position)
+        except json.JSONDecodeError:
+            if self.closing:
+                raise
+            raise IndexError
+        # A number that ends with the buffer might carry on in the next chunk.
+        if end == len(self.buffer) and not self.closing:
+            raise IndexError
+        self.position = end
+        return value
+
+    def expect(self, characters: str) -> str:
+        character = self.buffer[self.position]
+        if character not in characters:
+            raise ValueError(f"Unexpected {character!r} at {self.position} in ingress message, expected one of {characters!r}.")
+        self.position += 1
+        return character
+
+    def close_container(self):
+        self.stack.pop()
+        self.state = "next" if self.stack else "end"
+        if self.stack and self.stack[-1] == "readings":
+            self.state = "next_item"
+
+    def parse(self) -> List[ReadingDataItem]:
+        readings = []
+        try:
+            while self.skip_whitespace():
+                state = self.state
+                if state == "start":
+                    self.expect("{")
+                    self.stack.append("root")
+                    self.state = "key"
+                elif state == "key":
+                    if self.expect('"}') == "}":
+                        self.close_container()
+                    else:
+                        self.position -= 1
+                        self.key = self.decode_value()
+                        self.state = "colon"
+                elif state == "colon":
+                    self.expect(":")
+                    self.state = "value"
+                elif state == "value":
+                    self.parse_member()
+                elif state == "next":
+                    if self.expect(",}") == "}":
+                        self.close_container()
+                    else:
+                        self.state = "key"
+                elif state == "item":
+                    if self.buffer[self.position] == "]":
+                        self.position += 1
+                        self.close_container()
+                    else:
+                        readings.append(ReadingDataItem.model_validate(self.decode_value()))
+                        self.reading_count += 1
+                        self.state = "next_item"
+                elif state == "next_item":
+                    if self.expect(",]") == "]":
+                        self.close_container()
+                    else:
+                        self.state = "item"
+                else:
+                    raise ValueError(f"Unexpected data after the end of the ingress message at {self.position}.")
+        except IndexError:
+            pass # The token continues in the next chunk.
+        return readings
+
+    def parse_member(self):
+        container, key, character = self.stack[-1], self.key, self.buffer[self.position]
+        if container == "root" and key == "data" and character == "{":
+            self.position += 1
+            self.stack.append("data")
+            self.state = "key"
+        elif container == "data" and key == "readings" and character == "[":
+            self.position += 1
+            self.stack.append("readings")
+            self.state = "item"
+        else:
+            value = self.decode_value()
+            if container == "root" and key == "type":
+                self.type = value
+            elif container == "data" and key == "period_start":
+                self.period_start = value
+            elif container == "data" and key == "period_end":
+                self.period_end = value
+            self.state = "next"
@@ -0,0 +1,96 @@
+import atexit, configparser, logging, logging.handlers, queue, random, sys
+from typing import Dict, Optional
+
+DEFAULT_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler for a bounded queue that drops records instead of blocking the caller when the queue is full."""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class Truncated:
+    """Log argument that is cut to `max_chars` only if the record is actually formatted."""
+    __slots__ = ("value", "max_chars")
+
+    def __init__(self, value, max_chars: int):
+        self.value = value
+        self.max_chars = max_chars
+
+    def __str__(self) -> str:
+        text = str(self.value)
+        if len(text) <= self.max_chars:
+            return text
+        return text[:self.max_chars] + f"... ({len(text)} chars)"
+
+class PayloadLog:
+    """Sampled logging of message payloads to the `payloads` logger.
+
+    Only `rate` of the calls are logged, at INFO, with the payload cut to `max_chars`. With the default rate of 0
+    a call is a single comparison, so payload logging can stay in hot paths.
+    """
+    def __init__(self, rate: float = 0.0, max_chars: int = 512):
+        self.logger = logging.getLogger("payloads")
+        self.rate = float(rate)
+        self.max_chars = int(max_chars)
+
+    def log(self, msg: str, *args, payload):
+        if self.rate and random.random() < self.rate and self.logger.isEnabledFor(logging.INFO):
+            self.logger.info(msg, *args, Truncated(payload, self.max_chars))
+
+# Shared by the modules that log payloads. configure_logging sets its rate.
+payload_log = PayloadLog()
+
+def parse_levels(levels: str) -> Dict[str, str]:
+    """Parse "name: LEVEL, name: LEVEL" into logger names and level names."""
+    parsed = {}
+    for item in levels.split(","):
+        if item.strip():
+            name, _, level = item.rpartition(":")
+            parsed[name.strip()] = level.strip().upper()
+    return parsed
+
+# Listener of the configured logging, None until configure_logging is called.
+listener: Optional[logging.handlers.QueueListener] = None
+
+def configure_logging(config: configparser.ConfigParser, format: Optional[str] = None) -> logging.handlers.QueueListener:
+    """Set up logging from the [LOGGING] section and return the listener that writes the records.
+
+    Records are put on a bounded queue and written to the file or stderr by the listener's thread, so logging never
+    waits on I/O. The listener is stopped at exit, which writes out what is still queued. Only the first call of a
+    process configures logging, later calls return the same listener.
+    """
+    global listener
+    if listener is not None:
+        return listener
+
+    if config.get("LOGGING", "file", fallback=""):
+        handler = logging.FileHandler(config.get("LOGGING", "file"))
+    else:
+        handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(logging.Formatter(format or config.get("LOGGING", "format", fallback=DEFAULT_FORMAT, raw=True)))
+
+    log_queue = queue.Queue(config.getint("LOGGING", "queue_size", fallback=10000))
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(DroppingQueueHandler(log_queue))
+    root.setLevel(config.get("LOGGING", "level", fallback="INFO").upper())
+    for name, level in parse_levels(config.get("LOGGING", "levels", fallback="")).items():
+        logging.getLogger(name).setLevel(level)
+
+    payload_log.rate = config.getfloat("LOGGING", "payload_sample_rate", fallback=0.0)
+    payload_log.max_chars = config.getint("LOGGING", "payload_max_chars", fallback=512)
+
+    listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
@@ -0,0 +1,165 @@
+import bisect, math, time
+from typing import Dict, List, Sequence, Tuple
+
+# Seconds, from 10 microseconds for the decode stages of small packets to 10 seconds for slow database writes.
+LATENCY_BUCKETS = (1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Uncompressed size over compressed size.
+RATIO_BUCKETS = (1.0, 1.5, 2.0, 3.0, 4.0, 6.0, 8.0, 12.0, 16.0, 24.0, 32.0)
+
+def format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for value in values)
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, escaped)) + "}"
+
+class Timer:
+    """Context manager that observes the seconds spent in its block on a histogram."""
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram: "HistogramChild"):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+class CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+class HistogramChild:
+    """Observations counted per bucket. Buckets are kept non-cumulative and summed up when rendered, so an
+    observation is one binary search and three additions."""
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self) -> Timer:
+        return Timer(self)
+
+class Metric:
+    """A metric family: one child per combination of label values. Metrics without labels act as their only child."""
+    type = ""
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.children: Dict[tuple, object] = {}
+        if not self.label_names:
+            self.default = self.labels()
+
+    def child(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        """Child for the given label values, in the order of the label names. Callers on hot paths should keep it."""
+        values = tuple(str(value) for value in values)
+        child = self.children.get(values)
+        if child is None:
+            if len(values) != len(self.label_names):
+                raise ValueError(f"{self.name} takes labels {self.label_names}, got {values}")
+            child = self.children[values] = self.child()
+        return child
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+
+class Counter(Metric):
+    type = "counter"
+
+    def child(self) -> CounterChild:
+        return CounterChild()
+
+    def inc(self, amount: float = 1):
+        self.default.value += amount
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        for values, child in self.children.items():
+            lines.append(f"{self.name}{format_labels(self.label_names, values)} {format_value(child.value)}")
+        return lines
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.bounds = tuple(sorted(buckets))
+        super().__init__(name, help, labels)
+
+    def child(self) -> HistogramChild:
+        return HistogramChild(self.bounds)
+
+    def observe(self, value: float):
+        self.default.observe(value)
+
+    def time(self) -> Timer:
+        return Timer(self.default)
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        names = self.label_names + ("le",)
+        for values, child in self.children.items():
+            cumulative = 0
+            for bound, count in zip(self.bounds + (math.inf,), child.counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{format_labels(names, values + (format_value(bound),))} {cumulative}")
+            labels = format_labels(self.label_names, values)
+            lines.append(f"{self.name}_sum{labels} {format_value(child.sum)}")
+            lines.append(f"{self.name}_count{labels} {child.count}")
+        return lines
+
+class Registry:
+    """Metrics of the process, rendered in the Prometheus text exposition format.
+
+    Updates are plain attribute arithmetic without locks. They happen on the event loop, so none are lost, and a
+    scrape may at worst see a histogram whose count is one ahead of its buckets.
+    """
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self.metrics:
+            raise ValueError("Duplicate metric: " + metric.name)
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, help, labels))
+
+    def histogram(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+# Shared by the modules of the API.
+registry = Registry()
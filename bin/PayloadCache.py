@@ -0,0 +1,63 @@
+import hashlib, threading
+from collections import OrderedDict
+from typing import Optional
+
+class PayloadCache:
+    """Content addressed LRU cache of compressed payloads, keyed by a digest of the uncompressed bytes.
+
+    Bounded both by entry count and by the total size of the cached values.
+    """
+    def __init__(self, max_entries: int = 1024, max_bytes: int = 16 * 1024 * 1024):
+        self.max_entries = int(max_entries)
+        self.max_bytes = int(max_bytes)
+        self.entries: OrderedDict[bytes, str] = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(data: bytes) -> bytes:
+        return hashlib.blake2b(data, digest_size=16).digest()
+
+    def get(self, key: bytes) -> Optional[str]:
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: bytes, value: str):
+        if len(value) > self.max_bytes:
+            return # Never cache something that would evict the whole cache.
+
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous)
+
+            self.entries[key] = value
+            self.size += len(value)
+
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self.entries),
+            "bytes": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
@@ -0,0 +1,118 @@
+import decimal, uuid
+from typing import Dict, List
+
+try:
+    import psycopg
+    from psycopg import sql
+    from psycopg_pool import ConnectionPool
+except ImportError: # Optional dependency, only needed for the postgres storage backend.
+    psycopg = None
+
+from bin.ReadingBatch import ReadingBatch, COST_COLUMN, READING_COLUMNS, STATE_CHANGE_COLUMNS, optional_cost, timestamp_datetime
+from bin.ReadingStore import ReadingStore
+from bin.RollupEngine import MERGE_UPDATES, ROLLUP_COLUMNS, Rollups
+
+# Python conversions for column types that the binary COPY dumpers will not take from floats, ints or strings.
+CONVERTERS = {
+    "uuid": uuid.UUID,
+    "numeric": lambda value: None if value is None else decimal.Decimal(repr(value)),
+    "text": str,
+}
+
+class PostgresReadingStore(ReadingStore):
+    """Writes readings over a pooled native Postgres connection.
+
+    Each batch is sent with binary COPY into temporary staging tables and merged into `readings` (upsert on
+    `conflict_columns`) and `module_state_changes` (insert) in one transaction. Column types are read from the
+    database once, so the binary rows match the schema. With `cost`, readings.cost is written too.
+    """
+    def __init__(self, dsn: str, min_size: int = 1, max_size: int = 4, conflict_columns: List[str] = ("module_id", "period_start_time"), cost: bool = False):
+        if psycopg is None:
+            raise RuntimeError("The postgres storage backend requires the psycopg[binary] and psycopg-pool packages.")
+
+        self.pool = ConnectionPool(dsn, min_size=int(min_size), max_size=int(max_size), open=True)
+        self.conflict_columns = list(conflict_columns)
+        self.cost = optional_cost if cost else None
+        self.reading_columns = READING_COLUMNS + (COST_COLUMN,) if cost else READING_COLUMNS
+
+        with self.pool.connection() as connection:
+            self.reading_types = self.column_types(connection, "readings", self.reading_columns)
+            self.state_change_types = self.column_types(connection, "module_state_changes", STATE_CHANGE_COLUMNS)
+
+        self.reading_merge = self.merge_query("readings", self.reading_columns, self.conflict_columns)
+        self.state_change_merge = self.merge_query("module_state_changes", STATE_CHANGE_COLUMNS, None)
+        # Column types of the rollup tables, read on their first write so the tables are only needed with rollups enabled.
+        self.rollup_types: Dict[str, List[str]] = {}
+
+    @staticmethod
+    def column_types(connection, table: str, columns: tuple) -> List[str]:
+        rows = connection.execute(
+            "SELECT attname, format_type(atttypid, NULL) FROM pg_attribute WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped",
+            (table,)
+        ).fetchall()
+        types = dict(rows)
+        missing = [column for column in columns if column not in types]
+        if missing:
+            raise RuntimeError(f"Table {table} is missing columns: {', '.join(missing)}")
+        return [types[column] for column in columns]
+
+    @staticmethod
+    def merge_query(table: str, columns: tuple, conflict_columns):
+        column_list = sql.SQL(", ").join(map(sql.Identifier, columns))
+        query = sql.SQL("INSERT INTO {table} ({columns}) SELECT {columns} FROM {staging}").format(
+            table=sql.Identifier(table), columns=column_list, staging=sql.Identifier(table + "_staging"))
+
+        if conflict_columns:
+            updates = sql.SQL(", ").join(
+                sql.SQL("{column} = EXCLUDED.{column}").format(column=sql.Identifier(column))
+                for column in columns if column not in conflict_columns
+            )
+            query += sql.SQL(" ON CONFLICT ({conflict}) DO UPDATE SET {updates}").format(
+                conflict=sql.SQL(", ").join(map(sql.Identifier, conflict_columns)), updates=updates)
+        return query
+
+    @staticmethod
+    def copy_rows(cursor, table: str, columns: tuple, types: List[str], values: tuple):
+        """Binary COPY rows, given column by column, into the table's temporary staging table."""
+        staging = sql.Identifier(table + "_staging")
+        cursor.execute(sql.SQL("CREATE TEMP TABLE IF NOT EXISTS {staging} (LIKE {table} INCLUDING DEFAULTS) ON COMMIT DELETE ROWS").format(
+            staging=staging, table=sql.Identifier(table)))
+
+        values = [map(CONVERTERS[type], column) if type in CONVERTERS else column for type, column in zip(types, values)]
+        query = sql.SQL("COPY {staging} ({columns}) FROM STDIN (FORMAT BINARY)").format(
+            staging=staging, columns=sql.SQL(", ").join(map(sql.Identifier, columns)))
+
+        with cursor.copy(query) as copy:
+            copy.set_types(types)
+            for row in zip(*values):
+                copy.write_row(row)
+
+    def write(self, batch: ReadingBatch):
+        with self.pool.connection() as connection, connection.transaction(), connection.cursor() as cursor:
+            if len(batch):
+                self.copy_rows(cursor, "readings", self.reading_columns, self.reading_types, batch.reading_columns(timestamp_datetime, self.cost))
+                cursor.execute(self.reading_merge)
+            if batch.state_change_count:
+                self.copy_rows(cursor, "module_state_changes", STATE_CHANGE_COLUMNS, self.state_change_types, batch.state_change_columns(timestamp_datetime, bool))
+                cursor.execute(self.state_change_merge)
+
+    @staticmethod
+    def rollup_merge_query(rollups: Rollups):
+        """Merge of the staged deltas into the rollup table, adding them to the rows of their windows."""
+        columns = sql.SQL(", ").join(map(sql.Identifier, (rollups.id_column,) + ROLLUP_COLUMNS))
+        return sql.SQL("INSERT INTO {table} AS t ({columns}) SELECT {columns} FROM {staging} ON CONFLICT ({id}, resolution, window_start) DO UPDATE SET " + MERGE_UPDATES).format(
+            table=sql.Identifier(rollups.table), columns=columns, staging=sql.Identifier(rollups.table + "_staging"), id=sql.Identifier(rollups.id_column))
+
+    def write_rollups(self, rollups: List[Rollups]):
+        with self.pool.connection() as connection, connection.transaction(), connection.cursor() as cursor:
+            for level_rollups in rollups:
+                if not len(level_rollups):
+                    continue
+                columns = (level_rollups.id_column,) + ROLLUP_COLUMNS
+                if level_rollups.table not in self.rollup_types:
+                    self.rollup_types[level_rollups.table] = self.column_types(connection, level_rollups.table, columns)
+                self.copy_rows(cursor, level_rollups.table, columns, self.rollup_types[level_rollups.table], level_rollups.columns(timestamp_datetime))
+                cursor.execute(self.rollup_merge_query(level_rollups))
+
+    def close(self):
+        self.pool.close()
@@ -0,0 +1,221 @@
+import csv, datetime, functools, io, math
+from array import array
+from typing import List, Optional
+
+from models import ReadingDataItem, ReadingMessage
+
+READING_COLUMNS = (
+    "module_id", "period_start_time", "period_end_time", "sample_count", "mean_voltage", "mean_frequency",
+    "mean_apparent_power", "max_apparent_power", "iqr_apparent_power", "kurtosis_apparent_power",
+    "mean_power_factor", "max_power_factor", "iqr_power_factor", "kurtosis_power_factor", "kwh_usage",
+)
+
+# Written after READING_COLUMNS by stores that price readings.
+COST_COLUMN = "cost"
+
+STATE_CHANGE_COLUMNS = ("module", "state", "timestamp")
+
+STATE_TEXT = ("false", "true")
+
+SECONDS = [":%02d+00" % second for second in range(60)]
+
+# Characters that force a CSV field to be quoted.
+CSV_SPECIAL = (',', '"', '\n', '\r')
+
+NAN = array('d', [math.nan])
+
+def csv_cost(cost: float):
+    """CSV field of a cost, empty (NULL) for unpriced readings."""
+    return "" if cost != cost else cost
+
+def optional_cost(cost: float):
+    return None if cost != cost else cost
+
+@functools.lru_cache(maxsize=65536)
+def format_minute(minute: int) -> str:
+    return datetime.datetime.fromtimestamp(minute * 60, datetime.timezone.utc).strftime("%Y-%m-%d %H:%M")
+
+def format_timestamp(timestamp: int) -> str:
+    """Database timestamp string for a unix time, in UTC whatever the server's time zone, as the +00 says.
+
+    Only the minute is formatted with strftime, and cached, since the readings of a packet share their period
+    and state changes cluster within it.
+    """
+    minute, second = divmod(timestamp, 60)
+    return format_minute(minute) + SECONDS[second]
+
+@functools.lru_cache(maxsize=65536)
+def timestamp_datetime(timestamp: int) -> datetime.datetime:
+    """The moment format_timestamp describes, as an aware datetime for binary database drivers."""
+    return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc)
+
+class ReadingBatch:
+    """Columnar batch of readings and module state changes.
+
+    Each field of ReadingDataItem is held in its own column, numeric columns in typed arrays. The
+    apparent_power and power_factor statistics are stored flat, four values per reading in the order
+    [mean, max, iqr, kurtosis]. Batches serialise to CSV for bulk writes without building a dict per row.
+
+    `cost` holds the priced cost of the first len(cost) readings; readings past its end, which is all of them
+    until `price` is called, are unpriced and read as NaN.
+    """
+    def __init__(self):
+        self.module_id: List[str] = []
+        self.period_start = array('q')
+        self.period_end = array('q')
+        self.sample_count = array('q')
+        self.mean_voltage = array('d')
+        self.mean_frequency = array('d')
+        self.apparent_power = array('d')
+        self.power_factor = array('d')
+        self.kwh_usage = array('d')
+        self.cost = array('d')
+
+        self.state_module: List[str] = []
+        self.state = array('b')
+        self.state_timestamp = array('q')
+
+    def __len__(self) -> int:
+        return len(self.module_id)
+
+    @property
+    def state_change_count(self) -> int:
+        return len(self.state_module)
+
+    @property
+    def row_count(self) -> int:
+        return len(self.module_id) + len(self.state_module)
+
+    def add_message(self, message: ReadingMessage):
+        """Append every reading of a parsed reading packet."""
+        self.add_readings(message.period_start, message.period_end, message.readings)
+
+    def add_readings(self, period_start: int, period_end: int, readings: List[ReadingDataItem]):
+        """Append readings that share one period."""
+        count = len(readings)
+        self.period_start.extend([period_start] * count)
+        self.period_end.extend([period_end] * count)
+
+        for reading in readings:
+            self.module_id.append(reading.module_id)
+            self.sample_count.append(reading.sample_count)
+            self.mean_voltage.append(reading.mean_voltage)
+            self.mean_frequency.append(reading.mean_frequency)
+            apparent_power, power_factor = reading.apparent_power, reading.power_factor
+            self.apparent_power.extend((apparent_power[0], apparent_power[1], apparent_power[2], apparent_power[3]))
+            self.power_factor.extend((power_factor[0], power_factor[1], power_factor[2], power_factor[3]))
+            self.kwh_usage.append(reading.kwh_usage)
+
+            for state_change in reading.state_changes or []:
+                self.state_module.append(reading.module_id)
+                self.state.append(state_change.state)
+                self.state_timestamp.append(state_change.timestamp)
+
+    def append(self, other: "ReadingBatch"):
+        """Append all rows of another batch."""
+        if len(other.cost):
+            self.cost.extend(NAN * (len(self) - len(self.cost)))
+        for name, column in vars(other).items():
+            getattr(self, name).extend(column)
+
+    def take(self, indices: List[int], state_indices: Optional[List[int]] = None) -> "ReadingBatch":
+        """New batch holding the given readings, and the given state changes or else all of this batch's state changes."""
+        batch = ReadingBatch()
+        batch.module_id = [self.module_id[i] for i in indices]
+        if len(self.cost):
+            cost = self.costs()
+            batch.cost = array('d', [cost[i] for i in indices])
+        for name in ("period_start", "period_end", "sample_count", "mean_voltage", "mean_frequency", "kwh_usage"):
+            column = getattr(self, name)
+            setattr(batch, name, array(column.typecode, [column[i] for i in indices]))
+        for name in ("apparent_power", "power_factor"):
+            column = getattr(self, name)
+            setattr(batch, name, array('d', [column[4 * i + j] for i in indices for j in range(4)]))
+        if state_indices is None:
+            batch.state_module, batch.state, batch.state_timestamp = self.state_module, self.state, self.state_timestamp
+        else:
+            batch.state_module = [self.state_module[i] for i in state_indices]
+            batch.state = array('b', [self.state[i] for i in state_indices])
+            batch.state_timestamp = array('q', [self.state_timestamp[i] for i in state_indices])
+        return batch
+
+    def deduplicate(self) -> "ReadingBatch":
+        """Drop readings that a later reading with the same module and period start replaces.
+
+        Returns this batch when there is nothing to drop, which is the common case.
+        """
+        last = {}
+        for i, key in enumerate(zip(self.module_id, self.period_start)):
+            last[key] = i
+        if len(last) == len(self.module_id):
+            return self
+        return self.take(sorted(last.values()))
+
+    def costs(self) -> array:
+        """Cost of every reading, NaN where unpriced."""
+        if len(self.cost) == len(self):
+            return self.cost
+        return self.cost + NAN * (len(self) - len(self.cost))
+
+    def price(self, table):
+        """Price every reading with a TariffTable, at the rate of the hour its period starts in."""
+        self.cost = array('d')
+        if len(self):
+            self.cost.frombytes(table.price(self.period_start, self.kwh_usage).tobytes())
+
+    def reading_columns(self, timestamp=format_timestamp, cost=None) -> tuple:
+        """Columns of the `readings` table, in READING_COLUMNS order. `timestamp` converts the unix time columns.
+
+        With `cost`, which converts the cost of each reading, the cost column follows.
+        """
+        columns = (
+            self.module_id,
+            map(timestamp, self.period_start),
+            map(timestamp, self.period_end),
+            self.sample_count,
+            self.mean_voltage,
+            self.mean_frequency,
+            self.apparent_power[0::4],
+            self.apparent_power[1::4],
+            self.apparent_power[2::4],
+            self.apparent_power[3::4],
+            self.power_factor[0::4],
+            self.power_factor[1::4],
+            self.power_factor[2::4],
+            self.power_factor[3::4],
+            self.kwh_usage,
+        )
+        if cost is not None:
+            columns += (map(cost, self.costs()),)
+        return columns
+
+    def state_change_columns(self, timestamp=format_timestamp, state=STATE_TEXT.__getitem__) -> tuple:
+        """Columns of the `module_state_changes` table, in STATE_CHANGE_COLUMNS order."""
+        return (
+            self.state_module,
+            map(state, self.state),
+            map(timestamp, self.state_timestamp),
+        )
+
+    @staticmethod
+    def _to_csv(header: tuple, columns: tuple) -> bytes:
+        ids = "".join(columns[0])
+        if any(special in ids for special in CSV_SPECIAL):
+            # Module ids come from the units, so fall back to the csv module if one needs quoting.
+            buffer = io.StringIO()
+            writer = csv.writer(buffer, lineterminator="\n")
+            writer.writerow(header)
+            writer.writerows(zip(*columns))
+            return buffer.getvalue().encode('utf-8')
+
+        # Every other column is numeric, boolean or a timestamp, so fields can be joined without quoting.
+        row = ",".join(["{}"] * len(header)).format
+        return (",".join(header) + "\n" + "\n".join(map(row, *columns)) + "\n").encode('utf-8')
+
+    def readings_csv(self, cost: bool = False) -> bytes:
+        if cost:
+            return self._to_csv(READING_COLUMNS + (COST_COLUMN,), self.reading_columns(cost=csv_cost))
+        return self._to_csv(READING_COLUMNS, self.reading_columns())
+
+    def state_changes_csv(self) -> bytes:
+        return self._to_csv(STATE_CHANGE_COLUMNS, self.state_change_columns())
@@ -0,0 +1,129 @@
+import asyncio, logging, time
+from typing import Awaitable, Callable, Optional
+
+from bin.ReadingBatch import ReadingBatch
+
+logger = logging.getLogger(__name__)
+
+class BufferFullError(Exception):
+    """Raised when the buffer cannot take more rows until the next flush."""
+
+class ReadingBuffer:
+    """Write-behind buffer for reading and state change rows.
+
+    Batches from many webhooks are collected into one ReadingBatch and written in one call once `flush_rows`
+    rows are queued or `flush_interval` seconds have passed. Readings with the same module and period are
+    coalesced so the upsert never touches a row twice. The buffer holds at most `max_rows` rows; beyond that
+    `add` raises BufferFullError so the caller can push back on the sender.
+    """
+    def __init__(self, flush_callback: Callable[[ReadingBatch], Awaitable[None]], max_rows: int = 50000,
+                 flush_rows: int = 1000, flush_interval: float = 1.0):
+        self.flush_callback = flush_callback
+        self.max_rows = int(max_rows)
+        self.flush_rows = int(flush_rows)
+        self.flush_interval = float(flush_interval)
+
+        self.batch = ReadingBatch()
+        self.flush_needed = asyncio.Event()
+        self.flush_lock = asyncio.Lock()
+        self.task: Optional[asyncio.Task] = None
+        self.running = False
+
+        self.flushes = 0
+        self.rows_flushed = 0
+        self.rows_coalesced = 0
+        self.rows_rejected = 0
+        self.flush_failures = 0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+
+    @property
+    def depth(self) -> int:
+        return self.batch.row_count
+
+    def add(self, batch: ReadingBatch):
+        """Queue a batch for the next flush. Raises BufferFullError if it does not fit."""
+        if self.depth + batch.row_count > self.max_rows:
+            self.rows_rejected += batch.row_count
+            raise BufferFullError("Ingress buffer is full.")
+
+        self.batch.append(batch)
+
+        if self.depth >= self.flush_rows:
+            self.flush_needed.set()
+
+    async def flush(self):
+        """Write everything queued so far."""
+        async with self.flush_lock:
+            if not self.depth:
+                return
+
+            batch, self.batch = self.batch, ReadingBatch()
+            queued = len(batch)
+            batch = batch.deduplicate()
+            self.rows_coalesced += queued - len(batch)
+
+            start = time.perf_counter()
+            try:
+                await self.flush_callback(batch)
+            except Exception as e:
+                self.flush_failures += 1
+                logger.error("Failed to flush %d readings and %d state changes: %s", len(batch), batch.state_change_count, e)
+                self._requeue(batch)
+                return
+
+            self.last_flush_latency = time.perf_counter() - start
+            self.max_flush_latency = max(self.max_flush_latency, self.last_flush_latency)
+            self.flushes += 1
+            self.rows_flushed += batch.row_count
+
+    def _requeue(self, batch: ReadingBatch):
+        """Put the rows of a failed flush back ahead of newer rows, if there is room."""
+        if self.depth + batch.row_count > self.max_rows:
+            self.rows_rejected += batch.row_count
+            logger.error("Dropped %d rows after a failed flush, the buffer is full.", batch.row_count)
+            return
+
+        # Older rows go first, so a newer copy of a reading still wins when the batch is deduplicated.
+        batch.append(self.batch)
+        self.batch = batch
+
+    async def _run(self):
+        while self.running:
+            try:
+                await asyncio.wait_for(self.flush_needed.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.flush_needed.clear()
+            await self.flush()
+
+    async def start(self):
+        if self.task is None:
+            # Bind the synchronisation primitives to the running loop.
+            self.flush_needed = asyncio.Event()
+            self.flush_lock = asyncio.Lock()
+            self.running = True
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the flush loop and write any remaining rows."""
+        if self.task is not None:
+            # Let the loop finish its current flush rather than cancelling it half way through a write.
+            self.running = False
+            self.flush_needed.set()
+            await self.task
+            self.task = None
+        await self.flush()
+
+    def stats(self) -> dict:
+        return {
+            "depth": self.depth,
+            "max_rows": self.max_rows,
+            "flushes": self.flushes,
+            "rows_flushed": self.rows_flushed,
+            "rows_coalesced": self.rows_coalesced,
+            "rows_rejected": self.rows_rejected,
+            "flush_failures": self.flush_failures,
+            "last_flush_latency": self.last_flush_latency,
+            "max_flush_latency": self.max_flush_latency,
+        }
@@ -0,0 +1,169 @@
+import base64, struct, sys, uuid
+from array import array
+from typing import Tuple
+
+from bin.ReadingBatch import ReadingBatch
+from models import ReadingMessage
+
+# Values of MQTTDataPacket.e
+ENCODING_BROTLI_JSON = 0
+ENCODING_BINARY = 1
+
+VERSION = 1
+
+# Frame flags.
+STRING_IDS = 0x01
+
+HEADER = struct.Struct("<BBB")
+
+# Fewest bytes a reading and a state change take in a frame: the fixed-size columns, plus a UUID or a string id of
+# at least its length byte, and a state change's index, state and a one byte timestamp.
+READING_SIZE = 4 + 8 * 11
+UUID_SIZE = 16
+STATE_CHANGE_SIZE = 4 + 1 + 1
+
+class ReadingCodecError(ValueError):
+    """Raised for frames that are malformed or of an unknown version."""
+
+def write_uvarint(out: bytearray, value: int):
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+def write_svarint(out: bytearray, value: int):
+    write_uvarint(out, (value << 1) ^ (value >> 63))
+
+def read_uvarint(data: bytes, offset: int) -> Tuple[int, int]:
+    value = shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+def read_svarint(data: bytes, offset: int) -> Tuple[int, int]:
+    value, offset = read_uvarint(data, offset)
+    return (value >> 1) ^ -(value & 1), offset
+
+def is_uuid(module_id: str) -> bool:
+    try:
+        return str(uuid.UUID(module_id)) == module_id
+    except ValueError:
+        return False
+
+def float_column(data: memoryview, offset: int, count: int) -> Tuple[array, int]:
+    column = array('d')
+    column.frombytes(data[offset:offset + 8 * count])
+    if sys.byteorder == "big":
+        column.byteswap()
+    return column, offset + 8 * count
+
+def encode_reading_message(message: ReadingMessage, message_type: int = 0) -> bytes:
+    """Encode a reading packet as a binary frame, the `m` of an MQTTDataPacket with e = ENCODING_BINARY.
+
+    Frame, little-endian, columns of n readings and k state changes:
+        u8 version, u8 type, u8 flags (STRING_IDS when a module id is not a canonical UUID)
+        uvarint period_start, svarint period_end - period_start, uvarint n, uvarint k
+        module ids: n x 16 byte UUID, or n x (uvarint length, utf-8) with STRING_IDS
+        n x u32 sample_count
+        n x f64 mean_voltage, n x f64 mean_frequency
+        4n x f64 apparent_power, 4n x f64 power_factor, each reading's [mean, max, iqr, kurtosis]
+        n x f64 kwh_usage
+        k x u32 reading index, k x u8 state, k x svarint timestamp - period_start
+    """
+    readings = message.readings
+    state_changes = [(index, change) for index, reading in enumerate(readings) for change in reading.state_changes or []]
+    string_ids = not all(is_uuid(reading.module_id) for reading in readings)
+
+    out = bytearray(HEADER.pack(VERSION, message_type, STRING_IDS if string_ids else 0))
+    write_uvarint(out, message.period_start)
+    write_svarint(out, message.period_end - message.period_start)
+    write_uvarint(out, len(readings))
+    write_uvarint(out, len(state_changes))
+
+    for reading in readings:
+        if string_ids:
+            module_id = reading.module_id.encode('utf-8')
+            write_uvarint(out, len(module_id))
+            out += module_id
+        else:
+            out += uuid.UUID(reading.module_id).bytes
+
+    count = len(readings)
+    out += struct.pack(f"<{count}I", *(reading.sample_count for reading in readings))
+    out += struct.pack(f"<{count}d", *(reading.mean_voltage for reading in readings))
+    out += struct.pack(f"<{count}d", *(reading.mean_frequency for reading in readings))
+    out += struct.pack(f"<{4 * count}d", *(value for reading in readings for value in reading.apparent_power))
+    out += struct.pack(f"<{4 * count}d", *(value for reading in readings for value in reading.power_factor))
+    out += struct.pack(f"<{count}d", *(reading.kwh_usage for reading in readings))
+
+    out += struct.pack(f"<{len(state_changes)}I", *(index for index, _ in state_changes))
+    out += bytes(change.state for _, change in state_changes)
+    for _, change in state_changes:
+        write_svarint(out, change.timestamp - message.period_start)
+    return bytes(out)
+
+def decode_reading_batch(frame: bytes) -> Tuple[int, ReadingBatch]:
+    """Decode a binary frame straight into a ReadingBatch. Returns the message type and the batch."""
+    data = memoryview(frame)
+    if len(data) < HEADER.size:
+        raise ReadingCodecError("Truncated reading frame.")
+    version, message_type, flags = HEADER.unpack_from(data, 0)
+    if version != VERSION:
+        raise ReadingCodecError(f"Unsupported reading frame version: {version}")
+
+    try:
+        period_start, offset = read_uvarint(data, HEADER.size)
+        period_length, offset = read_svarint(data, offset)
+        count, offset = read_uvarint(data, offset)
+        state_change_count, offset = read_uvarint(data, offset)
+
+        # Counts are checked against the frame before any column is allocated, so a small frame cannot claim millions of readings.
+        id_size = 1 if flags & STRING_IDS else UUID_SIZE
+        if count * (READING_SIZE + id_size) + state_change_count * STATE_CHANGE_SIZE > len(data) - offset:
+            raise ReadingCodecError("Reading frame is shorter than its header claims.")
+
+        batch = ReadingBatch()
+        if flags & STRING_IDS:
+            for _ in range(count):
+                length, offset = read_uvarint(data, offset)
+                batch.module_id.append(str(data[offset:offset + length], 'utf-8'))
+                offset += length
+        else:
+            ids = data[offset:offset + 16 * count].hex()
+            batch.module_id = [
+                f"{ids[i:i + 8]}-{ids[i + 8:i + 12]}-{ids[i + 12:i + 16]}-{ids[i + 16:i + 20]}-{ids[i + 20:i + 32]}"
+                for i in range(0, 32 * count, 32)
+            ]
+            offset += 16 * count
+
+        batch.period_start = array('q', [period_start]) * count
+        batch.period_end = array('q', [period_start + period_length]) * count
+        batch.sample_count = array('q', struct.unpack_from(f"<{count}I", data, offset))
+        offset += 4 * count
+        batch.mean_voltage, offset = float_column(data, offset, count)
+        batch.mean_frequency, offset = float_column(data, offset, count)
+        batch.apparent_power, offset = float_column(data, offset, 4 * count)
+        batch.power_factor, offset = float_column(data, offset, 4 * count)
+        batch.kwh_usage, offset = float_column(data, offset, count)
+
+        indices = struct.unpack_from(f"<{state_change_count}I", data, offset)
+        offset += 4 * state_change_count
+        batch.state_module = [batch.module_id[index] for index in indices]
+        batch.state = array('b', [state != 0 for state in data[offset:offset + state_change_count]])
+        offset += state_change_count
+        for _ in range(state_change_count):
+            delta, offset = read_svarint(data, offset)
+            batch.state_timestamp.append(period_start + delta)
+    except (struct.error, IndexError, ValueError) as e:
+        raise ReadingCodecError(f"Malformed reading frame: {e}")
+
+    if offset != len(data) or len(batch.mean_voltage) != count or len(batch.state) != state_change_count:
+        raise ReadingCodecError("Reading frame length does not match its header.")
+    return message_type, batch
+
+def decode_reading_batch_b64(message: str) -> Tuple[int, ReadingBatch]:
+    return decode_reading_batch(base64.b64decode(message))
@@ -0,0 +1,45 @@
+from typing import List
+
+from supabase import Client
+
+from bin.ReadingBatch import ReadingBatch
+from bin.RollupEngine import Rollups
+
+class ReadingStore:
+    """Destination of ingress reading batches. Writes are blocking and are run on a worker thread."""
+
+    def write(self, batch: ReadingBatch):
+        raise NotImplementedError
+
+    def write_rollups(self, rollups: List[Rollups]):
+        """Merge rollup deltas into the rollup tables."""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+class SupabaseReadingStore(ReadingStore):
+    """Writes readings through the supabase PostgREST API as CSV bulk inserts. With `cost`, readings.cost is written too."""
+
+    def __init__(self, client: Client, cost: bool = False):
+        self.client = client
+        self.cost = cost
+
+    def post_csv(self, table: str, body: bytes, upsert: bool = False):
+        prefer = "return=minimal"
+        if upsert:
+            prefer += ",resolution=merge-duplicates"
+        response = self.client.postgrest.session.post("/" + table, content=body, headers={"Content-Type" : "text/csv", "Prefer" : prefer})
+        response.raise_for_status()
+
+    def write(self, batch: ReadingBatch):
+        if len(batch):
+            self.post_csv("readings", batch.readings_csv(self.cost), upsert=True)
+        if batch.state_change_count:
+            self.post_csv("module_state_changes", batch.state_changes_csv())
+
+    def write_rollups(self, rollups: List[Rollups]):
+        # PostgREST upserts replace rows rather than add to them, so deltas are merged by a database function.
+        for level_rollups in rollups:
+            if len(level_rollups):
+                self.client.rpc("merge_" + level_rollups.table, {"rows": level_rollups.rows()}).execute()
@@ -0,0 +1,338 @@
+"""
+Hourly and daily rollups of ingress readings per module and per unit, so dashboards read one row per window instead
+of every reading.
+
+Readings are collected as they are queued and aggregated in bulk every `flush_interval` seconds into deltas: reading,
+sample and state change counts, kWh and cost sums, sample weighted mean voltage and frequency, and the largest
+apparent power. Deltas are merged into the stored row of their window, so windows that fill over many flushes, or
+whose packets arrive late or out of order, add up to the same totals.
+
+Print the tables and the merge functions the supabase backend calls with: python -m bin.RollupEngine
+"""
+import asyncio, logging, time
+from typing import Awaitable, Callable, Dict, List, Sequence
+
+try:
+    import numpy as np
+except ImportError: # Optional dependency, only needed to roll up readings.
+    np = None
+
+from bin.Metrics import registry
+from bin.ReadingBatch import ReadingBatch, format_timestamp, optional_cost
+
+logger = logging.getLogger(__name__)
+
+HOUR = 3600
+DAY = 86400
+
+# Rollup table of each level, and the column its rows are keyed by along with (resolution, window_start).
+ROLLUP_TABLES = {"module": ("module_rollups", "module_id"), "unit": ("unit_rollups", "unit_id")}
+
+ROLLUP_COLUMNS = (
+    "resolution", "window_start", "readings", "samples", "mean_voltage", "mean_frequency", "kwh_usage", "cost",
+    "max_apparent_power", "state_changes",
+)
+
+# Columns that are NULL in windows without readings, or without priced readings in the case of cost.
+OPTIONAL_COLUMNS = ("mean_voltage", "mean_frequency", "cost", "max_apparent_power")
+
+# Merge of a delta into the stored row of its window, aliased t. Counts and sums add up and means are weighted by samples.
+MERGE_UPDATES = """readings = t.readings + EXCLUDED.readings,
+        samples = t.samples + EXCLUDED.samples,
+        mean_voltage = (COALESCE(t.mean_voltage * t.samples, 0) + COALESCE(EXCLUDED.mean_voltage * EXCLUDED.samples, 0)) / NULLIF(t.samples + EXCLUDED.samples, 0),
+        mean_frequency = (COALESCE(t.mean_frequency * t.samples, 0) + COALESCE(EXCLUDED.mean_frequency * EXCLUDED.samples, 0)) / NULLIF(t.samples + EXCLUDED.samples, 0),
+        kwh_usage = t.kwh_usage + EXCLUDED.kwh_usage,
+        cost = COALESCE(t.cost + EXCLUDED.cost, t.cost, EXCLUDED.cost),
+        max_apparent_power = GREATEST(t.max_apparent_power, EXCLUDED.max_apparent_power),
+        state_changes = t.state_changes + EXCLUDED.state_changes"""
+
+rollup_stage_seconds = registry.histogram("rollup_stage_seconds", "Time spent aggregating and writing rollups per flush.", ["stage"])
+rollup_aggregate_time = rollup_stage_seconds.labels("aggregate")
+rollup_write_time = rollup_stage_seconds.labels("write")
+rollup_rows = registry.counter("rollup_rows_total", "Rollup deltas merged into the rollup tables.", ["level"])
+
+def schema() -> str:
+    """DDL of the rollup tables, and of the functions SupabaseReadingStore merges deltas through."""
+    statements = []
+    for table, id_column in ROLLUP_TABLES.values():
+        statements.append(f"""CREATE TABLE {table} (
+    {id_column} uuid NOT NULL,
+    resolution integer NOT NULL,
+    window_start timestamptz NOT NULL,
+    readings integer NOT NULL,
+    samples bigint NOT NULL,
+    mean_voltage double precision,
+    mean_frequency double precision,
+    kwh_usage double precision NOT NULL,
+    cost double precision,
+    max_apparent_power double precision,
+    state_changes integer NOT NULL,
+    PRIMARY KEY ({id_column}, resolution, window_start)
+);
+
+CREATE FUNCTION merge_{table}(rows jsonb) RETURNS void LANGUAGE sql AS $$
+    INSERT INTO {table} AS t SELECT * FROM jsonb_populate_recordset(NULL::{table}, rows)
+    ON CONFLICT ({id_column}, resolution, window_start) DO UPDATE SET
+        {MERGE_UPDATES};
+$$;""")
+    return "\n\n".join(statements)
+
+def id_codes(index: Dict[str, int], ids: List[str]) -> "np.ndarray":
+    """Number every distinct id in order of first appearance, continuing the numbering of `index`."""
+    new = [id for id in dict.fromkeys(ids) if id not in index]
+    index.update(zip(new, range(len(index), len(index) + len(new))))
+    return np.fromiter(map(index.__getitem__, ids), dtype=np.int64, count=len(ids))
+
+class Rollups:
+    """Rollup deltas of one level, as an id column and numpy columns in ROLLUP_COLUMNS order, NaN where NULL."""
+
+    def __init__(self, level: str, ids: List[str], columns: Dict[str, "np.ndarray"]):
+        self.level = level
+        self.ids = ids
+        self.values = columns
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @property
+    def table(self) -> str:
+        return ROLLUP_TABLES[self.level][0]
+
+    @property
+    def id_column(self) -> str:
+        return ROLLUP_TABLES[self.level][1]
+
+    def columns(self, timestamp=format_timestamp) -> tuple:
+        """Columns of the level's rollup table as Python values, the id first. `timestamp` converts window_start."""
+        columns = [self.ids]
+        for name in ROLLUP_COLUMNS:
+            column = self.values[name].tolist()
+            if name == "window_start":
+                column = list(map(timestamp, column))
+            elif name in OPTIONAL_COLUMNS:
+                column = list(map(optional_cost, column))
+            columns.append(column)
+        return tuple(columns)
+
+    def rows(self) -> List[dict]:
+        names = (self.id_column,) + ROLLUP_COLUMNS
+        return [dict(zip(names, row)) for row in zip(*self.columns())]
+
+    @staticmethod
+    def concatenate(parts: Sequence["Rollups"]) -> "Rollups":
+        return Rollups(
+            parts[0].level,
+            [id for part in parts for id in part.ids],
+            {name: np.concatenate([part.values[name] for part in parts]) for name in ROLLUP_COLUMNS},
+        )
+
+class RollupEngine:
+    """Collects queued readings and hands their hourly and daily rollups to `flush_callback` every `flush_interval` seconds.
+
+    Rollups are derived data, so they never push back on ingress: readings beyond `max_rows` waiting to be rolled up
+    are dropped and counted. Readings and state changes sent twice within one flush are counted once, the later copy of
+    a reading winning as in ReadingBuffer; copies sent after their flush are counted again. Windows start at whole
+    hours and days of local time, `utc_offset` seconds ahead of UTC.
+    """
+    def __init__(self, flush_callback: Callable[[List[Rollups]], Awaitable[None]], utc_offset: int = 0,
+                 flush_interval: float = 60.0, max_rows: int = 100000):
+        if np is None:
+            raise RuntimeError("Rolling up readings requires the numpy package.")
+
+        self.flush_callback = flush_callback
+        self.utc_offset = int(utc_offset)
+        self.flush_interval = float(flush_interval)
+        self.max_rows = int(max_rows)
+
+        self.batch = ReadingBatch()
+        self.unit_ids: List[str] = []
+        self.state_unit_ids: List[str] = []
+        self.flush_needed = asyncio.Event()
+        self.flush_lock = asyncio.Lock()
+        self.task = None
+        self.running = False
+
+        self.flushes = 0
+        self.readings_rolled_up = 0
+        self.rows_written = 0
+        self.rows_dropped = 0
+        self.flush_failures = 0
+        self.last_flush_latency = 0.0
+
+    @property
+    def depth(self) -> int:
+        return self.batch.row_count
+
+    def add(self, unit_id: str, batch: ReadingBatch):
+        """Queue the readings and state changes of one unit for the next flush."""
+        if self.depth + batch.row_count > self.max_rows:
+            self.rows_dropped += batch.row_count
+            return
+
+        self.batch.append(batch)
+        self.unit_ids.extend([unit_id] * len(batch))
+        self.state_unit_ids.extend([unit_id] * batch.state_change_count)
+
+        if self.depth >= self.max_rows // 2:
+            self.flush_needed.set()
+
+    def windows(self, timestamps: "np.ndarray", resolution: int) -> "np.ndarray":
+        """Index of the window of each timestamp, counted from the first window after the epoch."""
+        return (timestamps + self.utc_offset) // resolution
+
+    def rollup(self, level: str, names: List[str], codes: "np.ndarray", state_codes: "np.ndarray", readings: dict, state_timestamps: "np.ndarray", resolution: int) -> Rollups:
+        """Deltas of every (id, window) that has readings or state changes. Ids are given as codes, indices into `names`."""
+        # Windows fit in 32 bits for any resolution of an hour or more, so one int64 key identifies (id, window).
+        keys = np.concatenate((
+            (codes << 32) | self.windows(readings["period_start"], resolution),
+            (state_codes << 32) | self.windows(state_timestamps, resolution),
+        ))
+        unique, inverse = np.unique(keys, return_inverse=True)
+        reading_group, state_group = inverse[:len(codes)], inverse[len(codes):]
+        size = len(unique)
+
+        samples = np.bincount(reading_group, weights=readings["sample_count"], minlength=size)
+        count = np.bincount(reading_group, minlength=size)
+        priced = ~np.isnan(readings["cost"])
+        cost = np.bincount(reading_group[priced], weights=readings["cost"][priced], minlength=size).astype(np.float64)
+        cost[np.bincount(reading_group[priced], minlength=size) == 0] = np.nan
+        max_apparent_power = np.full(size, -np.inf)
+        np.maximum.at(max_apparent_power, reading_group, readings["max_apparent_power"])
+        max_apparent_power[count == 0] = np.nan
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mean_voltage = np.bincount(reading_group, weights=readings["sample_count"] * readings["mean_voltage"], minlength=size) / samples
+            mean_frequency = np.bincount(reading_group, weights=readings["sample_count"] * readings["mean_frequency"], minlength=size) / samples
+
+        return Rollups(level, [names[code] for code in (unique >> 32).tolist()], {
+            "resolution": np.full(size, resolution, dtype=np.int64),
+            "window_start": (unique & 0xFFFFFFFF) * resolution - self.utc_offset,
+            "readings": count,
+            "samples": samples.astype(np.int64),
+            "mean_voltage": mean_voltage,
+            "mean_frequency": mean_frequency,
+            "kwh_usage": np.bincount(reading_group, weights=readings["kwh_usage"], minlength=size),
+            "cost": cost,
+            "max_apparent_power": max_apparent_power,
+            "state_changes": np.bincount(state_group, minlength=size),
+        })
+
+    def aggregate(self, batch: ReadingBatch, unit_ids: List[str], state_unit_ids: List[str]) -> List[Rollups]:
+        """Hourly and daily deltas of a batch, per module and per unit."""
+        readings = {
+            "period_start": np.frombuffer(batch.period_start, dtype=np.int64),
+            "sample_count": np.frombuffer(batch.sample_count, dtype=np.int64).astype(np.float64),
+            "mean_voltage": np.frombuffer(batch.mean_voltage, dtype=np.float64),
+            "mean_frequency": np.frombuffer(batch.mean_frequency, dtype=np.float64),
+            "max_apparent_power": np.frombuffer(batch.apparent_power, dtype=np.float64)[1::4],
+            "kwh_usage": np.frombuffer(batch.kwh_usage, dtype=np.float64),
+            "cost": np.frombuffer(batch.costs(), dtype=np.float64),
+        }
+        module_index, unit_index = {}, {}
+        module_codes = id_codes(module_index, batch.module_id)
+        state_module_codes = id_codes(module_index, batch.state_module)
+        unit_codes = id_codes(unit_index, unit_ids)
+        state_unit_codes = id_codes(unit_index, state_unit_ids)
+
+        # Keep the last copy of readings sent more than once, by module and period start.
+        keys = (module_codes << 32) | readings["period_start"]
+        _, last = np.unique(keys[::-1], return_index=True)
+        if len(last) < len(keys):
+            keep = np.sort(len(keys) - 1 - last)
+            readings = {name: column[keep] for name, column in readings.items()}
+            module_codes, unit_codes = module_codes[keep], unit_codes[keep]
+
+        # State changes sent more than once are counted once, by module, state and timestamp.
+        state_timestamps = np.frombuffer(batch.state_timestamp, dtype=np.int64)
+        states = np.frombuffer(batch.state, dtype=np.int8).astype(np.int64)
+        keys = (state_module_codes << 33) | (states << 32) | state_timestamps
+        _, first = np.unique(keys, return_index=True)
+        if len(first) < len(keys):
+            keep = np.sort(first)
+            state_timestamps, state_module_codes, state_unit_codes = state_timestamps[keep], state_module_codes[keep], state_unit_codes[keep]
+
+        return [
+            Rollups.concatenate([self.rollup(level, list(index), codes, state_codes, readings, state_timestamps, resolution) for resolution in (HOUR, DAY)])
+            for level, index, codes, state_codes in (("module", module_index, module_codes, state_module_codes), ("unit", unit_index, unit_codes, state_unit_codes))
+        ]
+
+    async def flush(self):
+        """Roll up and write everything queued so far."""
+        async with self.flush_lock:
+            if not self.depth:
+                return
+
+            batch, unit_ids, state_unit_ids = self.batch, self.unit_ids, self.state_unit_ids
+            self.batch, self.unit_ids, self.state_unit_ids = ReadingBatch(), [], []
+
+            start = time.perf_counter()
+            with rollup_aggregate_time.time():
+                rollups = await asyncio.to_thread(self.aggregate, batch, unit_ids, state_unit_ids)
+            try:
+                with rollup_write_time.time():
+                    await self.flush_callback(rollups)
+            except Exception as e:
+                self.flush_failures += 1
+                logger.error("Failed to write the rollups of %d readings and %d state changes: %s", len(batch), batch.state_change_count, e)
+                self._requeue(batch, unit_ids, state_unit_ids)
+                return
+
+            self.last_flush_latency = time.perf_counter() - start
+            self.flushes += 1
+            self.readings_rolled_up += len(batch)
+            for level_rollups in rollups:
+                self.rows_written += len(level_rollups)
+                rollup_rows.labels(level_rollups.level).inc(len(level_rollups))
+
+    def _requeue(self, batch: ReadingBatch, unit_ids: List[str], state_unit_ids: List[str]):
+        """Put the readings of a failed flush back ahead of newer ones, if there is room."""
+        if self.depth + batch.row_count > self.max_rows:
+            self.rows_dropped += batch.row_count
+            logger.error("Dropped the rollups of %d rows after a failed flush, the rollup queue is full.", batch.row_count)
+            return
+
+        batch.append(self.batch)
+        self.batch = batch
+        self.unit_ids = unit_ids + self.unit_ids
+        self.state_unit_ids = state_unit_ids + self.state_unit_ids
+
+    async def _run(self):
+        while self.running:
+            try:
+                await asyncio.wait_for(self.flush_needed.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.flush_needed.clear()
+            await self.flush()
+
+    async def start(self):
+        if self.task is None:
+            # Bind the synchronisation primitives to the running loop.
+            self.flush_needed = asyncio.Event()
+            self.flush_lock = asyncio.Lock()
+            self.running = True
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the flush loop and write the rollups of any remaining readings."""
+        if self.task is not None:
+            self.running = False
+            self.flush_needed.set()
+            await self.task
+            self.task = None
+        await self.flush()
+
+    def stats(self) -> dict:
+        return {
+            "depth": self.depth,
+            "max_rows": self.max_rows,
+            "flushes": self.flushes,
+            "readings_rolled_up": self.readings_rolled_up,
+            "rows_written": self.rows_written,
+            "rows_dropped": self.rows_dropped,
+            "flush_failures": self.flush_failures,
+            "last_flush_latency": self.last_flush_latency,
+        }
+
+if __name__ == "__main__":
+    print(schema())
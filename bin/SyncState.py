@@ -0,0 +1,157 @@
+import hashlib, json
+from typing import Dict, List, Optional, Tuple
+
+from supabase import Client
+
+from models import ModuleRuleUpdate, RuleUpdateMessage, ScheduleUpdateMessage, TagList, TagUpdateMessage, UnitRuleUpdate
+
+APPEND = 0
+REPLACE = 1
+
+# Tracked kinds of unit state and the EgressMessage.type that updates each.
+SYNC_TYPES = {
+    "rules": 0,
+    "schedule": 1,
+    "tags": 4,
+}
+
+def content_hash(state: dict) -> str:
+    return hashlib.sha256(json.dumps(state, sort_keys=True, separators=(",", ":")).encode('utf-8')).hexdigest()
+
+def appended(previous: list, current: list) -> Optional[list]:
+    """Items appended to `previous` to give `current`, or None if `current` does not start with `previous`."""
+    if len(current) >= len(previous) and current[:len(previous)] == previous:
+        return current[len(previous):]
+    return None
+
+class SyncState:
+    """Full state of one kind (rules, schedule or tags) last delivered to a unit, and its version and content hash."""
+
+    def __init__(self, unit_id: str, kind: str, version: int = 0, hash: str = "", state: Optional[dict] = None):
+        self.unit_id = unit_id
+        self.kind = kind
+        self.version = version
+        self.hash = hash
+        self.state = state
+
+    def advance(self, state: dict) -> "SyncState":
+        """The next version, holding `state`."""
+        return SyncState(self.unit_id, self.kind, self.version + 1, content_hash(state), state)
+
+class SyncStateStore:
+    """Delivered sync states, kept in the `unit_sync_state` table:
+
+        unit_id text, kind text, version integer, hash text, state jsonb, primary key (unit_id, kind)
+
+    A unit without a row gets a full replace on its next sync. Methods block and are run on a worker thread.
+    """
+    def __init__(self, client: Client):
+        self.client = client
+
+    def load(self, kind: str, unit_ids: List[str]) -> Dict[str, SyncState]:
+        """States of the given units, including empty ones for units that have never been synced."""
+        states = {unit_id: SyncState(unit_id, kind) for unit_id in unit_ids}
+        rows = self.client.table("unit_sync_state").select("unit_id, version, hash, state").eq("kind", kind).in_("unit_id", unit_ids).execute()
+        for row in rows.data:
+            states[row["unit_id"]] = SyncState(row["unit_id"], kind, row["version"], row["hash"], row["state"])
+        return states
+
+    def save(self, states: List[SyncState]):
+        if states:
+            self.client.table("unit_sync_state").upsert([
+                {"unit_id": state.unit_id, "kind": state.kind, "version": state.version, "hash": state.hash, "state": state.state}
+                for state in states
+            ], on_conflict="unit_id,kind").execute()
+
+    def forget(self, kind: str, unit_ids: List[str]):
+        """Drop the states of units that were sent an update which cannot be tracked, so their next sync is a full replace."""
+        if unit_ids:
+            self.client.table("unit_sync_state").delete().eq("kind", kind).in_("unit_id", unit_ids).execute()
+
+def diff_rules(previous: Optional[dict], current: RuleUpdateMessage) -> Optional[RuleUpdateMessage]:
+    """Smallest RuleUpdateMessage that turns the previously delivered rule set into `current`, None if they are equal.
+
+    Rule lists that only gained rules at the end are appended, others are replaced. Modules that no longer exist are cleared.
+    """
+    if previous is None:
+        return current
+    previous = RuleUpdateMessage.model_validate(previous)
+
+    unit_rules = appended(previous.unit_rules.rules, current.unit_rules.rules)
+    unit_update = UnitRuleUpdate(action=APPEND, rules=unit_rules) if unit_rules is not None else current.unit_rules
+
+    previous_modules = {module.module_id: module.rules for module in previous.module_rules}
+    module_updates = []
+    for module in current.module_rules:
+        previous_rules = previous_modules.pop(module.module_id, None)
+        if previous_rules is None:
+            if module.rules:
+                module_updates.append(module)
+            continue
+        rules = appended(previous_rules, module.rules)
+        if rules is None:
+            module_updates.append(ModuleRuleUpdate(module_id=module.module_id, action=REPLACE, rules=module.rules))
+        elif rules:
+            module_updates.append(ModuleRuleUpdate(module_id=module.module_id, action=APPEND, rules=rules))
+    for module_id, rules in previous_modules.items():
+        if rules:
+            module_updates.append(ModuleRuleUpdate(module_id=module_id, action=REPLACE, rules=[]))
+
+    if unit_update.action == APPEND and not unit_update.rules and not module_updates:
+        return None
+    return RuleUpdateMessage(unit_rules=unit_update, module_rules=module_updates)
+
+def diff_schedule(previous: Optional[dict], current: ScheduleUpdateMessage) -> Optional[ScheduleUpdateMessage]:
+    """Smallest ScheduleUpdateMessage that turns the previously delivered schedule into the replace message `current`."""
+    if previous is None:
+        return current
+    items = appended(ScheduleUpdateMessage.model_validate(previous).schedule, current.schedule)
+    if items is None:
+        return current
+    return ScheduleUpdateMessage(action=APPEND, schedule=items) if items else None
+
+def diff_tags(previous: Optional[dict], current: TagUpdateMessage) -> Optional[TagUpdateMessage]:
+    """Smallest TagUpdateMessage that turns the previously delivered tags into the replace message `current`.
+
+    The action covers the whole message, so the tags are appended only when no module lost or reordered a tag.
+    """
+    if previous is None:
+        return current
+    previous_tags = {tag_list.module_id: tag_list.tags for tag_list in TagUpdateMessage.model_validate(previous).tags}
+    current_modules = {tag_list.module_id for tag_list in current.tags}
+    if any(tags and module_id not in current_modules for module_id, tags in previous_tags.items()):
+        return current
+
+    additions = []
+    for tag_list in current.tags:
+        tags = appended(previous_tags.get(tag_list.module_id, []), tag_list.tags)
+        if tags is None:
+            return current
+        if tags:
+            additions.append(TagList(module_id=tag_list.module_id, tags=tags))
+    return TagUpdateMessage(action=APPEND, tags=additions) if additions else None
+
+def apply_append(kind: str, previous: Optional[dict], update: dict) -> Optional[dict]:
+    """State after an append-only schedule or tag update was delivered on top of `previous`, None if it is unknown."""
+    if previous is None:
+        return None
+    if kind == "schedule":
+        return {"action": REPLACE, "schedule": previous["schedule"] + update["schedule"]}
+    tags = {tag_list["module_id"]: list(tag_list["tags"]) for tag_list in previous["tags"]}
+    for tag_list in update["tags"]:
+        tags.setdefault(tag_list["module_id"], []).extend(tag_list["tags"])
+    return {"action": REPLACE, "tags": [{"module_id": module_id, "tags": module_tags} for module_id, module_tags in tags.items()]}
+
+DIFFS = {
+    "rules": diff_rules,
+    "schedule": diff_schedule,
+    "tags": diff_tags,
+}
+
+def delta(state: SyncState, current) -> Tuple[Optional[object], SyncState]:
+    """Update to send for a full replace message of `state.kind`, or None if the unit already has it, and the state after delivery."""
+    current_state = current.model_dump()
+    next_state = state.advance(current_state)
+    if next_state.hash == state.hash:
+        return None, state
+    return DIFFS[state.kind](state.state, current), next_state
@@ -0,0 +1,86 @@
+import asyncio, time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable, Optional
+
+class TTLCache:
+    """Bounded in-process cache whose entries expire `ttl` seconds after they were loaded.
+
+    `get_or_load` is single-flight: concurrent requests for a missing key share one call of the loader.
+    Failed loads are not cached.
+    """
+    def __init__(self, ttl: float = 300.0, max_entries: int = 10000):
+        self.ttl = float(ttl)
+        self.max_entries = int(max_entries)
+        self.entries: OrderedDict[Hashable, tuple] = OrderedDict()
+        self.pending: dict[Hashable, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.shared_loads = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    def put(self, key: Hashable, value: Any):
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    async def get_or_load(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> Any:
+        value = self.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+
+        # Somebody is already loading this key, wait for their result.
+        future = self.pending.get(key)
+        if future is not None:
+            self.shared_loads += 1
+            return await asyncio.shield(future)
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self.pending[key] = future
+        try:
+            value = await loader()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception() # Mark the exception as retrieved when nobody else was waiting.
+            raise
+        finally:
+            # An invalidation while loading replaces or removes the pending future; the result is then stale and not stored.
+            is_current = self.pending.get(key) is future
+            if is_current:
+                del self.pending[key]
+
+        if is_current:
+            self.put(key, value)
+        future.set_result(value)
+        return value
+
+    def invalidate(self, key: Optional[Hashable] = None):
+        """Drop one key, or everything when no key is given."""
+        if key is None:
+            self.entries.clear()
+            self.pending.clear()
+        else:
+            self.entries.pop(key, None)
+            self.pending.pop(key, None)
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "shared_loads": self.shared_loads,
+        }
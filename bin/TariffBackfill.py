@@ -0,0 +1,128 @@
+"""
+Reprices stored readings at the tariff of their unit, for readings stored before the unit's tariff changed or before
+pricing was enabled. Readings are read and updated in chunks of `backfill_chunk_size`, each chunk priced in one
+vectorised call and written back in one UPDATE, only touching readings whose cost changes.
+
+Usage: python -m bin.TariffBackfill --unit UNIT [--unit UNIT ...] [--since 2024-01-01]
+       python -m bin.TariffBackfill --all
+Reads [STORAGE] postgres_dsn and the [TARIFF] section of configuration.ini. Needs the psycopg and numpy packages.
+
+Readings are priced at EXTRACT(EPOCH FROM period_start_time), the same unix time ingest prices them at. Readings
+stored by an API server whose time zone was not UTC, before timestamps were written in UTC, hold its local time
+labelled +00; shift them back by that offset before repricing them.
+"""
+import argparse, configparser, datetime, logging
+from typing import List, Optional, Tuple
+
+try:
+    import psycopg
+except ImportError: # Optional dependency, only needed for the postgres storage backend and repricing.
+    psycopg = None
+
+import numpy as np
+
+from bin.LogConfig import configure_logging
+from bin.TariffTable import TariffCache, TariffTable
+from models import TOUSchedule
+
+logger = logging.getLogger(__name__)
+
+SELECT_CHUNK = """
+    SELECT r.module_id, r.period_start_time, EXTRACT(EPOCH FROM r.period_start_time)::bigint, r.kwh_usage
+    FROM readings r JOIN modules m ON m.id = r.module_id
+    WHERE m.unit_id = %(unit_id)s AND r.period_start_time >= %(since)s {after}
+    ORDER BY r.module_id, r.period_start_time
+    LIMIT %(limit)s
+"""
+
+# Keyset condition of every chunk after the first.
+AFTER = "AND (r.module_id, r.period_start_time) > (%(module_id)s, %(period_start_time)s)"
+
+UPDATE_CHUNK = """
+    UPDATE readings r SET cost = v.cost
+    FROM unnest(%s, %s, %s::double precision[]) AS v(module_id, period_start_time, cost)
+    WHERE r.module_id = v.module_id AND r.period_start_time = v.period_start_time AND r.cost IS DISTINCT FROM v.cost
+"""
+
+class TariffBackfill:
+    """Reprices the readings of units over a native Postgres connection, one transaction per chunk."""
+
+    def __init__(self, dsn: str, utc_offset: int = 0, chunk_size: int = 50000):
+        if psycopg is None:
+            raise RuntimeError("Repricing readings requires the psycopg[binary] package.")
+
+        self.connection = psycopg.connect(dsn)
+        self.tables = TariffCache(utc_offset=utc_offset)
+        self.chunk_size = int(chunk_size)
+
+    def tariffs(self, unit_ids: Optional[List[str]] = None) -> List[Tuple[str, str, TOUSchedule]]:
+        """(unit id, hash, schedule) of the given units, or of every unit with a tariff."""
+        query = "SELECT unit_id, hash, schedule FROM unit_tariffs"
+        if unit_ids is None:
+            rows = self.connection.execute(query).fetchall()
+        else:
+            rows = self.connection.execute(query + " WHERE unit_id = ANY(%s)", (unit_ids,)).fetchall()
+            missing = set(unit_ids) - {row[0] for row in rows}
+            if missing:
+                logger.warning("No tariff was sent to %s, their readings are left as they are.", ", ".join(sorted(missing)))
+        self.connection.commit()
+        return [(unit_id, hash, TOUSchedule.model_validate(schedule)) for unit_id, hash, schedule in rows]
+
+    def reprice(self, unit_id: str, table: TariffTable, since: datetime.datetime) -> Tuple[int, int]:
+        """Reprice the readings of a unit from `since` on. Returns the readings read and the readings whose cost changed."""
+        parameters = {"unit_id": unit_id, "since": since, "limit": self.chunk_size}
+        query = SELECT_CHUNK.format(after="")
+        read = changed = 0
+
+        while True:
+            with self.connection.transaction(), self.connection.cursor() as cursor:
+                rows = cursor.execute(query, parameters).fetchall()
+                if not rows:
+                    break
+                module_ids, period_starts, timestamps, kwh_usage = zip(*rows)
+                costs = table.price(np.array(timestamps, dtype=np.int64), np.array(kwh_usage, dtype=np.float64))
+                cursor.execute(UPDATE_CHUNK, (list(module_ids), list(period_starts), [None if cost != cost else cost for cost in costs.tolist()]))
+                changed += cursor.rowcount
+
+            read += len(rows)
+            logger.info("Unit %s: %d readings read, %d repriced.", unit_id, read, changed)
+            parameters.update(module_id=module_ids[-1], period_start_time=period_starts[-1])
+            query = SELECT_CHUNK.format(after=AFTER)
+
+        return read, changed
+
+    def run(self, unit_ids: Optional[List[str]] = None, since: Optional[datetime.datetime] = None):
+        since = since or datetime.datetime.min.replace(tzinfo=datetime.timezone.utc)
+        for unit_id, hash, schedule in self.tariffs(unit_ids):
+            read, changed = self.reprice(unit_id, self.tables.get(schedule, hash), since)
+            logger.info("Unit %s done: %d of %d readings repriced.", unit_id, changed, read)
+
+    def close(self):
+        self.connection.close()
+
+def run_backfill():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    units = parser.add_mutually_exclusive_group(required=True)
+    units.add_argument("--unit", action="append", dest="unit_ids", help="Unit to reprice, may be given many times.")
+    units.add_argument("--all", action="store_true", help="Reprice every unit with a tariff.")
+    parser.add_argument("--since", type=datetime.date.fromisoformat, help="Only reprice readings from this date on.")
+    parser.add_argument("--chunk-size", type=int, help="Readings per query, overrides [TARIFF] backfill_chunk_size.")
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read("configuration.ini")
+    configure_logging(config)
+
+    backfill = TariffBackfill(
+        config["STORAGE"]["postgres_dsn"],
+        utc_offset=config.getint("TARIFF", "utc_offset", fallback=0),
+        chunk_size=args.chunk_size or config.getint("TARIFF", "backfill_chunk_size", fallback=50000),
+    )
+    since = datetime.datetime.combine(args.since, datetime.time(), datetime.timezone.utc) if args.since else None
+    try:
+        backfill.run(None if args.all else args.unit_ids, since)
+    finally:
+        backfill.close()
+
+if __name__ == "__main__":
+    run_backfill()
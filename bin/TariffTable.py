@@ -0,0 +1,184 @@
+import datetime, threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+try:
+    import numpy as np
+except ImportError: # Optional dependency, only needed to price readings on the server.
+    np = None
+
+from supabase import Client
+
+from bin.SyncState import content_hash
+from models import TOUSchedule
+
+# Days of the week as TOUPeriodPrice.days and PublicHoliday.treat_as number them.
+SUNDAY = 1
+SATURDAY = 7
+
+def day_of_week(date: datetime.date) -> int:
+    """1 for Sunday through 7 for Saturday."""
+    return (date.weekday() + 1) % 7 + 1
+
+def in_season(month: int, day: int, start: Tuple[int, int], end: Tuple[int, int]) -> bool:
+    """Whether a date falls in a season from `start` to `end`, both (month, day) and inclusive. Seasons may wrap over the new year."""
+    if start <= end:
+        return start <= (month, day) <= end
+    return (month, day) >= start or (month, day) <= end
+
+class TariffTable:
+    """A TOUSchedule compiled into dense rate tables, one per year, indexed by (day of year - 1, hour).
+
+    A rate is the price of the hour's TOU period, or the season's base price in hours without one. Hours run from
+    `start` up to but excluding `end`; periods with `end <= start` wrap past midnight. Where periods overlap, the
+    later one in `tou_prices` wins. Public holidays are folded in by pricing the date as its `treat_as` day. Dates in
+    no season, and seasons without a base price, have a rate of NaN, so their cost is NaN as well.
+
+    Schedules are in local time, `utc_offset` seconds ahead of UTC. Year tables are built on first use.
+    """
+    def __init__(self, schedule: TOUSchedule, utc_offset: int = 0):
+        if np is None:
+            raise RuntimeError("Pricing readings requires the numpy package.")
+
+        self.utc_offset = int(utc_offset)
+        self.seasons = [((season.start_date.month, season.start_date.day), (season.end_date.month, season.end_date.day)) for season in schedule.seasons]
+        self.holidays = {datetime.date(holiday.year, holiday.month, holiday.day): holiday.treat_as for holiday in schedule.public_holidays}
+
+        # The 24 hourly rates of every season and day of the week, which whole years are assembled from.
+        names = {season.name: index for index, season in enumerate(schedule.seasons)}
+        self.day_rates = np.full((len(self.seasons) + 1, SATURDAY + 1, 24), np.nan)
+        for base in schedule.base_prices:
+            if base.season in names:
+                self.day_rates[names[base.season], :, :] = base.price
+        for period in schedule.tou_prices:
+            if period.season not in names:
+                continue
+            rates = self.day_rates[names[period.season]]
+            for day in period.days:
+                for hours in period.times:
+                    if hours.end > hours.start:
+                        rates[day, hours.start:hours.end] = period.price
+                    else:
+                        rates[day, hours.start:] = period.price
+                        rates[day, :hours.end] = period.price
+
+        self.years: Dict[int, "np.ndarray"] = {}
+        self.lock = threading.Lock()
+
+    def compile_year(self, year: int) -> "np.ndarray":
+        """The (366, 24) rates of a year. The last row is NaN in years of 365 days."""
+        first = datetime.date(year, 1, 1)
+        days = (datetime.date(year + 1, 1, 1) - first).days
+        season_index = np.full(366, len(self.seasons)) # The extra season row is all NaN.
+        weekday = np.zeros(366, dtype=np.intp)
+
+        for offset in range(days):
+            date = first + datetime.timedelta(days=offset)
+            weekday[offset] = self.holidays.get(date) or day_of_week(date)
+            for index, (start, end) in enumerate(self.seasons):
+                if in_season(date.month, date.day, start, end):
+                    season_index[offset] = index
+                    break
+
+        return self.day_rates[season_index, weekday]
+
+    def year(self, year: int) -> "np.ndarray":
+        table = self.years.get(year)
+        if table is None:
+            with self.lock:
+                table = self.years.get(year)
+                if table is None:
+                    table = self.years[year] = self.compile_year(year)
+        return table
+
+    def rates(self, timestamps) -> "np.ndarray":
+        """Rates at an array of unix timestamps, in seconds."""
+        local = np.asarray(timestamps, dtype=np.int64) + self.utc_offset
+        if local.size == 0:
+            return np.empty(local.shape)
+
+        days = (local // 86400).astype("datetime64[D]")
+        year_start = days.astype("datetime64[Y]")
+        day_of_year = (days - year_start.astype("datetime64[D]")).astype(np.intp)
+        hour = (local % 86400 // 3600).astype(np.intp)
+
+        year = year_start.astype(np.int64) + 1970
+        first, last = int(year.min()), int(year.max())
+        if first == last:
+            return self.year(first)[day_of_year, hour]
+        tables = np.stack([self.year(index) for index in range(first, last + 1)])
+        return tables[year - first, day_of_year, hour]
+
+    def price(self, timestamps, kwh) -> "np.ndarray":
+        """Cost of consuming `kwh` at `timestamps`, element by element, at the rate of the hour each timestamp falls in."""
+        return self.rates(timestamps) * np.asarray(kwh, dtype=np.float64)
+
+class TariffCache:
+    """LRU cache of compiled TariffTables keyed by the content hash of their schedule, so units on one tariff share a table."""
+
+    def __init__(self, max_entries: int = 256, utc_offset: int = 0):
+        if np is None:
+            raise RuntimeError("Pricing readings requires the numpy package.")
+
+        self.max_entries = int(max_entries)
+        self.utc_offset = int(utc_offset)
+        self.entries: OrderedDict[str, TariffTable] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(schedule: TOUSchedule) -> str:
+        return content_hash(schedule.model_dump())
+
+    def get(self, schedule: TOUSchedule, key: Optional[str] = None) -> TariffTable:
+        """Compiled table of a schedule. Pass `key` when the schedule's hash is already known."""
+        key = key or self.key(schedule)
+        with self.lock:
+            table = self.entries.get(key)
+            if table is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return table
+            self.misses += 1
+
+        table = TariffTable(schedule, self.utc_offset)
+        with self.lock:
+            self.entries[key] = table
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return table
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+class TariffStore:
+    """The TOU schedule last sent to each unit, which its readings are priced against, kept in the `unit_tariffs` table:
+
+        unit_id text primary key, hash text, schedule jsonb, updated timestamptz
+
+    Methods block and are run on a worker thread.
+    """
+    def __init__(self, client: Client):
+        self.client = client
+
+    def load(self, unit_id: str) -> Optional[Tuple[str, TOUSchedule]]:
+        """Hash and schedule of a unit's tariff, None if it has never been sent one."""
+        rows = self.client.table("unit_tariffs").select("hash, schedule").eq("unit_id", unit_id).execute()
+        if not rows.data:
+            return None
+        return rows.data[0]["hash"], TOUSchedule.model_validate(rows.data[0]["schedule"])
+
+    def save(self, unit_ids: List[str], schedule: TOUSchedule):
+        if unit_ids:
+            hash = TariffCache.key(schedule)
+            state = schedule.model_dump()
+            updated = datetime.datetime.now(datetime.timezone.utc).isoformat()
+            self.client.table("unit_tariffs").upsert([
+                {"unit_id": unit_id, "hash": hash, "schedule": state, "updated": updated}
+                for unit_id in unit_ids
+            ], on_conflict="unit_id").execute()
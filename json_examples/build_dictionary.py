@@ -0,0 +1,38 @@
+"""
+Builds a shared compression dictionary (see bin/CompressionProfiles.SchemaDictionary) from the json_examples corpus
+and the field names in models.py.
+
+Usage: python json_examples/build_dictionary.py <id>
+Writes bin/dictionaries/sdr_<id>.json. Never change a published dictionary, build a new id instead.
+"""
+import collections, glob, json, os, re, sys
+
+MAX_TOKENS = 28 # Number of free control character codes.
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+dictionary_id = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+
+counts = collections.Counter()
+
+# Keys as they appear in the example messages. Some examples are not strictly valid JSON, so scan the text.
+for path in glob.glob(os.path.join(root, "json_examples", "*.json")):
+    with open(path) as file:
+        for key in re.findall(r'"(\w+)"\s*:', file.read()):
+            counts[key] += 1
+
+# Field names of the pydantic models, so keys missing from the examples are still covered.
+with open(os.path.join(root, "models.py")) as file:
+    for key in re.findall(r'^\s+(\w+): ', file.read(), re.MULTILINE):
+        counts[key] += 1
+
+# Keys are serialised compactly by pydantic and the units, so the token includes the quotes and colon.
+tokens = ['"' + key + '":' for key in counts]
+tokens.sort(key=lambda token: counts[token[1:-2]] * (len(token) - 1), reverse=True)
+tokens = tokens[:MAX_TOKENS]
+
+output = os.path.join(root, "bin", "dictionaries", "sdr_" + str(dictionary_id) + ".json")
+os.makedirs(os.path.dirname(output), exist_ok=True)
+with open(output, "w") as file:
+    json.dump({"id": dictionary_id, "tokens": tokens}, file, indent=4)
+
+print("Wrote " + str(len(tokens)) + " tokens to " + output)
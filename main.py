@@ -1,4 +1,5 @@
 from fastapi import FastAPI, HTTPException, status, Response, Depends, Request
+from fastapi.responses import PlainTextResponse
 from pydantic import BaseModel
 from starlette.background import BackgroundTask
 from fastapi.routing import APIRoute
@@ -7,10 +8,30 @@ from starlette.background import BackgroundTask
 from fastapi.middleware.cors import CORSMiddleware
 from supabase import Client, create_client
 
-import brotli, base64, datetime, json, time, logging, configparser, logging
-import requests
-
-from auth import JWTBearer, encode_jwt, BrokerJWTBearer, encode_broker_jwt
+import base64, contextlib, json, time, logging, configparser, logging, asyncio, weakref
+import httpx
+from typing import Optional
+
+from auth import JWTBearer, encode_jwt, BrokerJWTBearer, encode_broker_jwt, token_cache
+from bin.BrokerPublisher import BrokerPublisher
+from bin.PayloadCache import PayloadCache
+from bin.CompressionExecutor import CompressionExecutor, brotli_decompress_b64_chunks
+from bin.CompressionProfiles import CompressionProfile, PROFILES, EGRESS_TYPE_NAMES
+from bin.ReadingBuffer import ReadingBuffer, BufferFullError
+from bin.ReadingBatch import ReadingBatch
+from bin.IngressStreamParser import IngressStreamParser
+from bin.ReadingCodec import ENCODING_BROTLI_JSON, ENCODING_BINARY, decode_reading_batch_b64
+from bin.ReadingStore import ReadingStore, SupabaseReadingStore
+from bin.TTLCache import TTLCache
+from bin.Metrics import registry, RATIO_BUCKETS
+from bin.LogConfig import configure_logging, payload_log
+from bin.EgressScheduler import EgressScheduler
+from bin.EgressOutbox import EgressOutbox
+from bin.CircuitBreaker import CircuitBreaker
+from bin.TariffTable import TariffCache, TariffStore, TariffTable
+from bin.RollupEngine import RollupEngine, Rollups
+from bin.DedupIndex import DedupIndex
+from bin.SyncState import SyncState, SyncStateStore, SYNC_TYPES, REPLACE, apply_append, delta
 
 from models import (
     MQTTDataPacket,
@@ -25,15 +46,19 @@ from models import (
     RuleUpdateMessage,
     DeviceRule,
     ModuleRuleUpdate,
+    UnitRuleUpdate,
     StateChangeItem,
     ScheduleUpdateMessage,
     ScheduleItem,
     ControlUnitParameters,
     TOUSchedule,
-    TagUpdateMessage
+    TagUpdateMessage,
+    BulkEgressRequest,
+    UnitSelector,
+    SyncRequest
 )
 
-logging.basicConfig(filename='info.log', level=logging.DEBUG)
+logger = logging.getLogger("main")
 
 app = FastAPI()
 
@@ -61,20 +86,114 @@ api_port: str
 supabase_client: Client
 emqx_headers: str
 emqx_broker_url: str
+broker_publisher: BrokerPublisher
+payload_cache: PayloadCache
+compression_executor: CompressionExecutor
+compression_profiles: dict[int, CompressionProfile]
+reading_buffer: ReadingBuffer
+reading_store: ReadingStore
+sync_chunk_size: int
+egress_scheduler: EgressScheduler
+egress_outbox: Optional[EgressOutbox]
+sync_delta: bool
+sync_state: SyncStateStore
+stream_threshold: int
+stream_batch_rows: int
+stream_chunk_size: int
+broker_cache: TTLCache
+acl_cache: TTLCache
+tariff_cache: TTLCache
+tariff_tables: Optional[TariffCache]
+tariff_store: TariffStore
+rollup_engine: Optional[RollupEngine]
+dedup_index: Optional[DedupIndex]
+
+# Locks of units whose sync or tariff state is being sent and recorded, by (kind, unit id). Per process.
+unit_locks: "weakref.WeakValueDictionary[tuple[str, str], asyncio.Lock]" = weakref.WeakValueDictionary()
+
+# Pipeline metrics, served by /metrics. Children of labelled metrics that are used on every message are looked up once here.
+ingress_stage_seconds = registry.histogram("ingress_stage_seconds", "Time spent in each stage of ingress processing.", ["stage"])
+ingress_base64_time = ingress_stage_seconds.labels("base64_decode")
+ingress_decompress_time = ingress_stage_seconds.labels("decompress")
+ingress_validate_time = ingress_stage_seconds.labels("validate")
+ingress_rows_time = ingress_stage_seconds.labels("row_build")
+ingress_binary_time = ingress_stage_seconds.labels("binary_decode")
+ingress_stream_time = ingress_stage_seconds.labels("stream")
+ingress_price_time = ingress_stage_seconds.labels("price")
+ingress_messages = registry.counter("ingress_messages_total", "Ingress messages by data type and encoding.", ["type", "encoding"])
+ingress_received_bytes = registry.counter("ingress_received_bytes_total", "Bytes of ingress payloads as received, after base64 decoding.")
+ingress_decompressed_bytes = registry.counter("ingress_decompressed_bytes_total", "Bytes of ingress payloads after decompression.")
+ingress_compression_ratio = registry.histogram("ingress_compression_ratio", "Decompressed over compressed size of ingress payloads.", buckets=RATIO_BUCKETS)
+ingress_errors = registry.counter("ingress_errors_total", "Ingress messages that were not queued.", ["reason"])
+ingress_duplicates = registry.counter("ingress_duplicates_total", "Retransmitted packets, readings and state changes dropped by the dedup index.", ["kind"])
+ingress_unpriced = registry.counter("ingress_unpriced_readings_total", "Readings queued without a cost, as their unit has no tariff or it failed to load.")
+
+egress_stage_seconds = registry.histogram("egress_stage_seconds", "Time spent in each stage of egress processing.", ["stage"])
+egress_serialize_time = egress_stage_seconds.labels("serialize")
+egress_compress_time = egress_stage_seconds.labels("compress")
+egress_messages = registry.counter("egress_messages_total", "Egress messages by type.", ["type"])
+egress_payload_bytes = registry.counter("egress_payload_bytes_total", "Bytes of serialized egress messages.")
+egress_sent_bytes = registry.counter("egress_sent_bytes_total", "Bytes of compressed egress payloads handed to the broker.")
+egress_compression_ratio = registry.histogram("egress_compression_ratio", "Serialized over compressed size of egress payloads, payload cache hits excluded.", buckets=RATIO_BUCKETS)
+egress_errors = registry.counter("egress_errors_total", "Egress messages that were not delivered.", ["reason"])
+
+db_query_seconds = registry.histogram("db_query_seconds", "Time of each database call.", ["query"])
+db_errors = registry.counter("db_errors_total", "Database calls that raised.", ["query"])
+
+def unwrap_message(message: str) -> tuple[str, int, int]:
+    """Split a message into its payload, encoding (`MQTTDataPacket.e`) and shared dictionary id."""
+    # Messages in another encoding than plain brotli JSON arrive wrapped in an MQTTDataPacket envelope.
+    # Plain messages are bare base64, which never starts with a brace.
+    if message.startswith("{"):
+        packet = MQTTDataPacket.model_validate_json(message)
+        if packet.e not in (ENCODING_BROTLI_JSON, ENCODING_BINARY):
+            raise ValueError(f"Unsupported encoding: {packet.e}")
+        return packet.m, packet.e, packet.d
+
+    return message, ENCODING_BROTLI_JSON, 0
+
+def get_compression_profile(message_type: int) -> CompressionProfile:
+    return compression_profiles.get(message_type, PROFILES["default"])
+
+async def compress_message(message: str, profile: CompressionProfile = PROFILES["default"]) -> str:
+    data = message.encode('utf-8')
+
+    # Identical payloads are re-sent to many units, so look up the compressed form by content first.
+    key = payload_cache.key(profile.name.encode() + b"\0" + data)
+    ret = payload_cache.get(key)
+    if ret is None:
+        start = time.perf_counter()
+        ret = await compression_executor.compress(data, profile)  # Compress the utf-8 bytes off the event loop and return them as a base64 string.
+        egress_compress_time.observe(time.perf_counter() - start)
+        egress_compression_ratio.observe(len(data) / (len(ret) * 3 / 4))
+
+        # The receiver needs the dictionary id to reverse the dictionary, so send such messages in an envelope.
+        if profile.dictionary_id:
+            ret = MQTTDataPacket(e=0, m=ret, d=profile.dictionary_id).model_dump_json()
+
+        payload_cache.put(key, ret)
+    return ret
 
-async def decompress_message_brotli(message: str) -> str:
-    logging.info("Decompressing: " + message)
-    return str(brotli.decompress(base64.b64decode(message)).decode('utf-8'))
+async def encode_egress(message: EgressMessage) -> str:
+    """Serialize and compress an egress message with the profile of its type."""
+    start = time.perf_counter()
+    message_str = message.model_dump_json()
+    egress_serialize_time.observe(time.perf_counter() - start)
 
-async def compress_message(message: str) -> MQTTDataPacket:
-    ret = str(base64.b64encode(brotli.compress(message.encode('utf-8'))).decode('UTF-8'))  # Encode the message with utf-8, compress it, then convert the bytes to base64, and return a string of it.
-    return ret
+    payload = await compress_message(message_str, get_compression_profile(message.type))
+    egress_messages.labels(message.type).inc()
+    egress_payload_bytes.inc(len(message_str))
+    egress_sent_bytes.inc(len(payload))
+    return payload
 
 async def publish_message(topic: str, message: EgressMessage):
     """Publish a message to the provided topic. Compresses and formats the message accordingly"""
 
-    message_str = message.model_dump_json()
-    payload = await compress_message(message_str)
+    # Hold the message briefly, so rapid updates to the same unit are merged into one publish.
+    if egress_scheduler.enabled:
+        return await egress_scheduler.submit(topic, message)
+
+    payload = await encode_egress(message)
 
     request_data = BrokerPublishMessage(
         payload_encoding="plain",
@@ -84,28 +203,59 @@ async def publish_message(topic: str, message: EgressMessage):
         retain=False,
     )
 
-    # Send message to broker with post request
-    result = requests.post(emqx_broker_url, json = request_data.model_dump(), headers=emqx_headers)
-    
+    # Hand the message to the outbox, which delivers it once the broker is reachable.
+    if egress_outbox is not None:
+        return (await deliver([request_data]))[0]
+
+    # Send message to broker through the pooled publisher.
+    try:
+        result = await broker_publisher.publish(request_data)
+    except httpx.HTTPError as e:
+        logger.error("Failed to reach broker: %s", e)
+        egress_errors.labels("broker_unreachable").inc()
+        return {"result" : "fail", "message" : "Failed to deliver the message to subscriber(s)"}
+
     if (result.status_code == 200):
         return {"result" : "ok", "message" : "The message was delivered to at least one subscriber."}
     if (result.status_code == 202):
         return {"result" : "ok", "message" : "No matched subscribers."}
     if (result.status_code == 400):
+        egress_errors.labels("invalid").inc()
         raise HTTPException(status_code=result.status_code, detail={"result" : "fail", "message" : "Message is invalid."})
-    logging.log(1, "code: " + str(result.status_code))
+    logger.debug("Broker returned %d.", result.status_code)
+    egress_errors.labels("broker_status").inc()
     return {"result" : "fail", "message" : "Failed to deliver the message to subscriber(s)"}
 
+async def deliver(messages: list[BrokerPublishMessage]) -> list[dict]:
+    """Queue messages in the egress outbox, or publish them through the broker's bulk API when it is disabled. Returns a status per message."""
+    if egress_outbox is None:
+        return await broker_publisher.publish_bulk(messages)
 
-async def get_acl(unit_id: str) -> ACL:
-    """Get the assosciated Access Control List for the control unit."""
+    await egress_outbox.put(messages)
+    return [{"result" : "ok", "message" : "Queued for delivery."} for _ in messages]
+
+
+async def run_query(name: str, function, *args):
+    """Run a blocking database call on a worker thread, timing it as query `name`."""
+    start = time.perf_counter()
+    try:
+        return await asyncio.to_thread(function, *args)
+    except Exception:
+        db_errors.labels(name).inc()
+        raise
+    finally:
+        db_query_seconds.labels(name).observe(time.perf_counter() - start)
+
+async def load_acl(unit_id: str) -> ACL:
+    """Query the assosciated Access Control List for the control unit."""
 
     # Fetch topic info for the unit.
-    data = supabase_client.table("topic_allocations").select("unit_id, ingress, all, topics(topic)").eq("unit_id", unit_id).execute()
+    data = await run_query("load_acl",
+        supabase_client.table("topic_allocations").select("unit_id, ingress, all, topics(topic)").eq("unit_id", unit_id).execute
+    )
 
-    if (not data):
+    if (not data.data):
         raise HTTPException(status_code=status.HTTP_406_NOT_ACCEPTABLE, detail="Not provisioned.")
-    print(data.data)
 
     # Arrange the topics into the ACL format
     all_topics = []
@@ -123,39 +273,73 @@ async def get_acl(unit_id: str) -> ACL:
                 
     return ACL(pub=pub_topics, sub=sub_topics, all=all_topics)
 
+async def get_acl(unit_id: str) -> ACL:
+    """Get the assosciated Access Control List for the control unit. Cached for `acl_ttl` seconds."""
+    return await acl_cache.get_or_load(unit_id, lambda: load_acl(unit_id))
+
+async def load_broker_info(unit_id: str) -> dict:
+    """Query the address and port of the broker the control unit is assigned to."""
+    broker_info = await run_query("load_broker_info",
+        supabase_client.table("control_units").select("id, brokers(address, port)").eq("id", unit_id).single().execute
+    )
+    if (not broker_info.data or not broker_info.data["brokers"]):
+        raise HTTPException(status_code=status.HTTP_406_NOT_ACCEPTABLE, detail="Not provisioned.")
+    return broker_info.data["brokers"]
+
+async def get_broker_info(unit_id: str) -> dict:
+    """Get the broker the control unit is assigned to. Cached for `broker_ttl` seconds."""
+    return await broker_cache.get_or_load(unit_id, lambda: load_broker_info(unit_id))
+
+def invalidate_unit_cache(unit_id: str | None = None):
+    """Drop the cached broker and ACL of a unit, or of every unit. Call after changing a unit's broker or topic allocations."""
+    broker_cache.invalidate(unit_id)
+    acl_cache.invalidate(unit_id)
+
 @app.get("/mqtt/v1/auth", dependencies=[Depends(JWTBearer())])
 async def create_unit_token(user_id: str, unit_id: str) -> str:
     """ Creates an MQTT access token for a control unit. Assosciates the unit with a user, and queries the database for assigned topics. Raises a 406 error if no topics are provisioned for t>
     """
-    # Assign the unit to the user.
-    supabase_client.table("control_units").update(
-        {
-            "user_id" : user_id,
-        }
-    ).eq("id", unit_id).execute()
-
-    broker_info = supabase_client.table("control_units").select("id, brokers(address, port)").eq("id", unit_id).single().execute()
-    if (not broker_info):
-        raise HTTPException(status_code=status.HTTP_406_NOT_ACCEPTABLE, detail="Not provisioned.")
-    print(broker_info)        
+    # Assign the unit to the user, while looking up its broker and topics.
+    assign_user = run_query("assign_user",
+        supabase_client.table("control_units").update(
+            {
+                "user_id" : user_id,
+            }
+        ).eq("id", unit_id).execute
+    )
+
+    _, broker, acl = await asyncio.gather(assign_user, get_broker_info(unit_id), get_acl(unit_id))
+
     ret = ControlUnitJWTInfo(
-        address=broker_info.data["brokers"]["address"],
-        port=broker_info.data["brokers"]["port"],
+        address=broker["address"],
+        port=broker["port"],
         exp=int(time.time() + 3600 * 24 * 365 * 10), # Expire after 10 years.
-        acl=await get_acl(unit_id)
+        acl=acl
     )
 
     return encode_broker_jwt(ret.model_dump())
 
+@app.post("/mqtt/v1/cache/invalidate", dependencies=[Depends(JWTBearer())])
+async def invalidate_cache(unit_id: str | None = None):
+    """Drop cached broker and ACL lookups for one unit, or for all units when no unit_id is given."""
+    invalidate_unit_cache(unit_id)
+    return {"result" : "ok", "message" : "Cache invalidated."}
+
 
 @app.post("/mqtt/v1/schedule", dependencies=[Depends(JWTBearer())])
-async def send_schedule(unit_id: str, payload: ScheduleUpdateMessage):
+async def send_schedule(unit_id: str, payload: ScheduleUpdateMessage, full: bool = False):
+    if payload.action == REPLACE:
+        return (await sync_units("schedule", {unit_id: payload}, full))[0]
+
     to_send = EgressMessage(
         type=1,
         data=payload
     )
 
-    return await publish_message("/egress/" + unit_id, to_send)
+    async with locked_units("schedule", [unit_id]):
+        result = await publish_message("/egress/" + unit_id, to_send)
+        await record_append("schedule", unit_id, payload, result)
+    return result
 
 @app.post("/mqtt/v1/parameters", dependencies=[Depends(JWTBearer())])
 async def send_parameters(unit_id: str, payload: ControlUnitParameters):
@@ -173,7 +357,11 @@ async def send_rules(unit_id: str, payload: RuleUpdateMessage):
         data=payload
     )
 
-    return await publish_message("/egress/" + unit_id, to_send)
+    async with locked_units("rules", [unit_id]):
+        result = await publish_message("/egress/" + unit_id, to_send)
+        # Hand-written rule updates are not tracked, the next sync sends the unit's full rule set.
+        await forget_sync_state("rules", [unit_id])
+    return result
 
 @app.post("/mqtt/v1/tou", dependencies=[Depends(JWTBearer())])
 async def send_tou_structure(unit_id: str, payload: TOUSchedule):
@@ -182,128 +370,567 @@ async def send_tou_structure(unit_id: str, payload: TOUSchedule):
         data=payload
     )
 
-    return await publish_message("/egress/" + unit_id, to_send)
+    async with locked_units("tariff", [unit_id]):
+        result = await publish_message("/egress/" + unit_id, to_send)
+        if result["result"] == "ok":
+            await record_tariff([unit_id], payload)
+    return result
 
 @app.post("/mqtt/v1/tags", dependencies=[Depends(JWTBearer())])
-async def send_tags(unit_id:str, payload: TagUpdateMessage):
+async def send_tags(unit_id:str, payload: TagUpdateMessage, full: bool = False):
+    if payload.action == REPLACE:
+        return (await sync_units("tags", {unit_id: payload}, full))[0]
+
     to_send = EgressMessage(
         type=4,
         data=payload
     )
 
-    return await publish_message("/egress/" + unit_id, to_send)
-
-@app.get("/mqtt/v1/sync", dependencies=[Depends(JWTBearer())])
-async def sync_commands(unit_id: str):
-    """Sync the database and Control Unit commands."""
-    message = RuleUpdateMessage(
-        action = "replace",
-        unit_rules=[],
-        rules=[]
+    async with locked_units("tags", [unit_id]):
+        result = await publish_message("/egress/" + unit_id, to_send)
+        await record_append("tags", unit_id, payload, result)
+    return result
+
+async def resolve_bulk_units(request: UnitSelector) -> list[str]:
+    """Resolve a unit selector into a de-duplicated list of unit ids."""
+    unit_ids = list(request.unit_ids or [])
+
+    if request.broker_id:
+        broker_units = await run_query("load_broker_units",
+            supabase_client.table("control_units").select("id").eq("broker_id", request.broker_id).execute
+        )
+        unit_ids.extend(row["id"] for row in broker_units.data)
+
+    if request.tag:
+        tagged_units = await run_query("load_tagged_units",
+            supabase_client.table("module_tags").select("modules(unit_id)").eq("tag", request.tag).execute
+        )
+        unit_ids.extend(row["modules"]["unit_id"] for row in tagged_units.data if row["modules"])
+
+    return list(dict.fromkeys(unit_ids))
+
+@app.post("/mqtt/v1/bulk", dependencies=[Depends(JWTBearer())])
+async def send_bulk(request: BulkEgressRequest):
+    """Publish one egress message to many control units. The message is compressed once and sent through the broker's bulk API."""
+    unit_ids = await resolve_bulk_units(request)
+    if not unit_ids:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="No units matched the selector.")
+
+    payload = await encode_egress(request.message)
+    kind = next((kind for kind, message_type in SYNC_TYPES.items() if request.message.type == message_type), None)
+    if isinstance(request.message.data, TOUSchedule):
+        kind = "tariff"
+
+    async with locked_units(kind, unit_ids if kind else []):
+        units = await publish_to_units(unit_ids, [payload] * len(unit_ids))
+
+        # Bulk updates are not tracked per unit, the next sync of these units sends their full state.
+        if kind in SYNC_TYPES:
+            await forget_sync_state(kind, unit_ids)
+        if kind == "tariff":
+            await record_tariff([unit["unit_id"] for unit in units if unit["result"] == "ok"], request.message.data)
+
+    return bulk_response(units)
+
+async def publish_scheduled(items: list[tuple[str, EgressMessage]]) -> list[dict]:
+    """Publish the messages released by the egress scheduler through the broker's bulk API."""
+    payloads = await asyncio.gather(*(encode_egress(message) for _, message in items))
+    return await deliver([
+        BrokerPublishMessage(
+            payload_encoding="plain",
+            topic = topic,
+            payload = payload,
+            qos=0,
+            retain=False,
+        )
+        for (topic, _), payload in zip(items, payloads)
+    ])
+
+async def publish_egress(messages: dict[str, EgressMessage]) -> list[dict]:
+    """Publish a message to each unit, through the egress scheduler when it is enabled. Returns a status per unit."""
+    if egress_scheduler.enabled:
+        results = await asyncio.gather(*(egress_scheduler.submit("/egress/" + unit_id, message) for unit_id, message in messages.items()))
+        return [{"unit_id" : unit_id, **result} for unit_id, result in zip(messages, results)]
+
+    payloads = await asyncio.gather(*(encode_egress(message) for message in messages.values()))
+    return await publish_to_units(list(messages), payloads)
+
+async def publish_to_units(unit_ids: list[str], payloads: list[str]) -> list[dict]:
+    """Publish compressed payloads to the egress topics of units through the broker's bulk API. Returns a status per unit."""
+    messages = [
+        BrokerPublishMessage(
+            payload_encoding="plain",
+            topic = "/egress/" + unit_id,
+            payload = payload,
+            qos=0,
+            retain=False,
+        )
+        for unit_id, payload in zip(unit_ids, payloads)
+    ]
+
+    results = await deliver(messages)
+    for result in results:
+        if result["result"] != "ok":
+            egress_errors.labels("bulk").inc()
+
+    return [{"unit_id" : unit_id, **result} for unit_id, result in zip(unit_ids, results)]
+
+def bulk_response(units: list[dict]) -> dict:
+    failed = sum(1 for unit in units if unit["result"] != "ok")
+
+    return {
+        "result" : "ok" if failed == 0 else "fail",
+        "message" : f"Published to {len(units) - failed} of {len(units)} units.",
+        "units" : units
+    }
+
+@app.get("/mqtt/v1/stats", dependencies=[Depends(JWTBearer())])
+async def get_stats():
+    """Internal counters of the API's caches and queues."""
+    return {
+        "payload_cache" : payload_cache.stats(),
+        "reading_buffer" : reading_buffer.stats(),
+        "broker_cache" : broker_cache.stats(),
+        "acl_cache" : acl_cache.stats(),
+        "token_cache" : token_cache.stats(),
+        "tariff_cache" : tariff_cache.stats(),
+        "tariff_tables" : tariff_tables.stats() if tariff_tables is not None else None,
+        "egress_scheduler" : egress_scheduler.stats(),
+        "egress_outbox" : await egress_outbox.stats() if egress_outbox is not None else None,
+        "rollup_engine" : rollup_engine.stats() if rollup_engine is not None else None,
+        "dedup_index" : dedup_index.stats() if dedup_index is not None else None
+    }
+
+@app.get("/metrics", dependencies=[Depends(JWTBearer())])
+async def get_metrics():
+    """Pipeline metrics in the Prometheus text format."""
+    return PlainTextResponse(registry.render(), media_type=registry.CONTENT_TYPE)
+
+async def load_unit_rules(unit_ids: list[str]) -> dict[str, RuleUpdateMessage]:
+    """Resolve the full rule sets of units into replace messages.
+
+    Unit rules and module rules are each fetched in one query, with the rules embedded through their allocation
+    tables, and both queries run concurrently. Every module of a unit gets an entry, so modules without rules are cleared.
+    """
+    unit_rule_request, module_rule_request = await asyncio.gather(
+        run_query("load_unit_rules",
+            supabase_client.table("unit_rule_allocations").select("unit_id, rules(priority, expression, command)").in_("unit_id", unit_ids).execute
+        ),
+        run_query("load_module_rules",
+            supabase_client.table("modules").select("id, unit_id, module_rule_allocations(rules(priority, expression, command))").in_("unit_id", unit_ids).execute
+        ),
     )
 
-    # Query for unit rules:
-    unit_rule_request = supabase_client.table("unit_rule_allocations").select("unit_id, rules(priority, expression, command)").eq("unit_id", unit_id).execute();
-
-    # Load unit rules into update message.
-    if unit_rule_request.data:
-        for rule in unit_rule_request.data:
-            message.unit_rules.append(
-                DeviceRule.model_validate_json(
-                    rule
-                )
-            )
-
-    # Query for modules by unit_id
-    module_id_request = supabase_client.table("modules").select("id, unit_id").eq("unit_id", unit_id).execute()
+    unit_rules = {unit_id: [] for unit_id in unit_ids}
+    for allocation in unit_rule_request.data:
+        if allocation["rules"]:
+            unit_rules[allocation["unit_id"]].append(DeviceRule.model_validate(allocation["rules"]))
 
-    if not module_id_request.data:
-        return False
+    module_rules = {unit_id: [] for unit_id in unit_ids}
+    for module in module_rule_request.data:
+        rules = [DeviceRule.model_validate(allocation["rules"]) for allocation in module["module_rule_allocations"] if allocation["rules"]]
+        module_rules[module["unit_id"]].append(ModuleRuleUpdate(module_id=module["id"], action=1, rules=sorted(rules, key=rule_order)))
 
-    module_ids = [module["id"] for module in module_id_request.data]
+    return {
+        unit_id: RuleUpdateMessage(
+            unit_rules=UnitRuleUpdate(action=1, rules=sorted(unit_rules[unit_id], key=rule_order)),
+            module_rules=sorted(module_rules[unit_id], key=lambda update: update.module_id),
+        )
+        for unit_id in unit_ids
+    }
 
-    # Query for rule_allocations by module_ids
-    rule_id_data = supabase_client.table("module_rule_allocations").select("module_id, rule_id").in_("module_id", module_ids).execute()
+def rule_order(rule: DeviceRule) -> tuple:
+    return (rule.priority, rule.expression, rule.command)
 
-    if not rule_id_data.data:
-        return {"result": "ok", "message": "No rules configured"}
+async def sync_units(kind: str, messages: dict, full: bool = False) -> list[dict]:
+    """Publish full replace messages of one kind of unit state, sending each unit only what changed since its last delivery.
 
-    rule_ids = [rule_alloc["rule_id"] for rule_alloc in rule_id_data.data]
-
-    # Query for rules by rule_ids
-    rule_data = supabase_client.table("rules").select("id, priority, expression, command").in_("id", rule_ids).execute()
-
-    for rule in rule_data.data:
-        message.rules.append(DeviceRule.model_validate_json(rule))
+    Units that already have the state are not sent anything. With `full`, or when delta sync is disabled, the
+    whole message is sent. Returns a status per unit, with the version of its state when delta sync is enabled.
+    """
+    unit_ids = list(messages)
+    async with locked_units(kind, unit_ids):
+        updates = dict(messages)
+        statuses = {}
+        next_states = {}
+
+        if sync_delta:
+            states = await run_query("load_sync_state", sync_state.load, kind, unit_ids)
+            for unit_id in unit_ids:
+                state = states[unit_id]
+                if full:
+                    state = SyncState(unit_id, kind, state.version)
+                update, next_state = delta(state, messages[unit_id])
+                if next_state is not state:
+                    next_states[unit_id] = next_state
+                if update is None:
+                    del updates[unit_id]
+                    statuses[unit_id] = {"unit_id" : unit_id, "result" : "ok", "message" : "Already in sync.", "version" : next_state.version}
+                else:
+                    updates[unit_id] = update
+
+        message_type = SYNC_TYPES[kind]
+        to_send = {unit_id: EgressMessage(type=message_type, data=update) for unit_id, update in updates.items()}
+        for unit in await publish_egress(to_send):
+            if unit["unit_id"] in next_states:
+                unit["version"] = next_states[unit["unit_id"]].version
+                if unit["result"] != "ok":
+                    del next_states[unit["unit_id"]]
+            statuses[unit["unit_id"]] = unit
+
+        if next_states:
+            await run_query("save_sync_state", sync_state.save, list(next_states.values()))
+        return [statuses[unit_id] for unit_id in unit_ids]
+
+def unit_lock(kind: str, unit_id: str) -> asyncio.Lock:
+    lock = unit_locks.get((kind, unit_id))
+    if lock is None:
+        lock = unit_locks[(kind, unit_id)] = asyncio.Lock()
+    return lock
+
+@contextlib.asynccontextmanager
+async def locked_units(kind: str, unit_ids: list[str]):
+    """Hold the `kind` state lock of each unit, so a message is computed, sent and recorded before the next one to
+    the same unit. Otherwise an append recorded on a state loaded before a concurrent replace overwrites it. Locks
+    are taken in order, so concurrent bulk sends do not deadlock."""
+    async with contextlib.AsyncExitStack() as stack:
+        for unit_id in sorted(set(unit_ids)):
+            await stack.enter_async_context(unit_lock(kind, unit_id))
+        yield
+
+async def record_append(kind: str, unit_id: str, update, result: dict):
+    """Track an append update that was published to a unit on top of its delivered state. Call under the unit's lock."""
+    if not sync_delta or result.get("result") != "ok":
+        return
+    state = (await run_query("load_sync_state", sync_state.load, kind, [unit_id]))[unit_id]
+    appended_state = apply_append(kind, state.state, update.model_dump())
+    if appended_state is None:
+        await forget_sync_state(kind, [unit_id])
+    else:
+        await run_query("save_sync_state", sync_state.save, [state.advance(appended_state)])
+
+async def forget_sync_state(kind: str, unit_ids: list[str]):
+    if sync_delta:
+        await run_query("forget_sync_state", sync_state.forget, kind, unit_ids)
 
-    to_send = EgressMessage(
-        type="rules",
-        data=message
-    )
+@app.get("/mqtt/v1/sync", dependencies=[Depends(JWTBearer())])
+async def sync_commands(unit_id: str, full: bool = False):
+    """Sync the database and Control Unit commands. Only the rules that changed since the unit's last sync are sent, unless `full` is set."""
+    messages = await load_unit_rules([unit_id])
 
     # Send new commands to the device.
-    return await publish_message("/egress/" + unit_id, to_send)
+    return (await sync_units("rules", messages, full))[0]
+
+@app.post("/mqtt/v1/sync", dependencies=[Depends(JWTBearer())])
+async def sync_many(request: SyncRequest):
+    """Sync the commands of many control units, such as after an outage.
 
-async def insert_readings(data: ReadingMessage):
-    """Insert a reading packet into the database."""
-    readings_to_insert = []
-    state_changes_to_insert = []
-
-    period_start = datetime.datetime.fromtimestamp(data.period_start).strftime("%Y-%m-%d %H:%M:%S+00")
-    period_end = datetime.datetime.fromtimestamp(data.period_end).strftime("%Y-%m-%d %H:%M:%S+00")
-
-    # Unpack the reading data into the two lists.
-    for reading in data.readings:
-        readings_to_insert.append({
-            "iqr_apparent_power": reading.apparent_power[2],
-            "iqr_power_factor": reading.power_factor[2],
-            "kurtosis_apparent_power": reading.apparent_power[3],
-            "kurtosis_power_factor": reading.power_factor[3],
-            "kwh_usage": reading.kwh_usage,
-            "max_apparent_power": reading.apparent_power[1],
-            "max_power_factor": reading.power_factor[1],
-            "mean_apparent_power": reading.apparent_power[0],
-            "mean_frequency": reading.mean_frequency,
-            "mean_power_factor": reading.power_factor[0],
-            "mean_voltage": reading.mean_voltage,
-            "module_id": reading.module_id,
-            "period_end_time": period_end,
-            "period_start_time": period_start,
-            "sample_count": reading.sample_count
-        })
-
-
-        for state_change in reading.state_changes:
-            state_changes_to_insert.append({
-                    "module" : reading.module_id,
-                    "state" : state_change.state,
-                    "timestamp" : datetime.datetime.fromtimestamp(state_change.timestamp).strftime("%Y-%m-%d %H:%M:%S+00")
-                })
-
-    # Insert the data into the database.
-    supabase_client.table("readings").upsert(readings_to_insert).execute()    
-    supabase_client.table("module_state_changes").insert(state_changes_to_insert).execute()
+    Rules are loaded `sync_chunk_size` units at a time and the changes are published through the broker's bulk API.
+    """
+    unit_ids = await resolve_bulk_units(request)
+    if not unit_ids:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="No units matched the selector.")
+
+    messages = {}
+    for start in range(0, len(unit_ids), sync_chunk_size):
+        messages.update(await load_unit_rules(unit_ids[start:start + sync_chunk_size]))
+
+    return bulk_response(await sync_units("rules", messages, request.full))
+
+async def load_unit_tariff(unit_id: str) -> tuple:
+    """Query the tariff last sent to the unit. Empty when it has none, so that is cached as well."""
+    return await run_query("load_tariff", tariff_store.load, unit_id) or ()
+
+async def get_unit_tariff(unit_id: str) -> Optional[TariffTable]:
+    """Compiled tariff of the unit, None if it has none. Cached for `cache_ttl` seconds."""
+    tariff = await tariff_cache.get_or_load(unit_id, lambda: load_unit_tariff(unit_id))
+    if not tariff:
+        return None
+    hash, schedule = tariff
+    return tariff_tables.get(schedule, hash)
+
+async def record_tariff(unit_ids: list[str], schedule: TOUSchedule):
+    """Keep the TOU schedule sent to units, which their readings are priced against from now on."""
+    if tariff_tables is None or not unit_ids:
+        return
+    await run_query("save_tariff", tariff_store.save, unit_ids, schedule)
+    for unit_id in unit_ids:
+        tariff_cache.invalidate(unit_id)
+
+async def price_readings(unit_id: str, batch: ReadingBatch):
+    """Cost the readings of a unit at its tariff. Readings of units without one, or whose tariff fails to load, are queued unpriced."""
+    if tariff_tables is None or not len(batch):
+        return
+    try:
+        table = await get_unit_tariff(unit_id)
+    except Exception as e:
+        logger.error("Failed to load the tariff of %s: %s", unit_id, e)
+        table = None
+    if table is None:
+        ingress_unpriced.inc(len(batch))
+        return
+
+    with ingress_price_time.time():
+        batch.price(table)
+
+async def flush_reading_batch(batch: ReadingBatch):
+    await run_query("write_readings", reading_store.write, batch)
+
+async def flush_rollups(rollups: list[Rollups]):
+    await run_query("write_rollups", reading_store.write_rollups, rollups)
+
+def packet_key(data: BrokerWebhook) -> Optional[bytes]:
+    return dedup_index.packet_key(data.clientId, data.data) if dedup_index is not None else None
+
+def claim_packet(key: Optional[bytes]) -> bool:
+    """Remember an ingress packet by its key. False if it was already received within the dedup window."""
+    if key is None or dedup_index.claim(key):
+        return True
+    ingress_duplicates.labels("packet").inc()
+    return False
+
+def release_packet(key: Optional[bytes]):
+    """Forget a packet that was not queued, so its retransmission is processed."""
+    if key is not None:
+        dedup_index.release(key)
+
+def admit_readings(unit_id: str, batch: ReadingBatch) -> ReadingBatch:
+    """The readings of a unit that were not already queued within the dedup window, with their state changes."""
+    if dedup_index is None:
+        return batch
+    admitted = dedup_index.admit(unit_id, batch)
+    if admitted is not batch:
+        ingress_duplicates.labels("reading").inc(len(batch) - len(admitted))
+        ingress_duplicates.labels("state_change").inc(batch.state_change_count - admitted.state_change_count)
+    return admitted
+
+def forget_readings(unit_id: str, batch: ReadingBatch):
+    if dedup_index is not None:
+        dedup_index.forget(unit_id, batch)
+
+async def queue_readings(unit_id: str, batch: ReadingBatch):
+    """Price the new readings of a unit and queue them to be written and rolled up. Raises BufferFullError when the ingress buffer is full."""
+    batch = admit_readings(unit_id, batch)
+    await price_readings(unit_id, batch)
+    try:
+        reading_buffer.add(batch)
+    except BufferFullError:
+        forget_readings(unit_id, batch)
+        raise
+    if rollup_engine is not None:
+        rollup_engine.add(unit_id, batch)
+
+async def decode_ingress(message: str, encoding: int = ENCODING_BROTLI_JSON, dictionary_id: int = 0) -> tuple[int, Optional[ReadingBatch]]:
+    """Decode an unwrapped ingress message. Returns its data type and, for readings, the batch of its rows."""
+    # Binary frames decode straight into columns, without building the JSON object tree.
+    if encoding == ENCODING_BINARY:
+        start = time.perf_counter()
+        message_type, batch = await compression_executor.run(len(message), decode_reading_batch_b64, message)
+        ingress_binary_time.observe(time.perf_counter() - start)
+        ingress_received_bytes.inc(len(message) * 3 // 4)
+        ingress_messages.labels(message_type, encoding).inc()
+        return message_type, batch
+
+    text, compressed_size, size, base64_seconds, decompress_seconds = await compression_executor.decompress_timed(message, dictionary_id)
+    ingress_base64_time.observe(base64_seconds)
+    ingress_decompress_time.observe(decompress_seconds)
+    ingress_received_bytes.inc(compressed_size)
+    ingress_decompressed_bytes.inc(size)
+    if compressed_size:
+        ingress_compression_ratio.observe(size / compressed_size)
+
+    start = time.perf_counter()
+    ingress_message = IngressMessage.model_validate_json(text)
+    ingress_validate_time.observe(time.perf_counter() - start)
+    ingress_messages.labels(ingress_message.type, encoding).inc()
+    if ingress_message.type != 0:
+        return ingress_message.type, None
+
+    start = time.perf_counter()
+    batch = ReadingBatch()
+    batch.add_message(ingress_message.data)
+    ingress_rows_time.observe(time.perf_counter() - start)
+    return ingress_message.type, batch
+
+async def process_webhook(data: BrokerWebhook) -> dict:
+    """Decompress, parse and queue one ingress message. Shared by the webhook endpoint and the MQTT ingest daemon.
+
+    Packets already received within the dedup window are acknowledged without being decompressed again. Raises
+    BufferFullError when the ingress buffer is full.
+    """
+    key = packet_key(data)
+    if not claim_packet(key):
+        return {"result" : "ok", "message": "Duplicate packet, already received."}
+    try:
+        result = await process_packet(data)
+    except BaseException:
+        release_packet(key)
+        raise
+    if result["result"] != "ok":
+        release_packet(key)
+    return result
+
+async def process_packet(data: BrokerWebhook) -> dict:
+    message, encoding, dictionary_id = unwrap_message(data.data)
+    payload_log.log("Ingress from %s on %s, encoding %d: %s", data.clientId, data.topic, encoding, payload=message)
+    if encoding == ENCODING_BROTLI_JSON and len(message) >= stream_threshold:
+        with ingress_stream_time.time():
+            return await process_webhook_stream(data.clientId, message, dictionary_id)
+
+    message_type, batch = await decode_ingress(message, encoding, dictionary_id)
+
+    # Check the 'type' field for data type
+    if message_type == 0: # Type 0 - Reading
+        await queue_readings(data.clientId, batch)
+
+        return {"result" : "ok", "message": "success"}
+    else:
+        ingress_errors.labels("unsupported_type").inc()
+        return {"result" : "fail", "message": f"Unsupported data type: {message_type}"}
+
+async def queue_streamed_readings(unit_id: str, period_start: int, period_end: int, readings: list[ReadingDataItem]):
+    batch = ReadingBatch()
+    batch.add_readings(period_start, period_end, readings)
+    try:
+        await queue_readings(unit_id, batch)
+    except BufferFullError:
+        # Failing here would drop the rest of a large packet, so write out what is queued and try once more.
+        await reading_buffer.flush()
+        await queue_readings(unit_id, batch)
+
+async def process_webhook_stream(unit_id: str, message: str, dictionary_id: int = 0) -> dict:
+    """process_webhook for large packets, such as units catching up after being offline.
+
+    The packet is decompressed and parsed incrementally, and its readings are queued every `stream_batch_rows`
+    readings, so memory stays bounded by the chunk size instead of growing with the packet. Chunks are decompressed
+    and parsed on a worker thread, one at a time, and their readings queued back on the event loop. If a packet fails
+    part way its first readings may already be queued; readings are upserted, so the unit's retransmission is harmless.
+    """
+    parser = IngressStreamParser()
+    chunks = brotli_decompress_b64_chunks(message, dictionary_id, stream_chunk_size)
+    readings = []
+
+    def parse_chunk() -> Optional[list[ReadingDataItem]]:
+        """Readings of the next chunk, None once the packet is consumed."""
+        text = next(chunks, None)
+        return None if text is None else parser.feed(text)
+
+    while (chunk_readings := await asyncio.to_thread(parse_chunk)) is not None:
+        readings.extend(chunk_readings)
+        if parser.type is not None and parser.type != 0:
+            ingress_messages.labels(parser.type, ENCODING_BROTLI_JSON).inc()
+            ingress_errors.labels("unsupported_type").inc()
+            return {"result" : "fail", "message": f"Unsupported data type: {parser.type}"}
+
+        # Readings can only be queued once their period is known, which units send ahead of them.
+        if len(readings) >= stream_batch_rows and parser.period_start is not None and parser.period_end is not None:
+            await queue_streamed_readings(unit_id, parser.period_start, parser.period_end, readings)
+            readings = []
+
+    readings.extend(await asyncio.to_thread(parser.close))
+    ingress_messages.labels(parser.type, ENCODING_BROTLI_JSON).inc()
+    if parser.type != 0:
+        ingress_errors.labels("unsupported_type").inc()
+        return {"result" : "fail", "message": f"Unsupported data type: {parser.type}"}
+    if parser.period_start is None or parser.period_end is None:
+        raise ValueError("Reading message is missing its period.")
+    if readings:
+        await queue_streamed_readings(unit_id, parser.period_start, parser.period_end, readings)
+
+    return {"result" : "ok", "message": "success"}
 
 # Define the endpoint to receive MQTTBrokerWebhook data
 @app.post("/mqtt/v1/ingress", dependencies=[Depends(BrokerJWTBearer())])
 async def receive_mqtt_webhook(data: BrokerWebhook):
     try:
-        # Decompress the data.
-        decompressed_data = await decompress_message_brotli(data.data)
+        return await process_webhook(data)
+    except BufferFullError as e:
+        ingress_errors.labels("buffer_full").inc()
+        raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail=str(e))
+    except Exception as e:
+        ingress_errors.labels("invalid").inc()
+        raise HTTPException(status_code=500, detail=f"Error processing data: {str(e)}")
+
+async def decode_batch_item(item) -> tuple[str, ReadingBatch, Optional[bytes]]:
+    """Validate, decompress and parse one webhook envelope of a batch. Returns its unit, readings and packet key, raises on any failure.
 
-        # Parse the data as Ingress Message
-        decompressed_data_message = IngressMessage.model_validate_json(decompressed_data)
+    Packets already received within the dedup window come back without readings.
+    """
+    if isinstance(item, Exception):
+        raise item
+    webhook = BrokerWebhook.model_validate(item)
+    key = packet_key(webhook)
+    if not claim_packet(key):
+        return webhook.clientId, ReadingBatch(), None
+    try:
+        message_type, batch = await decode_ingress(*unwrap_message(webhook.data))
+        if message_type != 0:
+            raise ValueError(f"Unsupported data type: {message_type}")
+    except BaseException:
+        release_packet(key)
+        raise
+    return webhook.clientId, batch, key
+
+def parse_batch_line(line: bytes):
+    """One NDJSON envelope, or the error it fails with."""
+    try:
+        return json.loads(line)
+    except ValueError as e:
+        return ValueError(f"Invalid JSON: {str(e)}")
 
-        # Check the 'type' field for data type
-        if decompressed_data_message.type == 0: # Type 0 - Reading
-            await insert_readings(decompressed_data_message.data)
+@app.post("/mqtt/v1/ingress/batch", dependencies=[Depends(BrokerJWTBearer())])
+async def receive_mqtt_webhook_batch(request: Request):
+    """Receive many broker webhooks in one request, as a JSON array or as NDJSON (one envelope per line).
 
-            return {"result" : "ok", "message": "success"}
+    All envelopes are decompressed together and their readings are queued as one batch. Returns a status per envelope.
+    """
+    body = await request.body()
+    try:
+        if request.headers.get("content-type", "").startswith(("application/x-ndjson", "application/jsonl")):
+            # Lines are parsed one by one, so a malformed line fails only its own envelope.
+            items = [parse_batch_line(line) for line in body.splitlines() if line.strip()]
+        else:
+            items = json.loads(body)
+            if not isinstance(items, list):
+                raise ValueError("Expected an array of webhooks.")
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Invalid batch: {str(e)}")
+
+    decoded = await asyncio.gather(*(decode_batch_item(item) for item in items), return_exceptions=True)
+
+    batch = ReadingBatch()
+    results = []
+    queued = []
+    for message in decoded:
+        if isinstance(message, Exception):
+            ingress_errors.labels("invalid").inc()
+            results.append({"result" : "fail", "message" : f"Error processing data: {str(message)}"})
         else:
-            return {"result" : "fail", "message": f"Unsupported data type: {decompressed_data_message.type}"}
+            unit_id, item_batch, key = message
+            item_batch = admit_readings(unit_id, item_batch)
+            await price_readings(unit_id, item_batch)
+            batch.append(item_batch)
+            queued.append((unit_id, item_batch, key))
+            results.append({"result" : "ok", "message" : "success"})
 
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error processing data: {str(e)}")
+    try:
+        reading_buffer.add(batch)
+    except BufferFullError as e:
+        for unit_id, item_batch, key in queued:
+            forget_readings(unit_id, item_batch)
+            release_packet(key)
+        ingress_errors.labels("buffer_full").inc(len(items))
+        raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail=str(e))
+    if rollup_engine is not None:
+        for unit_id, item_batch, _ in queued:
+            rollup_engine.add(unit_id, item_batch)
+
+    failed = sum(1 for result in results if result["result"] != "ok")
+    return {
+        "result" : "ok" if failed == 0 else "fail",
+        "message" : f"Processed {len(results) - failed} of {len(results)} messages.",
+        "results" : results
+    }
 
 
     
@@ -330,11 +957,39 @@ async def receive_mqtt_webhook(data: BrokerWebhook):
 #     return Response(content=res_body, status_code=response.status_code, 
 #         headers=dict(response.headers), media_type=response.media_type, background=task)
 
+@app.on_event("startup")
+async def startup(ingress_only: bool = False):
+    """Start the background pieces. `ingress_only` leaves out egress, for processes that only take readings in, such
+    as the MQTT ingest workers: each would otherwise dispatch the shared outbox too."""
+    if not ingress_only:
+        await broker_publisher.start()
+        if egress_outbox is not None:
+            await egress_outbox.start()
+        await egress_scheduler.start()
+    await reading_buffer.start()
+    if rollup_engine is not None:
+        await rollup_engine.start()
+
+@app.on_event("shutdown")
+async def shutdown(ingress_only: bool = False):
+    await reading_buffer.stop()
+    if rollup_engine is not None:
+        await rollup_engine.stop()
+    reading_store.close()
+    if not ingress_only:
+        await egress_scheduler.stop()
+        if egress_outbox is not None:
+            await egress_outbox.stop()
+        await broker_publisher.stop()
+    compression_executor.shutdown()
+
 def load_config():
-    global supabase_url, supabase_service_key, emqx_broker_ip, emqx_broker_http_port, emqx_api_key, emqx_secret, api_hostname, api_port, supabase_client, emqx_headers, emqx_broker_url
+    global supabase_url, supabase_service_key, emqx_broker_ip, emqx_broker_http_port, emqx_api_key, emqx_secret, api_hostname, api_port, supabase_client, emqx_headers, emqx_broker_url, broker_publisher, payload_cache, compression_executor, compression_profiles, reading_buffer, reading_store, broker_cache, acl_cache, stream_threshold, stream_batch_rows, stream_chunk_size, sync_chunk_size, sync_delta, sync_state, egress_scheduler, egress_outbox, tariff_cache, tariff_tables, tariff_store, rollup_engine, dedup_index
 
     config = configparser.ConfigParser()
     config.read("configuration.ini")
+    configure_logging(config)
+
     supabase_url = config["SUPABASE"]["supabase_url"]
     supabase_service_key = config["SUPABASE"]["supabase_service_key"]
     emqx_broker_ip = config["EMQX"]["emqx_broker_ip"]
@@ -352,6 +1007,143 @@ def load_config():
                     "Content-Type": "application/json" }
     emqx_broker_url = "http://" + emqx_broker_ip + ":" + str(emqx_broker_http_port) + "/api/v5/publish"
 
+    # Pooled async publisher for the EMQX HTTP API.
+    broker_publisher = BrokerPublisher(
+        emqx_broker_url,
+        emqx_headers,
+        pool_size=config["EMQX"].getint("emqx_pool_size", 20),
+        timeout=config["EMQX"].getfloat("emqx_timeout", 5.0),
+        connect_timeout=config["EMQX"].getfloat("emqx_connect_timeout", 2.0),
+        retries=config["EMQX"].getint("emqx_retries", 3),
+        backoff=config["EMQX"].getfloat("emqx_backoff", 0.1),
+        bulk_chunk_size=config["EMQX"].getint("emqx_bulk_chunk_size", 500),
+        bulk_concurrency=config["EMQX"].getint("emqx_bulk_concurrency", 4),
+    )
+
+    # Cache of compressed egress payloads.
+    payload_cache = PayloadCache(
+        max_entries=config.getint("COMPRESSION", "cache_max_entries", fallback=1024),
+        max_bytes=config.getint("COMPRESSION", "cache_max_bytes", fallback=16 * 1024 * 1024),
+    )
+
+    # Worker pool for brotli (de)compression, keeps large payloads off the event loop.
+    compression_executor = CompressionExecutor(
+        mode=config.get("COMPRESSION", "executor", fallback="process"),
+        max_workers=config.getint("COMPRESSION", "executor_workers", fallback=0),
+        inline_threshold=config.getint("COMPRESSION", "inline_threshold", fallback=4096),
+    )
+
+    # Compression profile for each egress message type.
+    compression_profiles = {
+        message_type: PROFILES[config.get("COMPRESSION", "profile_" + name, fallback="default")]
+        for message_type, name in EGRESS_TYPE_NAMES.items()
+    }
+
+    # Caches for the lookups of create_unit_token.
+    broker_cache = TTLCache(
+        ttl=config.getfloat("CACHE", "broker_ttl", fallback=300),
+        max_entries=config.getint("CACHE", "max_entries", fallback=10000),
+    )
+    acl_cache = TTLCache(
+        ttl=config.getfloat("CACHE", "acl_ttl", fallback=300),
+        max_entries=config.getint("CACHE", "max_entries", fallback=10000),
+    )
+
+    # Pricing of ingress readings at the TOU schedule last sent to their unit.
+    tariff_tables = None
+    if config.getboolean("TARIFF", "enabled", fallback=False):
+        tariff_tables = TariffCache(
+            max_entries=config.getint("TARIFF", "max_tables", fallback=256),
+            utc_offset=config.getint("TARIFF", "utc_offset", fallback=0),
+        )
+    tariff_cache = TTLCache(
+        ttl=config.getfloat("TARIFF", "cache_ttl", fallback=300),
+        max_entries=config.getint("CACHE", "max_entries", fallback=10000),
+    )
+    tariff_store = TariffStore(supabase_client)
+
+    # Storage backend for ingress readings.
+    storage_backend = config.get("STORAGE", "backend", fallback="supabase")
+    if storage_backend == "postgres":
+        from bin.PostgresReadingStore import PostgresReadingStore
+        reading_store = PostgresReadingStore(
+            config["STORAGE"]["postgres_dsn"],
+            min_size=config.getint("STORAGE", "pool_min_size", fallback=1),
+            max_size=config.getint("STORAGE", "pool_max_size", fallback=4),
+            conflict_columns=[column.strip() for column in config.get("STORAGE", "conflict_columns", fallback="module_id, period_start_time").split(",")],
+            cost=tariff_tables is not None,
+        )
+    elif storage_backend == "supabase":
+        reading_store = SupabaseReadingStore(supabase_client, cost=tariff_tables is not None)
+    else:
+        raise ValueError("Unknown storage backend: " + storage_backend)
+
+    # Write-behind buffer for ingress readings.
+    reading_buffer = ReadingBuffer(
+        flush_reading_batch,
+        max_rows=config.getint("INGRESS", "buffer_max_rows", fallback=50000),
+        flush_rows=config.getint("INGRESS", "flush_rows", fallback=1000),
+        flush_interval=config.getfloat("INGRESS", "flush_interval", fallback=1.0),
+    )
+
+    # Memory of recently queued packets and readings, so retransmissions are dropped.
+    dedup_index = None
+    if config.getboolean("DEDUP", "enabled", fallback=True):
+        dedup_index = DedupIndex(
+            ttl=config.getfloat("DEDUP", "ttl", fallback=900),
+            max_entries=config.getint("DEDUP", "max_entries", fallback=500000),
+        )
+
+    # Hourly and daily rollups of the readings, per module and per unit.
+    rollup_engine = None
+    if config.getboolean("ROLLUP", "enabled", fallback=False):
+        rollup_engine = RollupEngine(
+            flush_rollups,
+            utc_offset=config.getint("ROLLUP", "utc_offset", fallback=0),
+            flush_interval=config.getfloat("ROLLUP", "flush_interval", fallback=60.0),
+            max_rows=config.getint("ROLLUP", "max_rows", fallback=100000),
+        )
+
+    # Durable queue between the API and the broker, so egress survives broker outages and restarts.
+    egress_outbox = None
+    if config.getboolean("OUTBOX", "enabled", fallback=True):
+        egress_outbox = EgressOutbox(
+            config.get("OUTBOX", "path", fallback="outbox.sqlite3"),
+            broker_publisher.publish_bulk,
+            CircuitBreaker(
+                threshold=config.getint("OUTBOX", "breaker_threshold", fallback=5),
+                cooldown=config.getfloat("OUTBOX", "breaker_cooldown", fallback=5.0),
+                max_cooldown=config.getfloat("OUTBOX", "breaker_max_cooldown", fallback=60.0),
+            ),
+            chunk_size=config.getint("EMQX", "emqx_bulk_chunk_size", fallback=500),
+            concurrency=config.getint("OUTBOX", "concurrency", fallback=4),
+            backoff=config.getfloat("OUTBOX", "backoff", fallback=1.0),
+            max_backoff=config.getfloat("OUTBOX", "max_backoff", fallback=60.0),
+            max_attempts=config.getint("OUTBOX", "max_attempts", fallback=20),
+            lease=config.getfloat("OUTBOX", "lease", fallback=60.0),
+            synchronous=config.get("OUTBOX", "synchronous", fallback="normal"),
+        )
+
+    # Egress messages to the same unit within window seconds are merged, 0 publishes every message at once.
+    egress_scheduler = EgressScheduler(
+        publish_scheduled,
+        window=config.getfloat("EGRESS", "window", fallback=0),
+        max_messages=config.getint("EGRESS", "max_messages", fallback=16),
+        batch=config.getboolean("EGRESS", "batch", fallback=False),
+    )
+
+    # Units whose rules are loaded per query pair by a multi-unit sync.
+    sync_chunk_size = config.getint("SYNC", "chunk_size", fallback=200)
+
+    # State last delivered to each unit, so syncs only send what changed.
+    sync_delta = config.getboolean("SYNC", "delta", fallback=True)
+    sync_state = SyncStateStore(supabase_client)
+
+    # Packets of at least stream_threshold base64 characters are decompressed and parsed incrementally.
+    stream_threshold = config.getint("INGRESS", "stream_threshold", fallback=262144)
+    stream_batch_rows = config.getint("INGRESS", "stream_batch_rows", fallback=500)
+    stream_chunk_size = config.getint("INGRESS", "stream_chunk_size", fallback=65536)
+
 if __name__ == "__main__":
     import uvicorn
     load_config()
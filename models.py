@@ -132,8 +132,19 @@ EMQX Broker Communication
 """
 
 class MQTTDataPacket(BaseModel):
+    """Envelope for a compressed message.
+
+    `e` - encoding of `m`:
+        - 0 - brotli compressed JSON, base64 encoded.
+        - 1 - binary reading frame (see bin/ReadingCodec.py), base64 encoded.
+
+    `m` - the encoded message.
+
+    `d` - id of the shared compression dictionary applied before compression, 0 for none.
+    """
     e: int
     m: str
+    d: int = 0
 
 class BrokerPublishMessage(BaseModel):
     """Format of HTTP POST request to publish message to topic."""
@@ -241,10 +252,34 @@ class EgressMessage(BaseModel):
         - 2 - parameters
         - 3 - TOU Schedule
         - 4 - tags
+        - 5 - batch of the above, for one unit
 
         `data` - contained data.
 
     """
 
     type: int
-    data: Union[RuleUpdateMessage, ScheduleUpdateMessage, ControlUnitParameters, TOUSchedule, TagUpdateMessage]
\ No newline at end of file
+    data: Union[RuleUpdateMessage, ScheduleUpdateMessage, ControlUnitParameters, TOUSchedule, TagUpdateMessage, "EgressBatchMessage"]
+
+class EgressBatchMessage(BaseModel):
+    """Several egress messages for one control unit, published together. The unit applies them in order."""
+    messages: List[EgressMessage]
+
+EgressMessage.model_rebuild()
+
+class UnitSelector(BaseModel):
+    """Selects many control units at once.
+
+    Units are selected by any combination of `unit_ids`, `tag` (units with a module carrying the tag) and `broker_id`.
+    """
+    unit_ids: Optional[List[str]] = None
+    tag: Optional[str] = None
+    broker_id: Optional[str] = None
+
+class SyncRequest(UnitSelector):
+    """Units to sync. `full` sends every unit its complete state instead of the changes since its last sync."""
+    full: bool = False
+
+class BulkEgressRequest(UnitSelector):
+    """Egress message to publish to many control units at once."""
+    message: EgressMessage
@@ -0,0 +1,203 @@
+"""
+MQTT ingestion daemon. Subscribes to the ingress topics directly, instead of receiving one HTTP webhook per message,
+and feeds messages into the same pipeline as `main.receive_mqtt_webhook`.
+
+Topics are subscribed with `$share/<group>/<topic>` shared subscriptions, so the broker spreads messages over all
+workers of all daemons in the group. Each worker is its own process with its own ingress buffer.
+
+Units publish on their own topic, `/ingress/<unit_id>`, and the unit id is taken from the topic's last level. MQTT 5
+publishers on a topic without one may send it as a `clientId` user property instead. Messages without a unit id that
+is a UUID are dropped, since readings are priced, rolled up and deduplicated by it.
+
+Usage: python -m mqtt.IngestDaemon [--workers N]
+Reads the [MQTT_INGEST] section of configuration.ini.
+"""
+import argparse, asyncio, configparser, logging, multiprocessing, signal, time, uuid
+from typing import Optional
+
+import paho.mqtt.client as mqtt
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+
+from bin.LogConfig import configure_logging
+
+logger = logging.getLogger("mqtt.IngestDaemon")
+
+def canonical_uuid(value: str) -> Optional[str]:
+    try:
+        return str(uuid.UUID(value))
+    except ValueError:
+        return None
+
+def message_unit_id(message: mqtt.MQTTMessage) -> Optional[str]:
+    """The unit a message is from: the last level of its topic, or else its MQTT 5 `clientId` user property. None
+    if neither is a UUID."""
+    unit_id = canonical_uuid(message.topic.rsplit("/", 1)[-1])
+    if unit_id is None and message.properties is not None:
+        for name, value in getattr(message.properties, "UserProperty", None) or []:
+            if name == "clientId":
+                unit_id = canonical_uuid(value)
+    return unit_id
+
+class IngestWorker:
+    """One subscriber process: a paho client on its network thread handing messages to consumers on the asyncio loop.
+
+    The network thread never waits on the loop, so keepalives keep flowing under load. Messages are acknowledged once
+    processed instead, and the broker stops sending once its in-flight window is unacknowledged: `queue_size` with
+    MQTT 5 (receive maximum), the broker's own limit with MQTT 3.1.1. The rest wait in the broker's session.
+    """
+
+    def __init__(self, index: int, config: configparser.ConfigParser):
+        section = config["MQTT_INGEST"]
+        self.index = index
+        self.host = section.get("host", "localhost")
+        self.port = section.getint("port", 1883)
+        self.username = section.get("username", "")
+        self.password = section.get("password", "")
+        self.transport = section.get("transport", "tcp")
+        self.group = section.get("group", "sdr_ingest")
+        self.shared = section.getboolean("shared", True)
+        self.protocol = mqtt.MQTTv5 if section.get("protocol", "5") == "5" else mqtt.MQTTv311
+        self.topics = [topic.strip() for topic in section.get("topics", "/ingress/+").split(",") if topic.strip()]
+        self.qos = section.getint("qos", 1)
+        self.client_id = section.get("client_id_prefix", "sdr_ingest_") + str(index) + "_" + str(int(time.time()))
+        self.queue_size = section.getint("queue_size", 1000)
+        self.consumers = section.getint("consumers", 8)
+        self.executor_mode = section.get("executor", "inline")
+
+        self.loop: asyncio.AbstractEventLoop = None
+        self.queue: asyncio.Queue = None
+        self.stopping: asyncio.Event = None
+        self.client: mqtt.Client = None
+        self.consumer_tasks = []
+        self.received = 0
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+
+    def on_connect(self, client, userdata, flags, reason_code, properties):
+        if reason_code.is_failure:
+            logger.error("Worker %d failed to connect: %s", self.index, reason_code)
+            return
+        # Subscribe on every (re)connect, the broker forgets subscriptions of clean sessions.
+        prefix = "$share/" + self.group + "/" if self.shared else ""
+        client.subscribe([(prefix + topic, self.qos) for topic in self.topics])
+        logger.info("Worker %d subscribed to %s", self.index, ", ".join(prefix + topic for topic in self.topics))
+
+    def on_message(self, client, userdata, message: mqtt.MQTTMessage):
+        """Runs on paho's network thread, and only hands the message to the loop."""
+        client_id = message_unit_id(message)
+        if client_id is None:
+            self.rejected += 1
+            logger.warning("Worker %d dropped a message on %s, it carries no unit id.", self.index, message.topic)
+            client.ack(message.mid, message.qos)
+            return
+        item = (client_id, message.topic, message.payload.decode('utf-8'), message.mid, message.qos)
+        # The queue is unbounded, it only holds messages the broker sent within its in-flight window.
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, item)
+        self.received += 1
+
+    async def consume(self):
+        import main
+        from models import BrokerWebhook
+        from bin.ReadingBuffer import BufferFullError
+
+        while True:
+            client_id, topic, data, mid, qos = await self.queue.get()
+            webhook = BrokerWebhook(clientId=client_id, topic=topic, data=data)
+            while True:
+                try:
+                    await main.process_webhook(webhook)
+                    self.processed += 1
+                    break
+                except BufferFullError:
+                    # There is no 429 for MQTT; hold the message unacknowledged until the buffer drains, which pushes back on the broker.
+                    await asyncio.sleep(main.reading_buffer.flush_interval)
+                except Exception as e:
+                    self.failed += 1
+                    logger.error("Worker %d failed to process a message on %s: %s", self.index, topic, e)
+                    break
+            self.client.ack(mid, qos)
+            self.queue.task_done()
+
+    async def start(self):
+        """Load the API configuration, start its ingress pipeline and connect to the broker."""
+        import main
+        from bin.CompressionExecutor import CompressionExecutor
+
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+        self.stopping = asyncio.Event()
+
+        main.load_config()
+        # Workers are already one process per core, so do not fork a compression pool from each of them.
+        main.compression_executor.shutdown()
+        main.compression_executor = CompressionExecutor(mode=self.executor_mode, inline_threshold=main.compression_executor.inline_threshold)
+        await main.startup(ingress_only=True)
+
+        self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=self.client_id, protocol=self.protocol, transport=self.transport, manual_ack=True)
+        if self.username:
+            self.client.username_pw_set(self.username, self.password)
+        self.client.on_connect = self.on_connect
+        self.client.on_message = self.on_message
+        properties = None
+        if self.protocol == mqtt.MQTTv5:
+            properties = Properties(PacketTypes.CONNECT)
+            properties.ReceiveMaximum = max(1, min(self.queue_size, 65535))
+        self.client.connect(self.host, self.port, properties=properties)
+        self.client.loop_start()
+
+        self.consumer_tasks = [asyncio.create_task(self.consume()) for _ in range(self.consumers)]
+
+    async def stop(self):
+        """Stop taking messages, finish the queued ones, then flush the ingress buffer."""
+        import main
+
+        logger.info("Worker %d stopping, %d received, %d processed, %d failed, %d rejected.", self.index, self.received, self.processed, self.failed, self.rejected)
+        self.client.disconnect()
+        await asyncio.to_thread(self.client.loop_stop)
+        await self.queue.join()
+        for consumer in self.consumer_tasks:
+            consumer.cancel()
+        await main.shutdown(ingress_only=True)
+
+    async def run(self):
+        await self.start()
+        for stop_signal in (signal.SIGINT, signal.SIGTERM):
+            self.loop.add_signal_handler(stop_signal, self.stopping.set)
+        await self.stopping.wait()
+        await self.stop()
+
+def run_worker(index: int):
+    config = configparser.ConfigParser()
+    config.read("configuration.ini")
+    configure_logging(config, format="%(asctime)s worker " + str(index) + " %(levelname)s %(name)s: %(message)s")
+    asyncio.run(IngestWorker(index, config).run())
+
+def run_daemon():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=0, help="Number of worker processes, overrides [MQTT_INGEST] workers.")
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read("configuration.ini")
+    workers = args.workers or config.getint("MQTT_INGEST", "workers", fallback=0) or multiprocessing.cpu_count()
+
+    context = multiprocessing.get_context("spawn")
+    processes = [context.Process(target=run_worker, args=(index,), name="ingest-" + str(index)) for index in range(workers)]
+    for process in processes:
+        process.start()
+
+    # Forward termination to the workers so each flushes its buffer before exiting.
+    def stop(signum, frame):
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    for process in processes:
+        process.join()
+
+if __name__ == "__main__":
+    run_daemon()
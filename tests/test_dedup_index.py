@@ -0,0 +1,142 @@
+import asyncio, configparser, importlib, os
+
+import pytest
+
+from benchmarks.fleet import Fleet
+from bin import DedupIndex as dedup_module
+from bin.DedupIndex import GENERATIONS, DedupIndex
+from bin.ReadingBatch import ReadingBatch
+
+EXAMPLE_CONFIG = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "configuration.ini.example")
+
+class Clock:
+    """Stands in for time.monotonic in DedupIndex, advanced by hand."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(dedup_module.time, "monotonic", clock)
+    return clock
+
+def reading_batch(*messages) -> ReadingBatch:
+    batch = ReadingBatch()
+    for message in messages:
+        batch.add_message(message)
+    return batch
+
+def test_duplicate_packets_are_claimed_once(clock):
+    index = DedupIndex(ttl=60)
+    key = DedupIndex.packet_key("unit", "payload")
+    assert index.claim(key)
+    assert not index.claim(key)
+    assert index.claim(DedupIndex.packet_key("other unit", "payload"))
+    assert index.stats()["packets_dropped"] == 1
+
+    # A packet that failed is released, so its retransmission is processed.
+    index.release(key)
+    assert index.claim(key)
+
+def test_keys_expire_after_the_ttl(clock):
+    index = DedupIndex(ttl=60)
+    index.claim("early")
+    clock.now += 30
+    index.claim("late")
+
+    # Keys live at least ttl seconds, and at most a generation longer.
+    clock.now += 30
+    assert not index.claim("early")
+    clock.now += 60 / GENERATIONS + 1
+    assert index.claim("early")
+    assert not index.claim("late")
+
+    # After a quiet spell every generation has expired, the newest included.
+    clock.now += 60 + 60 / GENERATIONS
+    assert index.claim("late")
+    assert index.claim("early")
+    assert index.stats()["generations"] == 1
+
+def test_generations_rotate_at_max_entries(clock):
+    index = DedupIndex(ttl=3600, max_entries=100)
+    for key in range(100 // GENERATIONS):
+        index.claim(key)
+    assert index.stats()["generations"] == 1
+
+    # A full generation starts a new one, without any time passing.
+    index.claim("next")
+    assert index.stats()["generations"] == 2
+
+    for key in range(1000):
+        index.claim(("more", key))
+    stats = index.stats()
+    assert stats["entries"] <= 100 + 100 // GENERATIONS and stats["evicted"] > 0
+    # The oldest generations are evicted whole, the newest keys are kept.
+    assert not index.seen(0) and index.seen(("more", 999))
+
+def test_resent_readings_are_dropped(clock):
+    fleet = Fleet(2, 4, 2)
+    unit, other = fleet.unit_ids
+    first, second = fleet.reading_message(unit, 1696790400), fleet.reading_message(unit, 1696790700)
+    index = DedupIndex(ttl=60)
+    batch = reading_batch(first)
+    assert index.admit(unit, batch) is batch
+    assert index.admit(unit, reading_batch(first)).row_count == 0
+    assert index.admit(other, reading_batch(first)).row_count == batch.row_count
+
+    # Readings repacked with new ones into another packet keep only the new ones, and their state changes.
+    mixed = reading_batch(first, second)
+    admitted = index.admit(unit, mixed)
+    assert set(admitted.period_start) == {1696790700} and len(admitted) == 4
+    assert admitted.state_change_count == mixed.state_change_count - batch.state_change_count
+    assert index.stats()["readings_dropped"] == 8
+
+    index.forget(unit, admitted)
+    assert index.admit(unit, admitted) is admitted
+
+@pytest.fixture
+def ingress(tmp_path, monkeypatch):
+    """main, configured from the example configuration in a scratch directory, with its store and tariffs faked."""
+    config = configparser.ConfigParser()
+    config.read(EXAMPLE_CONFIG)
+    config.set("SUPABASE", "supabase_url", "http://127.0.0.1:9")
+    config.set("SUPABASE", "supabase_service_key", "eyJhbGciOiJIUzI1NiIsInR5cCI6IkpXVCJ9.eyJyb2xlIjoic2VydmljZV9yb2xlIn0.x")
+    config.set("EMQX", "emqx_jwt_secret", "secret")
+    config.set("COMPRESSION", "executor", "inline")
+    with open(tmp_path / "configuration.ini", "w") as file:
+        config.write(file)
+    monkeypatch.chdir(tmp_path)
+
+    from benchmarks.fake_supabase import FakeSupabase
+    main = importlib.import_module("main")
+    main.load_config()
+    fleet = Fleet(3, 4, 2)
+    main.supabase_client = main.tariff_store.client = FakeSupabase(fleet.tables())
+    batches = []
+    async def capture(batch):
+        batches.append(batch)
+    main.reading_buffer.flush_callback = capture
+    yield main, fleet, batches
+    asyncio.run(main.shutdown())
+
+def test_duplicate_packets_are_acknowledged(ingress):
+    main, fleet, batches = ingress
+    from models import BrokerWebhook
+
+    async def run():
+        results = []
+        packets = fleet.ingress_packets(1)
+        for unit_id, payload in packets + packets:
+            results.append(await main.process_webhook(BrokerWebhook(clientId=unit_id, topic="/ingress/" + unit_id, data=payload)))
+        await main.reading_buffer.flush()
+        return results
+
+    results = asyncio.run(run())
+    # Retransmissions are acknowledged as received, so units stop resending them, but queued only once.
+    assert results == [{"result": "ok", "message": "success"}] * 3 + [{"result": "ok", "message": "Duplicate packet, already received."}] * 3
+    assert sum(len(batch) for batch in batches) == 12
+    assert main.dedup_index.stats()["packets_dropped"] == 3
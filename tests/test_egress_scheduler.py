@@ -0,0 +1,135 @@
+import asyncio, time
+
+from bin.EgressScheduler import APPEND, BATCH_TYPE, REPLACE, SUPERSEDED, EgressScheduler
+from models import EgressMessage, ScheduleItem, ScheduleUpdateMessage, TagList, TagUpdateMessage
+
+OK = {"result": "ok", "message": "success"}
+
+def schedule(action: int, timestamp: int) -> EgressMessage:
+    return EgressMessage(type=1, data=ScheduleUpdateMessage(action=action, schedule=[ScheduleItem(module_id="m1", state=True, timestamp=timestamp, period=60, count=1)]))
+
+def tags(action: int, tag: str) -> EgressMessage:
+    return EgressMessage(type=4, data=TagUpdateMessage(action=action, tags=[TagList(module_id="m1", tags=[tag])]))
+
+class Recorder:
+    """Publish callback that records each call and answers every envelope with OK."""
+
+    def __init__(self):
+        self.calls = []
+
+    async def __call__(self, envelopes):
+        self.calls.append((time.monotonic(), envelopes))
+        return [OK] * len(envelopes)
+
+def run(scheduler: EgressScheduler, submissions):
+    """Submit (topic, message) pairs in order on a running scheduler and return their results."""
+    async def go():
+        await scheduler.start()
+        tasks = []
+        for topic, message in submissions:
+            tasks.append(asyncio.create_task(scheduler.submit(topic, message)))
+            await asyncio.sleep(0)
+        results = await asyncio.gather(*tasks)
+        await scheduler.stop()
+        return results
+    return asyncio.run(go())
+
+def test_disabled_window_publishes_at_once():
+    publish = Recorder()
+    scheduler = EgressScheduler(publish, window=0)
+    results = run(scheduler, [("/egress/u1", schedule(REPLACE, 1)), ("/egress/u1", schedule(REPLACE, 2))])
+    assert results == [OK, OK]
+    assert [envelopes for _, envelopes in publish.calls] == [[("/egress/u1", schedule(REPLACE, 1))], [("/egress/u1", schedule(REPLACE, 2))]]
+
+def test_superseded_message_is_resolved_distinctly():
+    publish = Recorder()
+    scheduler = EgressScheduler(publish, window=0.05, batch=False)
+    results = run(scheduler, [
+        ("/egress/u1", schedule(REPLACE, 1)),
+        ("/egress/u1", schedule(APPEND, 2)),
+        ("/egress/u1", tags(REPLACE, "a")),
+        ("/egress/u1", schedule(REPLACE, 3)),
+    ])
+    # The replace drops both schedule messages before it, whose callers must not record state the unit never got.
+    assert results == [SUPERSEDED, SUPERSEDED, OK, OK]
+    assert [envelopes for _, envelopes in publish.calls] == [[("/egress/u1", tags(REPLACE, "a")), ("/egress/u1", schedule(REPLACE, 3))]]
+    assert scheduler.stats()["messages_superseded"] == 2
+
+def test_append_does_not_supersede():
+    publish = Recorder()
+    scheduler = EgressScheduler(publish, window=0.05, batch=False)
+    assert run(scheduler, [("/egress/u1", schedule(REPLACE, 1)), ("/egress/u1", schedule(APPEND, 2))]) == [OK, OK]
+    assert len(publish.calls[0][1]) == 2
+
+def test_batch_envelope_per_topic():
+    publish = Recorder()
+    scheduler = EgressScheduler(publish, window=0.05, batch=True)
+    results = run(scheduler, [
+        ("/egress/u1", schedule(APPEND, 1)),
+        ("/egress/u2", schedule(APPEND, 2)),
+        ("/egress/u1", tags(APPEND, "a")),
+    ])
+    assert results == [OK, OK, OK]
+    # Both topics are due together and share one publish; u1's two messages travel in one envelope.
+    assert len(publish.calls) == 1
+    (topic, envelope), single = publish.calls[0][1]
+    assert topic == "/egress/u1" and envelope.type == BATCH_TYPE
+    assert envelope.data.messages == [schedule(APPEND, 1), tags(APPEND, "a")]
+    assert single == ("/egress/u2", schedule(APPEND, 2))
+    assert scheduler.stats()["messages_batched"] == 2
+
+def test_messages_wait_out_the_window():
+    publish = Recorder()
+    scheduler = EgressScheduler(publish, window=0.1)
+
+    async def go():
+        await scheduler.start()
+        start = time.monotonic()
+        result = await scheduler.submit("/egress/u1", schedule(APPEND, 1))
+        await scheduler.stop()
+        return start, result
+
+    start, result = asyncio.run(go())
+    assert result == OK
+    # The loop may wake a clock tick early.
+    assert publish.calls[0][0] - start >= 0.09
+
+def test_full_topic_is_published_before_the_window():
+    publish = Recorder()
+    scheduler = EgressScheduler(publish, window=60, max_messages=3, batch=True)
+
+    async def go():
+        await scheduler.start()
+        results = await asyncio.wait_for(asyncio.gather(*(scheduler.submit("/egress/u1", schedule(APPEND, i)) for i in range(3))), 5)
+        await scheduler.stop()
+        return results
+
+    assert asyncio.run(go()) == [OK, OK, OK]
+    assert len(publish.calls) == 1 and publish.calls[0][1][0][1].type == BATCH_TYPE
+
+def test_stop_publishes_held_messages():
+    publish = Recorder()
+    scheduler = EgressScheduler(publish, window=60)
+
+    async def go():
+        await scheduler.start()
+        task = asyncio.create_task(scheduler.submit("/egress/u1", schedule(APPEND, 1)))
+        await asyncio.sleep(0)
+        await scheduler.stop()
+        return await task
+
+    assert asyncio.run(go()) == OK
+    assert len(publish.calls) == 1
+
+def test_publish_failure_reaches_every_caller():
+    async def publish(envelopes):
+        raise ConnectionError("broker down")
+    scheduler = EgressScheduler(publish, window=0.05, batch=True)
+
+    async def go():
+        await scheduler.start()
+        results = await asyncio.gather(*(scheduler.submit("/egress/u1", schedule(APPEND, i)) for i in range(2)), return_exceptions=True)
+        await scheduler.stop()
+        return results
+
+    assert all(isinstance(result, ConnectionError) for result in asyncio.run(go()))
@@ -0,0 +1,92 @@
+import json, random
+
+import pytest
+
+from benchmarks.payloads import make_reading_message
+from bin.IngressStreamParser import IngressStreamParser
+from models import IngressMessage
+
+def document(modules: int = 20, seed: int = 0) -> tuple:
+    """An ingress message and its JSON, spaced out so chunks also split on whitespace."""
+    message = make_reading_message(modules=modules, state_changes=2, seed=seed)
+    text = IngressMessage(type=0, data=message).model_dump_json().replace(',"', ', \n "').replace(':', ' : ')
+    return message, text
+
+def parse(chunks) -> tuple:
+    parser = IngressStreamParser()
+    readings = []
+    for chunk in chunks:
+        readings.extend(parser.feed(chunk))
+    readings.extend(parser.close())
+    return parser, readings
+
+def test_whole_document():
+    message, text = document()
+    parser, readings = parse([text])
+    assert (parser.type, parser.period_start, parser.period_end) == (0, message.period_start, message.period_end)
+    assert readings == message.readings
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 64])
+def test_chunks_split_every_token(size):
+    message, text = document(modules=5)
+    # Chunks of a few characters split keys, strings, numbers, literals and the separators between them.
+    parser, readings = parse(text[start:start + size] for start in range(0, len(text), size))
+    assert (parser.type, parser.period_start, parser.period_end) == (0, message.period_start, message.period_end)
+    assert readings == message.readings
+
+def test_random_chunks():
+    message, text = document(modules=200, seed=1)
+    rng = random.Random(0)
+    chunks, start = [], 0
+    while start < len(text):
+        size = rng.randint(1, 300)
+        chunks.append(text[start:start + size])
+        start += size
+    assert parse(chunks)[1] == message.readings
+
+def test_numbers_split_at_the_chunk_end():
+    # 1696790400 could end at any digit, so the parser must wait for the next chunk before taking it.
+    parser = IngressStreamParser()
+    assert parser.feed('{"type": 0, "data": {"period_start": 16967') == []
+    assert parser.period_start is None
+    parser.feed('90400, "period_end": 1696790700, "readings": []}}')
+    parser.close()
+    assert (parser.period_start, parser.period_end) == (1696790400, 1696790700)
+
+def test_readings_are_returned_as_they_complete():
+    message, text = document(modules=3)
+    parser = IngressStreamParser()
+    second = text.index('"module_id"', text.index('"module_id"') + 1)
+    assert parser.feed(text[:second]) == message.readings[:1]
+    assert parser.feed(text[second:]) == message.readings[1:]
+    assert parser.close() == []
+    assert parser.reading_count == 3
+
+def test_period_after_readings():
+    message = make_reading_message(modules=3)
+    data = json.loads(message.model_dump_json())
+    text = json.dumps({"data": {"readings": data["readings"], "extra": [1, {"nested": [2, "]}"]}], "period_end": data["period_end"], "period_start": data["period_start"]}, "type": 0})
+
+    parser = IngressStreamParser()
+    readings = parser.feed(text[:text.index('"extra"')])
+    # The readings complete before their period is known; the caller holds them until it is.
+    assert readings == message.readings and parser.period_start is None and parser.period_end is None
+    readings.extend(parser.feed(text[text.index('"extra"'):]))
+    readings.extend(parser.close())
+    assert (parser.type, parser.period_start, parser.period_end) == (0, message.period_start, message.period_end)
+    assert readings == message.readings
+
+def test_other_types():
+    parser, readings = parse(['{"type": 2, "data": {"readings": [], "period_start": 1, "period_end": 2}}'])
+    assert parser.type == 2 and readings == []
+
+@pytest.mark.parametrize("text", [
+    '{"type": 0, "data": {"period_start": 1, "period_end": 2, "readings": [{"module_id": "x"}]}}',
+    '{"type": 0, "data": {"readings": [',
+    '{"type": 0, "data": {"period_start": 1, "period_end": 2, "readings": []}} x',
+    '{"type": 0, "data": {"period_start": 1 "period_end": 2}}',
+    '',
+])
+def test_invalid_documents(text):
+    with pytest.raises(ValueError):
+        parse([text])
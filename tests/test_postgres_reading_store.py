@@ -0,0 +1,137 @@
+"""
+Tests of PostgresReadingStore against a real database, in a schema of their own that is dropped afterwards.
+
+Skipped unless SDR_TEST_POSTGRES_DSN is set, e.g. SDR_TEST_POSTGRES_DSN=postgresql://postgres@localhost/postgres
+"""
+import decimal, os, uuid
+
+import pytest
+
+psycopg = pytest.importorskip("psycopg")
+pytest.importorskip("psycopg_pool")
+from psycopg import sql
+from psycopg.conninfo import make_conninfo
+
+from benchmarks.payloads import make_reading_message
+from bin.PostgresReadingStore import PostgresReadingStore
+from bin.ReadingBatch import READING_COLUMNS, ReadingBatch, timestamp_datetime
+
+DSN = os.environ.get("SDR_TEST_POSTGRES_DSN")
+pytestmark = pytest.mark.skipif(not DSN, reason="SDR_TEST_POSTGRES_DSN is not set")
+
+# Numeric columns as well as double precision ones, so the binary COPY converters are exercised.
+SCHEMA = """
+    CREATE TABLE readings (
+        module_id uuid NOT NULL,
+        period_start_time timestamptz NOT NULL,
+        period_end_time timestamptz NOT NULL,
+        sample_count integer,
+        mean_voltage numeric,
+        mean_frequency numeric,
+        mean_apparent_power double precision,
+        max_apparent_power double precision,
+        iqr_apparent_power double precision,
+        kurtosis_apparent_power double precision,
+        mean_power_factor double precision,
+        max_power_factor double precision,
+        iqr_power_factor double precision,
+        kurtosis_power_factor double precision,
+        kwh_usage numeric,
+        cost numeric,
+        PRIMARY KEY (module_id, period_start_time)
+    );
+    CREATE TABLE module_state_changes (
+        id bigserial PRIMARY KEY,
+        module uuid NOT NULL,
+        state boolean NOT NULL,
+        "timestamp" timestamptz NOT NULL CHECK ("timestamp" >= '2000-01-01')
+    );
+"""
+
+@pytest.fixture
+def schema_dsn():
+    """DSN whose search path is a fresh schema holding the readings tables."""
+    schema = "test_" + uuid.uuid4().hex
+    with psycopg.connect(DSN, autocommit=True) as connection:
+        connection.execute(sql.SQL("CREATE SCHEMA {}").format(sql.Identifier(schema)))
+    dsn = make_conninfo(DSN, options="-c search_path=" + schema)
+    with psycopg.connect(dsn, autocommit=True) as connection:
+        connection.execute(SCHEMA)
+    yield dsn
+    with psycopg.connect(DSN, autocommit=True) as connection:
+        connection.execute(sql.SQL("DROP SCHEMA {} CASCADE").format(sql.Identifier(schema)))
+
+@pytest.fixture
+def store(schema_dsn):
+    store = PostgresReadingStore(schema_dsn, cost=True)
+    yield store
+    store.close()
+
+def make_batch(seed: int = 0, period_start: int = 1696790400) -> ReadingBatch:
+    batch = ReadingBatch()
+    batch.add_message(make_reading_message(modules=4, state_changes=2, period_start=period_start, seed=seed))
+    return batch
+
+def fetch(store: PostgresReadingStore, query: str) -> list:
+    with store.pool.connection() as connection:
+        return connection.execute(query).fetchall()
+
+def test_copy_into_staging(store):
+    batch = make_batch()
+    batch.cost.extend([0.5, 1.25])
+    with store.pool.connection() as connection, connection.transaction(), connection.cursor() as cursor:
+        store.copy_rows(cursor, "readings", store.reading_columns, store.reading_types, batch.reading_columns(timestamp_datetime, store.cost))
+        rows = cursor.execute("SELECT * FROM readings_staging ORDER BY kwh_usage").fetchall()
+        # Staged rows go with the transaction, nothing reaches readings.
+        raise psycopg.Rollback()
+
+    assert fetch(store, "SELECT count(*) FROM readings") == [(0,)]
+
+    columns = READING_COLUMNS + ("cost",)
+    expected = sorted(zip(*batch.reading_columns(timestamp_datetime, lambda cost: None if cost != cost else cost)), key=lambda row: row[-2])
+    assert len(rows) == len(batch)
+    for row, values in zip(rows, expected):
+        row = dict(zip(columns, row))
+        assert str(row["module_id"]) == values[0]
+        assert row["period_start_time"] == values[1] and row["period_end_time"] == values[2]
+        assert row["sample_count"] == values[3]
+        assert row["mean_voltage"] == decimal.Decimal(repr(values[4]))
+        assert row["max_apparent_power"] == values[7]
+        assert row["kwh_usage"] == decimal.Decimal(repr(values[14]))
+        assert row["cost"] == (None if values[15] is None else decimal.Decimal(repr(values[15])))
+
+def test_merge_readings_and_state_changes(store):
+    batch = make_batch()
+    store.write(batch)
+
+    readings = fetch(store, "SELECT module_id::text, EXTRACT(EPOCH FROM period_start_time)::bigint, kwh_usage, cost FROM readings ORDER BY module_id")
+    assert [(module_id, start) for module_id, start, _, _ in readings] == sorted(zip(batch.module_id, batch.period_start))
+    assert all(cost is None for _, _, _, cost in readings)
+    states = fetch(store, "SELECT module::text, state, EXTRACT(EPOCH FROM \"timestamp\")::bigint FROM module_state_changes ORDER BY id")
+    assert states == list(zip(batch.state_module, map(bool, batch.state), batch.state_timestamp))
+
+    # Readings are upserted on (module_id, period_start_time), state changes are appended.
+    again = make_batch(seed=0)
+    again.kwh_usage = type(again.kwh_usage)('d', [value + 1 for value in again.kwh_usage])
+    again.cost.extend([2.0] * len(again))
+    store.write(again)
+
+    readings = fetch(store, "SELECT module_id::text, kwh_usage, cost FROM readings")
+    assert len(readings) == len(batch)
+    expected = dict(zip(again.module_id, again.kwh_usage))
+    assert all(kwh_usage == decimal.Decimal(repr(expected[module_id])) and cost == 2 for module_id, kwh_usage, cost in readings)
+    assert fetch(store, "SELECT count(*) FROM module_state_changes") == [(2 * batch.state_change_count,)]
+
+def test_failed_merge_rolls_back(store):
+    store.write(make_batch(seed=1))
+    before = fetch(store, "SELECT module_id, period_start_time, kwh_usage FROM readings ORDER BY 1, 2")
+
+    # The state change merge breaks the CHECK constraint after the readings merged, and must take them with it.
+    batch = make_batch(seed=2, period_start=946684800 - 3600)
+    with pytest.raises(psycopg.errors.CheckViolation):
+        store.write(batch)
+    assert fetch(store, "SELECT module_id, period_start_time, kwh_usage FROM readings ORDER BY 1, 2") == before
+
+    # The pool's connections are usable afterwards.
+    store.write(make_batch(seed=3))
+    assert fetch(store, "SELECT count(*) FROM readings") == [(len(before) + 4,)]
@@ -0,0 +1,73 @@
+import struct
+
+import pytest
+
+from benchmarks.payloads import make_reading_message
+from bin.ReadingBatch import ReadingBatch
+from bin.ReadingCodec import HEADER, STRING_IDS, VERSION, ReadingCodecError, decode_reading_batch, encode_reading_message, write_svarint, write_uvarint
+from models import ReadingMessage
+
+def expected_batch(message: ReadingMessage) -> ReadingBatch:
+    batch = ReadingBatch()
+    batch.add_message(message)
+    return batch
+
+def header(count: int, state_change_count: int, flags: int = 0) -> bytearray:
+    out = bytearray(HEADER.pack(VERSION, 0, flags))
+    write_uvarint(out, 1696790400)
+    write_svarint(out, 300)
+    write_uvarint(out, count)
+    write_uvarint(out, state_change_count)
+    return out
+
+@pytest.mark.parametrize("message", [
+    ReadingMessage(period_start=1696790400, period_end=1696790700, readings=[]),
+    make_reading_message(modules=4, state_changes=3),
+    make_reading_message(modules=16, state_changes=0, seed=1),
+])
+def test_round_trip(message):
+    message_type, batch = decode_reading_batch(encode_reading_message(message))
+    assert message_type == 0
+    assert vars(batch) == vars(expected_batch(message))
+
+def test_round_trip_string_ids():
+    message = make_reading_message(modules=4)
+    readings = [reading.model_copy(update={"module_id": module_id}) for reading, module_id in zip(message.readings, ("module-1", "D0F96266-6D4B-46CB-9C7B-C31142F6AB30", "ünïcode", ""))]
+    message = message.model_copy(update={"readings": readings})
+    _, batch = decode_reading_batch(encode_reading_message(message))
+    assert vars(batch) == vars(expected_batch(message))
+
+def test_damaged_frames():
+    frame = encode_reading_message(make_reading_message(modules=4, state_changes=3))
+    for damaged in (b"", frame[:2], frame[:-1], frame + b"\0", frame[:20], b"\2" + frame[1:]):
+        with pytest.raises(ReadingCodecError):
+            decode_reading_batch(damaged)
+
+def test_state_change_index_out_of_range():
+    message = make_reading_message(modules=2, state_changes=3)
+    frame = bytearray(encode_reading_message(message))
+    # The state changes' reading indices come before their states and timestamps; point the first past the last reading.
+    tail = bytearray()
+    for reading in message.readings:
+        for change in reading.state_changes:
+            tail.append(change.state)
+    for reading in message.readings:
+        for change in reading.state_changes:
+            write_svarint(tail, change.timestamp - message.period_start)
+    state_change_count = sum(len(reading.state_changes) for reading in message.readings)
+    index_offset = len(frame) - len(tail) - 4 * state_change_count
+    assert struct.unpack_from("<I", frame, index_offset) == (0,)
+    struct.pack_into("<I", frame, index_offset, len(message.readings) + 1)
+    with pytest.raises(ReadingCodecError):
+        decode_reading_batch(bytes(frame))
+
+@pytest.mark.parametrize("count, state_change_count, flags", [
+    (10000000, 0, 0),
+    (10000000, 0, STRING_IDS),
+    (0, 10000000, 0),
+    (1, 0, 0),
+])
+def test_oversized_counts_are_rejected_before_decoding(count, state_change_count, flags):
+    frame = bytes(header(count, state_change_count, flags))
+    with pytest.raises(ReadingCodecError, match="shorter than its header"):
+        decode_reading_batch(frame)
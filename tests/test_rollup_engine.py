@@ -0,0 +1,147 @@
+import asyncio, math
+
+import pytest
+
+pytest.importorskip("numpy")
+
+from bin.ReadingBatch import ReadingBatch, format_timestamp
+from bin.RollupEngine import DAY, HOUR, ROLLUP_COLUMNS, RollupEngine
+from models import ReadingDataItem, ReadingMessage, StateChangeItem
+
+UTC_OFFSET = 7200
+# Midnight of 9 October 2023 in local time, UTC_OFFSET ahead of UTC.
+LOCAL_MIDNIGHT = 1696802400
+
+def reading(module_id: str, samples: int, voltage: float, kwh: float, max_power: float, state_changes=()) -> ReadingDataItem:
+    return ReadingDataItem(
+        module_id=module_id, sample_count=samples, mean_voltage=voltage, mean_frequency=50.0,
+        apparent_power=[0.0, max_power, 0.0, 0.0], power_factor=[1.0, 1.0, 0.0, 0.0], kwh_usage=kwh,
+        state_changes=[StateChangeItem(state=bool(index % 2), timestamp=timestamp) for index, timestamp in enumerate(state_changes)],
+    )
+
+def batch(period_start: int, *readings: ReadingDataItem) -> ReadingBatch:
+    result = ReadingBatch()
+    result.add_message(ReadingMessage(period_start=period_start, period_end=period_start + 300, readings=list(readings)))
+    return result
+
+def merge(stored: dict, delta: dict) -> dict:
+    """The merge of MERGE_UPDATES, on rows of ROLLUP_COLUMNS values."""
+    if stored is None:
+        return dict(delta)
+    samples = stored["samples"] + delta["samples"]
+    merged = {"readings": stored["readings"] + delta["readings"], "samples": samples}
+    for name in ("mean_voltage", "mean_frequency"):
+        weighted = sum(row[name] * row["samples"] for row in (stored, delta) if row[name] is not None)
+        merged[name] = weighted / samples if samples else None
+    merged["kwh_usage"] = stored["kwh_usage"] + delta["kwh_usage"]
+    costs = [row["cost"] for row in (stored, delta) if row["cost"] is not None]
+    merged["cost"] = sum(costs) if costs else None
+    powers = [row["max_apparent_power"] for row in (stored, delta) if row["max_apparent_power"] is not None]
+    merged["max_apparent_power"] = max(powers) if powers else None
+    merged["state_changes"] = stored["state_changes"] + delta["state_changes"]
+    return merged
+
+class Store:
+    """Flush callback keeping rollup rows by (level, id, resolution, window_start), merged like the database does."""
+
+    def __init__(self):
+        self.rows = {}
+
+    async def __call__(self, rollups):
+        for level_rollups in rollups:
+            for row in level_rollups.rows():
+                key = (level_rollups.level, row[level_rollups.id_column], row["resolution"], row["window_start"])
+                self.rows[key] = merge(self.rows.get(key), {name: row[name] for name in ROLLUP_COLUMNS[2:]})
+
+def roll_up(engine: RollupEngine, unit_batches, flush_every: int = 0):
+    """Add (unit_id, batch) pairs, flushing after every `flush_every` of them and at the end."""
+    async def go():
+        for index, (unit_id, unit_batch) in enumerate(unit_batches, 1):
+            engine.add(unit_id, unit_batch)
+            if flush_every and index % flush_every == 0:
+                await engine.flush()
+        await engine.flush()
+    asyncio.run(go())
+
+def test_windows_follow_local_time():
+    store = Store()
+    engine = RollupEngine(store, utc_offset=UTC_OFFSET)
+    # 23:55 and 00:05 local are on different local days, though both are on 8 October in UTC.
+    roll_up(engine, [
+        ("u1", batch(LOCAL_MIDNIGHT - 300, reading("m1", 10, 230.0, 1.0, 100.0))),
+        ("u1", batch(LOCAL_MIDNIGHT + 300, reading("m1", 30, 234.0, 2.0, 300.0), reading("m2", 10, 238.0, 0.5, 50.0))),
+        ("u1", batch(LOCAL_MIDNIGHT + 1800, reading("m1", 10, 230.0, 1.0, 200.0, state_changes=[LOCAL_MIDNIGHT + 3599, LOCAL_MIDNIGHT + 3600]))),
+    ])
+
+    rows = store.rows
+    assert set(key for key in rows if key[:3] == ("module", "m1", HOUR)) == {
+        ("module", "m1", HOUR, format_timestamp(LOCAL_MIDNIGHT - HOUR)),
+        ("module", "m1", HOUR, format_timestamp(LOCAL_MIDNIGHT)),
+        ("module", "m1", HOUR, format_timestamp(LOCAL_MIDNIGHT + HOUR)),
+    }
+    assert set(key[3] for key in rows if key[:3] == ("unit", "u1", DAY)) == {format_timestamp(LOCAL_MIDNIGHT - DAY), format_timestamp(LOCAL_MIDNIGHT)}
+    assert format_timestamp(LOCAL_MIDNIGHT) == "2023-10-08 22:00:00+00"
+
+    day = rows[("unit", "u1", DAY, format_timestamp(LOCAL_MIDNIGHT))]
+    assert (day["readings"], day["samples"], day["kwh_usage"], day["max_apparent_power"], day["state_changes"]) == (3, 50, 3.5, 300.0, 2)
+    assert day["mean_voltage"] == pytest.approx((30 * 234.0 + 10 * 238.0 + 10 * 230.0) / 50)
+    assert day["cost"] is None
+
+    # A state change in an hour without readings gives a row of its own, with no means.
+    state_hour = rows[("module", "m1", HOUR, format_timestamp(LOCAL_MIDNIGHT + HOUR))]
+    assert (state_hour["readings"], state_hour["samples"], state_hour["mean_voltage"], state_hour["max_apparent_power"], state_hour["state_changes"]) == (0, 0, None, None, 1)
+    assert rows[("module", "m1", HOUR, format_timestamp(LOCAL_MIDNIGHT))]["state_changes"] == 1
+
+@pytest.mark.parametrize("utc_offset", [0, -5 * 3600, 5 * 3600 + 1800])
+def test_window_starts(utc_offset):
+    store = Store()
+    engine = RollupEngine(store, utc_offset=utc_offset)
+    timestamp = 1696790400 + 12345
+    roll_up(engine, [("u1", batch(timestamp, reading("m1", 10, 230.0, 1.0, 100.0)))])
+
+    starts = {key[2]: key[3] for key in store.rows if key[0] == "unit"}
+    local = timestamp + utc_offset
+    assert starts == {HOUR: format_timestamp(local // HOUR * HOUR - utc_offset), DAY: format_timestamp(local // DAY * DAY - utc_offset)}
+
+def test_resent_readings_within_a_flush_count_once():
+    store = Store()
+    engine = RollupEngine(store, utc_offset=UTC_OFFSET)
+    # The later copy of a reading wins, and a state change sent twice is counted once.
+    roll_up(engine, [
+        ("u1", batch(LOCAL_MIDNIGHT, reading("m1", 10, 230.0, 1.0, 100.0, state_changes=[LOCAL_MIDNIGHT + 10]))),
+        ("u1", batch(LOCAL_MIDNIGHT, reading("m1", 12, 232.0, 1.5, 120.0, state_changes=[LOCAL_MIDNIGHT + 10]))),
+    ])
+
+    hour = store.rows[("module", "m1", HOUR, format_timestamp(LOCAL_MIDNIGHT))]
+    assert (hour["readings"], hour["samples"], hour["mean_voltage"], hour["kwh_usage"], hour["max_apparent_power"], hour["state_changes"]) == (1, 12, 232.0, 1.5, 120.0, 1)
+    assert engine.stats()["readings_rolled_up"] == 2
+
+def test_flushes_merge_to_the_same_totals():
+    unit_batches = [
+        ("u" + str(index % 3), batch(LOCAL_MIDNIGHT - DAY + 1500 * index, reading("m" + str(index % 5), 5 + index, 225.0 + index % 7, 0.1 * index, float(index), state_changes=[LOCAL_MIDNIGHT - DAY + 1500 * index + 60])))
+        for index in range(120)
+    ]
+    once, flushed = Store(), Store()
+    roll_up(RollupEngine(once, utc_offset=UTC_OFFSET), unit_batches)
+    roll_up(RollupEngine(flushed, utc_offset=UTC_OFFSET), unit_batches[::-1], flush_every=7)
+
+    assert set(once.rows) == set(flushed.rows)
+    for key, row in once.rows.items():
+        for name, value in row.items():
+            assert math.isclose(value, flushed.rows[key][name], rel_tol=1e-9) if value is not None else flushed.rows[key][name] is None, (key, name)
+
+def test_resent_readings_after_their_flush_count_again():
+    store = Store()
+    engine = RollupEngine(store, utc_offset=UTC_OFFSET)
+    resent = batch(LOCAL_MIDNIGHT, reading("m1", 10, 230.0, 1.0, 100.0))
+    roll_up(engine, [("u1", resent), ("u1", batch(LOCAL_MIDNIGHT, reading("m1", 10, 230.0, 1.0, 100.0)))], flush_every=1)
+
+    hour = store.rows[("module", "m1", HOUR, format_timestamp(LOCAL_MIDNIGHT))]
+    assert (hour["readings"], hour["samples"], hour["kwh_usage"], hour["mean_voltage"]) == (2, 20, 2.0, 230.0)
+
+def test_queue_is_bounded():
+    store = Store()
+    engine = RollupEngine(store, max_rows=3)
+    engine.add("u1", batch(LOCAL_MIDNIGHT, reading("m1", 10, 230.0, 1.0, 100.0), reading("m2", 10, 230.0, 1.0, 100.0)))
+    engine.add("u1", batch(LOCAL_MIDNIGHT, reading("m3", 10, 230.0, 1.0, 100.0), reading("m4", 10, 230.0, 1.0, 100.0)))
+    assert (engine.depth, engine.stats()["rows_dropped"]) == (2, 2)
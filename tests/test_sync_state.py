@@ -0,0 +1,86 @@
+from bin.SyncState import APPEND, REPLACE, SyncState, apply_append, delta, diff_rules, diff_schedule, diff_tags
+from models import DeviceRule, ModuleRuleUpdate, RuleUpdateMessage, ScheduleItem, ScheduleUpdateMessage, TagList, TagUpdateMessage, UnitRuleUpdate
+
+def rule(priority: int) -> DeviceRule:
+    return DeviceRule(priority=priority, expression="x > " + str(priority), command="on")
+
+def rules(unit: list, modules: dict) -> RuleUpdateMessage:
+    return RuleUpdateMessage(
+        unit_rules=UnitRuleUpdate(action=REPLACE, rules=[rule(priority) for priority in unit]),
+        module_rules=[ModuleRuleUpdate(module_id=module_id, action=REPLACE, rules=[rule(priority) for priority in priorities]) for module_id, priorities in modules.items()],
+    )
+
+def schedule(count: int) -> ScheduleUpdateMessage:
+    return ScheduleUpdateMessage(action=REPLACE, schedule=[ScheduleItem(module_id="m1", state=bool(i % 2), timestamp=1696790400 + 60 * i, period=60, count=1) for i in range(count)])
+
+def tags(modules: dict) -> TagUpdateMessage:
+    return TagUpdateMessage(action=REPLACE, tags=[TagList(module_id=module_id, tags=module_tags) for module_id, module_tags in modules.items()])
+
+def test_unknown_state_is_replaced():
+    current = rules([1], {"m1": [2]})
+    assert diff_rules(None, current) is current
+    assert diff_schedule(None, schedule(2)) == schedule(2)
+    assert diff_tags(None, tags({"m1": ["a"]})) == tags({"m1": ["a"]})
+
+def test_unchanged_state_sends_nothing():
+    current = rules([1], {"m1": [2], "m2": []})
+    assert diff_rules(current.model_dump(), current) is None
+    assert diff_schedule(schedule(3).model_dump(), schedule(3)) is None
+    assert diff_tags(tags({"m1": ["a", "b"]}).model_dump(), tags({"m1": ["a", "b"]})) is None
+
+def test_rules_append_only():
+    update = diff_rules(rules([1], {"m1": [2], "m2": [3]}).model_dump(), rules([1, 4], {"m1": [2, 5], "m2": [3], "m3": [6]}))
+    assert update.unit_rules == UnitRuleUpdate(action=APPEND, rules=[rule(4)])
+    assert update.module_rules == [
+        ModuleRuleUpdate(module_id="m1", action=APPEND, rules=[rule(5)]),
+        ModuleRuleUpdate(module_id="m3", action=REPLACE, rules=[rule(6)]),
+    ]
+
+def test_rules_removal_is_replaced():
+    update = diff_rules(rules([1, 4], {"m1": [2, 5], "m2": [3]}).model_dump(), rules([4], {"m1": [5, 2]}))
+    assert update.unit_rules == UnitRuleUpdate(action=REPLACE, rules=[rule(4)])
+    # m2 was removed, and is cleared.
+    assert update.module_rules == [
+        ModuleRuleUpdate(module_id="m1", action=REPLACE, rules=[rule(5), rule(2)]),
+        ModuleRuleUpdate(module_id="m2", action=REPLACE, rules=[]),
+    ]
+
+def test_schedule_append_and_removal():
+    update = diff_schedule(schedule(2).model_dump(), schedule(4))
+    assert update == ScheduleUpdateMessage(action=APPEND, schedule=schedule(4).schedule[2:])
+    assert diff_schedule(schedule(4).model_dump(), schedule(3)) == schedule(3)
+
+def test_tags_append_and_removal():
+    update = diff_tags(tags({"m1": ["a"]}).model_dump(), tags({"m1": ["a", "b"], "m2": ["c"]}))
+    assert update == TagUpdateMessage(action=APPEND, tags=[TagList(module_id="m1", tags=["b"]), TagList(module_id="m2", tags=["c"])])
+    # The action covers the whole message, so one module losing a tag replaces them all.
+    assert diff_tags(tags({"m1": ["a"], "m2": ["c"]}).model_dump(), tags({"m1": ["a", "b"], "m2": []})) == tags({"m1": ["a", "b"], "m2": []})
+    assert diff_tags(tags({"m1": ["a"], "m2": ["c"]}).model_dump(), tags({"m1": ["a"]})) == tags({"m1": ["a"]})
+
+def test_apply_append():
+    appended = apply_append("schedule", schedule(2).model_dump(), ScheduleUpdateMessage(action=APPEND, schedule=schedule(3).schedule[2:]).model_dump())
+    assert appended == schedule(3).model_dump()
+
+    update = TagUpdateMessage(action=APPEND, tags=[TagList(module_id="m1", tags=["b"]), TagList(module_id="m2", tags=["c"])])
+    assert apply_append("tags", tags({"m1": ["a"]}).model_dump(), update.model_dump()) == tags({"m1": ["a", "b"], "m2": ["c"]}).model_dump()
+
+def test_apply_append_onto_unknown_state():
+    # Without the state the append went onto, the unit's state is unknown and its next sync must be a full replace.
+    update = ScheduleUpdateMessage(action=APPEND, schedule=schedule(1).schedule).model_dump()
+    assert apply_append("schedule", None, update) is None
+    assert apply_append("tags", None, TagUpdateMessage(action=APPEND, tags=[]).model_dump()) is None
+    update, _ = delta(SyncState("u1", "schedule"), schedule(1))
+    assert update == schedule(1)
+
+def test_delta_versions():
+    state = SyncState("u1", "schedule")
+    update, state = delta(state, schedule(2))
+    assert update == schedule(2)
+    assert (state.version, state.state) == (1, schedule(2).model_dump())
+
+    update, unchanged = delta(state, schedule(2))
+    assert update is None and unchanged is state
+
+    update, state = delta(state, schedule(3))
+    assert update == ScheduleUpdateMessage(action=APPEND, schedule=schedule(3).schedule[2:])
+    assert state.version == 2 and state.hash == SyncState("u1", "schedule").advance(schedule(3).model_dump()).hash
@@ -0,0 +1,88 @@
+import datetime, math
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from benchmarks.fleet import load_example_tou
+from benchmarks.tariff_table import walk_rate
+from bin.TariffTable import TariffCache, TariffTable
+from models import TOUSchedule
+
+UTC_OFFSET = 7200
+
+def local_timestamp(*args, utc_offset: int = UTC_OFFSET) -> int:
+    """Unix timestamp of a local time given as datetime arguments."""
+    return int(datetime.datetime(*args, tzinfo=datetime.timezone.utc).timestamp()) - utc_offset
+
+def wrapping_schedule() -> TOUSchedule:
+    """A season over the new year with a night period over midnight, and a gap in the seasons."""
+    return TOUSchedule.model_validate({
+        "seasons": [
+            {"name": "winter", "start_date": {"day": 1, "month": 11}, "end_date": {"day": 28, "month": 2}},
+            {"name": "summer", "start_date": {"day": 1, "month": 4}, "end_date": {"day": 30, "month": 9}},
+        ],
+        "base_prices": [{"season": "winter", "price": 1.0}, {"season": "summer", "price": 0.5}],
+        "tou_prices": [
+            {"season": "winter", "price": 0.25, "days": [1, 2, 3, 4, 5, 6, 7], "times": [{"start": 22, "end": 6}]},
+            {"season": "summer", "price": 2.0, "days": [2, 3, 4, 5, 6], "times": [{"start": 17, "end": 20}]},
+        ],
+        "public_holidays": [{"day": 25, "month": 12, "year": 2023, "treat_as": 1}],
+    })
+
+@pytest.mark.parametrize("utc_offset", [0, UTC_OFFSET, -5 * 3600])
+def test_rates_match_the_schedule_every_hour(utc_offset):
+    schedule = load_example_tou()
+    table = TariffTable(schedule, utc_offset)
+    timestamps = np.arange(local_timestamp(2022, 1, 1, utc_offset=utc_offset), local_timestamp(2025, 1, 1, utc_offset=utc_offset), 3600)
+    expected = np.array([walk_rate(schedule, int(timestamp), utc_offset) for timestamp in timestamps])
+    assert np.array_equal(table.rates(timestamps), expected, equal_nan=True)
+
+def test_hour_boundaries():
+    schedule = load_example_tou()
+    table = TariffTable(schedule, UTC_OFFSET)
+    # A weekday in the low season: 06:00-07:00 is a peak period, 05:00 and 07:00 are not.
+    for hour in range(24):
+        start = local_timestamp(2023, 10, 11, hour)
+        timestamps = [start - 1, start, start + 1799, start + 3599]
+        expected = [walk_rate(schedule, timestamp, UTC_OFFSET) for timestamp in timestamps]
+        assert list(table.rates(timestamps)) == expected
+    assert table.rates([local_timestamp(2023, 10, 11, 6)])[0] != table.rates([local_timestamp(2023, 10, 11, 7)])[0]
+    assert table.rates([local_timestamp(2023, 10, 11, 7) - 1])[0] == table.rates([local_timestamp(2023, 10, 11, 6)])[0]
+
+def test_holidays():
+    schedule = load_example_tou()
+    table = TariffTable(schedule, UTC_OFFSET)
+    # Freedom Day 2022, a Wednesday treated as Saturday, is off-peak at 08:00 unlike the Wednesday after.
+    freedom_day = local_timestamp(2022, 4, 27, 8)
+    assert table.rates([freedom_day])[0] == walk_rate(schedule, freedom_day, UTC_OFFSET) != walk_rate(schedule, freedom_day + 7 * 86400, UTC_OFFSET)
+
+def test_year_wrap():
+    schedule = wrapping_schedule()
+    table = TariffTable(schedule, UTC_OFFSET)
+    # 22:00 on new year's eve local is 20:00 UTC, and 01:00 on new year's day local is 23:00 UTC the year before.
+    timestamps = np.array([local_timestamp(2023, 12, 31, 21), local_timestamp(2023, 12, 31, 22), local_timestamp(2024, 1, 1, 1), local_timestamp(2024, 1, 1, 6)])
+    assert list(table.rates(timestamps)) == [1.0, 0.25, 0.25, 1.0]
+    # One call spanning the years is priced like calls within each.
+    assert list(table.rates(timestamps)) == [table.rates([timestamp])[0] for timestamp in timestamps]
+
+    # Every hour around the new year, over the leap day and through the gap between the seasons.
+    timestamps = np.arange(local_timestamp(2023, 12, 1), local_timestamp(2024, 4, 2), 3600)
+    expected = np.array([walk_rate(schedule, int(timestamp), UTC_OFFSET) for timestamp in timestamps])
+    assert np.array_equal(table.rates(timestamps), expected, equal_nan=True)
+    # Winter ends on 28 February, so the leap day is in no season.
+    assert table.rates([local_timestamp(2024, 2, 28, 12)])[0] == 1.0
+    assert math.isnan(table.rates([local_timestamp(2024, 2, 29, 12)])[0])
+
+def test_price_and_cache():
+    schedule = load_example_tou()
+    cache = TariffCache(max_entries=1, utc_offset=UTC_OFFSET)
+    table = cache.get(schedule)
+    assert cache.get(load_example_tou()) is table
+    assert cache.stats() == {"entries": 1, "hits": 1, "misses": 1}
+
+    timestamps = [local_timestamp(2023, 10, 11, 6), local_timestamp(2023, 10, 11, 12)]
+    assert list(table.price(timestamps, [2.0, 0.5])) == [2.0 * walk_rate(schedule, timestamps[0], UTC_OFFSET), 0.5 * walk_rate(schedule, timestamps[1], UTC_OFFSET)]
+
+    cache.get(wrapping_schedule())
+    assert cache.get(schedule) is not table